@@ -14,4 +14,5 @@ admin.site.register(Payment)
 admin.site.register(PostalCode)
 admin.site.register(ProductImage)
 admin.site.register(ProductVariant)
-admin.site.register(Coupon)
\ No newline at end of file
+admin.site.register(Coupon)
+admin.site.register(Tag)
\ No newline at end of file
@@ -0,0 +1,172 @@
+"""
+Async versions of the read-heavy endpoints, for deployments behind an ASGI
+server. They return the same payloads as their DRF counterparts (sharing
+their catalog cache entries) but do their database work through Django's
+async ORM, so a request waiting on a query doesn't hold a worker thread
+for its whole lifetime.
+
+Lists come newest first, a page at a time; pass the `next` link (a
+`cursor` of the last row's id) for the following page.
+"""
+import json
+import uuid
+
+from django.contrib.auth.models import AnonymousUser
+from django.db.models import Q
+from django.http import JsonResponse
+from django.utils.decorators import classonlymethod
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotAuthenticated, NotFound, ParseError
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.utils.urls import replace_query_param
+
+from api.authentication import aauthenticate
+from api.utils import catalog_cache, category_tree, postal_codes
+
+from .models import Category, Order, Product
+from .pagination import KeysetCursorPagination
+from .serializers import CategorySerializer, OrderSerializer, ProductSerializer
+
+
+def json_response(data, status_code=status.HTTP_200_OK):
+    return JsonResponse(data, status=status_code, encoder=JSONEncoder, safe=False)
+
+
+class AsyncAPIView(View):
+    """
+    JSON in and out, token authentication through the same cache as the DRF
+    views, DRF exceptions rendered as {'detail': ...}, and no CSRF check,
+    as with APIView.
+    """
+    authentication_required = False
+
+    @classonlymethod
+    def as_view(cls, **initkwargs):
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        try:
+            # AuthenticationMiddleware's lazy session user can't be loaded
+            # from async code; token authentication replaces it.
+            request.user = await aauthenticate(request) or AnonymousUser()
+            if self.authentication_required and not request.user.is_authenticated:
+                raise NotAuthenticated
+            return await super().dispatch(request, *args, **kwargs)
+        except APIException as exc:
+            response = json_response({'detail': exc.detail}, exc.status_code)
+            if exc.status_code == status.HTTP_401_UNAUTHORIZED:
+                response['WWW-Authenticate'] = 'Token'
+            return response
+
+    def get_data(self, request):
+        if request.content_type == 'application/json':
+            try:
+                data = json.loads(request.body or b'{}')
+            except ValueError:
+                raise ParseError
+            if not isinstance(data, dict):
+                raise ParseError('Expected a JSON object.')
+            return data
+        return request.POST
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.GET.get('page_size', KeysetCursorPagination.page_size))
+        except ValueError:
+            size = KeysetCursorPagination.page_size
+        return min(max(size, 1), KeysetCursorPagination.max_page_size)
+
+    def get_cache_scope(self, request):
+        # Same as CatalogCacheMixin's.
+        return request.build_absolute_uri('/')
+
+    async def paginate(self, request, queryset):
+        """
+        One page of `queryset` by (created_at, pk) descending, the order of
+        KeysetCursorPagination, and the next page's url (None on the last).
+        """
+        cursor = request.GET.get('cursor')
+        if cursor:
+            try:
+                cursor = uuid.UUID(cursor)
+            except ValueError:
+                raise NotFound('Invalid cursor')
+            created_at = await queryset.filter(pk=cursor).values_list('created_at', flat=True).afirst()
+            if created_at is None:
+                raise NotFound('Invalid cursor')
+            queryset = queryset.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, pk__lt=cursor))
+
+        size = self.get_page_size(request)
+        rows = [row async for row in queryset.order_by('-created_at', '-pk')[:size + 1]]
+        if len(rows) <= size:
+            return rows, None
+        rows = rows[:size]
+        return rows, replace_query_param(request.build_absolute_uri(), 'cursor', rows[-1].pk)
+
+
+async def _product_payloads(request, pks):
+    # Everything the serializer reads is prefetched, so it runs without
+    # touching the database.
+    queryset = ProductSerializer.setup_eager_loading(Product.objects.filter(pk__in=pks))
+    products = [product async for product in queryset]
+    serializer = ProductSerializer(products, many=True, context={'request': request})
+    return {str(row['id']): dict(row) for row in serializer.data}
+
+
+class AsyncProductListView(AsyncAPIView):
+    async def get(self, request):
+        page, next_url = await self.paginate(request, Product.objects.only('pk', 'created_at'))
+
+        async def build_many(pks):
+            return await _product_payloads(request, pks)
+
+        results = await catalog_cache.aget_many(
+            'product', [product.pk for product in page], build_many, self.get_cache_scope(request)
+        )
+        return json_response({'next': next_url, 'results': results})
+
+
+class AsyncProductDetailView(AsyncAPIView):
+    async def get(self, request, pk):
+        async def build():
+            return (await _product_payloads(request, [pk])).get(str(pk))
+
+        data = await catalog_cache.aget_one('product', pk, build, self.get_cache_scope(request))
+        if data is None:
+            raise NotFound
+        return json_response(data)
+
+
+class AsyncCategoryTreeView(AsyncAPIView):
+    async def get(self, request):
+        async def build():
+            categories = [category async for category in Category.objects.order_by('name')]
+            serializer = CategorySerializer(categories, many=True, context={'request': request})
+            return category_tree.build_tree(serializer.data)
+
+        scope = self.get_cache_scope(request)
+        return json_response(await catalog_cache.aget_collection('category', build, f'{scope}tree'))
+
+
+class AsyncValidatePostalCodeView(AsyncAPIView):
+    async def post(self, request):
+        code = self.get_data(request).get('postal_code')
+        if not code:
+            return json_response({"error": "Postal code is required"}, status.HTTP_400_BAD_REQUEST)
+
+        if await postal_codes.ais_serviceable(code):
+            return json_response({"message": "Service available in your area"})
+
+        return json_response({"message": "Service not available in your area"}, status.HTTP_404_NOT_FOUND)
+
+
+class AsyncUserOrdersView(AsyncAPIView):
+    authentication_required = True
+
+    async def get(self, request):
+        queryset = OrderSerializer.setup_eager_loading(Order.objects.filter(user=request.user))
+        page, next_url = await self.paginate(request, queryset)
+        serializer = OrderSerializer(page, many=True, context={'request': request})
+        return json_response({'next': next_url, 'results': serializer.data})
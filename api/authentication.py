@@ -0,0 +1,137 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from rest_framework.authentication import TokenAuthentication
+
+from api.utils.stats import register
+from api.utils.versions import bump_version_on_commit, get_version
+
+
+stats = register('token_auth', 'hits', 'misses', 'evictions', 'invalidations')
+
+
+def user_version_name(user_id):
+    return f'auth_user:{user_id}'
+
+
+def invalidate_user(user_id):
+    """
+    Drop every cached token of the user, in this worker and (through the
+    version stamp) in the others.
+    """
+    bump_version_on_commit(user_version_name(user_id))
+    token_cache.discard_user(user_id)
+    stats.incr('invalidations')
+
+
+class TokenCache:
+    """
+    Bounded LRU of token key -> (user, token), each entry valid for `ttl`
+    seconds and only as long as the user's version stamp is unchanged.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            user, token, version, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                stats.incr('evictions')
+                return None
+            self._entries.move_to_end(key)
+
+        if get_version(user_version_name(user.pk)) != version:
+            self.discard(key)
+            return None
+        # Views may modify request.user; never hand out the cached instance.
+        return copy.copy(user), copy.copy(token)
+
+    def set(self, key, user, token):
+        version = get_version(user_version_name(user.pk))
+        with self._lock:
+            self._entries[key] = (copy.copy(user), copy.copy(token), version, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                stats.incr('evictions')
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def discard_user(self, user_id):
+        with self._lock:
+            for key in [key for key, entry in self._entries.items() if entry[0].pk == user_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TokenCache(
+    max_entries=getattr(settings, 'TOKEN_AUTH_CACHE_MAX_ENTRIES', 10000),
+    ttl=getattr(settings, 'TOKEN_AUTH_CACHE_TTL', 300),
+)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication that remembers token -> user lookups instead of
+    joining authtoken_token to the user table on every request.
+
+    Entries go away when the token is deleted (logout), when the user is
+    saved (deactivation, role change, ...), after TOKEN_AUTH_CACHE_TTL
+    seconds, or when the cache is full.
+    """
+
+    def authenticate_credentials(self, key):
+        cached = token_cache.get(key)
+        if cached is not None:
+            stats.incr('hits')
+            return cached
+
+        stats.incr('misses')
+        user, token = super().authenticate_credentials(key)
+        token_cache.set(key, user, token)
+        return user, token
+
+
+async def aauthenticate(request):
+    """
+    CachedTokenAuthentication for async views: the user of the request's
+    `Authorization: Token <key>` header, or None when there is no header or
+    the token is unknown or its user inactive.
+    """
+    from rest_framework.authtoken.models import Token
+
+    auth = request.headers.get('Authorization', '').split()
+    if len(auth) != 2 or auth[0].lower() != CachedTokenAuthentication.keyword.lower():
+        return None
+    key = auth[1]
+
+    cached = token_cache.get(key)
+    if cached is not None:
+        stats.incr('hits')
+        return cached[0]
+
+    stats.incr('misses')
+    try:
+        token = await Token.objects.select_related('user').aget(key=key)
+    except Token.DoesNotExist:
+        return None
+    if not token.user.is_active:
+        return None
+    token_cache.set(key, token.user, token)
+    return token.user
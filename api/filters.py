@@ -0,0 +1,115 @@
+import json
+
+import django_filters
+from django.db.models import Exists, IntegerField, OuterRef
+from django.db.models.expressions import RawSQL
+from rest_framework.filters import SearchFilter
+
+from api.models import Order, Product, ProductListing
+from api.utils import category_tree, search, tags
+
+
+class ProductFilter(django_filters.FilterSet):
+    """
+    `?category=<id>` and `?category_slug=` match products anywhere under that
+    category, through the category closure table in a single query.
+    `?tags=a,b` matches products with any of those tags, through the indexed
+    tag link table.
+    """
+    category = django_filters.UUIDFilter(method='filter_subtree')
+    category_slug = django_filters.CharFilter(method='filter_subtree_by_slug')
+    tags = django_filters.CharFilter(method='filter_tags')
+
+    common_tag_threshold = 1000
+
+    class Meta:
+        model = Product
+        fields = ['name', 'category__name']
+
+    def filter_subtree(self, queryset, name, value):
+        return queryset.filter(category__in=category_tree.subtree_ids(value))
+
+    def filter_subtree_by_slug(self, queryset, name, value):
+        return queryset.filter(category__ancestor_links__ancestor__slug=value)
+
+    def filter_tags(self, queryset, name, value):
+        # Subqueries rather than a join, so products with several of the
+        # tags aren't repeated. Collecting every tagged product and sorting
+        # them is cheap for a rare tag; for a common one it's much cheaper to
+        # walk the page ordering's index and probe each product's tags.
+        links = Product.tags.through.objects.filter(tag__name__in=tags.parse(value))
+        if links.count() > self.common_tag_threshold:
+            return queryset.filter(Exists(links.filter(product=OuterRef('pk'))))
+        return queryset.filter(pk__in=links.values('product_id'))
+
+
+class ProductListingFilter(django_filters.FilterSet):
+    category = django_filters.UUIDFilter(method='filter_subtree')
+    category_slug = django_filters.CharFilter(method='filter_subtree_by_slug')
+    price_min = django_filters.NumberFilter(field_name='min_price', lookup_expr='gte')
+    price_max = django_filters.NumberFilter(field_name='min_price', lookup_expr='lte')
+
+    class Meta:
+        model = ProductListing
+        fields = ['in_stock', 'brand']
+
+    def filter_subtree(self, queryset, name, value):
+        return queryset.filter(category__in=category_tree.subtree_ids(value))
+
+    def filter_subtree_by_slug(self, queryset, name, value):
+        return queryset.filter(category__ancestor_links__ancestor__slug=value)
+
+
+class OrderExportFilter(django_filters.FilterSet):
+    """
+    `?created_after=` (inclusive) and `?created_before=` (exclusive) take a
+    date or a datetime; repeat `?status=` to match any of several.
+    """
+    created_after = django_filters.DateTimeFilter(field_name='created_at', lookup_expr='gte')
+    created_before = django_filters.DateTimeFilter(field_name='created_at', lookup_expr='lt')
+    status = django_filters.MultipleChoiceFilter(choices=Order.ORDER_STATUS)
+
+    class Meta:
+        model = Order
+        fields = []
+
+
+class FullTextSearchFilter(SearchFilter):
+    """
+    `?search=` over the product FTS5 index, ranked by relevance. Falls back
+    to the regular `search_fields` lookup where FTS5 isn't available.
+
+    Matches are annotated with their rank (lower is better) so the paginator
+    can page through them in relevance order.
+    """
+
+    def filter_queryset(self, request, queryset, view):
+        if not search.is_available():
+            return super().filter_queryset(request, queryset, view)
+
+        term = ' '.join(self.get_search_terms(request))
+        if not search.build_match_query(term):
+            return queryset
+
+        # Every match is returned; only the best SEARCH_RANK_LIMIT are
+        # ranked, and the rest follow them, in primary key order.
+        product_ids = search.search_product_ids(term)
+        # Ids are fixed-width hex, so an id's offset in the ranked list is its
+        # rank. One parameter is far cheaper to build than a CASE per match,
+        # and the lookup in it only runs for the ranked few: scanning it for
+        # every match costs more than the search itself for short prefixes.
+        ranked = ','.join(product_ids)
+        column = f'"{queryset.model._meta.db_table}"."id"'
+        ranking = RawSQL(
+            f'CASE WHEN {column} IN (SELECT value FROM json_each(%s)) THEN instr(%s, {column}) ELSE %s END',
+            [json.dumps(product_ids), ranked, len(ranked) + 1],
+            output_field=IntegerField(),
+        )
+        # The ranked matches alone, for KeysetCursorPagination to read the
+        # first pages from without going through every match.
+        view.search_ranked_queryset = queryset.filter(pk__in=product_ids).annotate(
+            **{search.RANK_ANNOTATION: ranking}
+        )
+        return queryset.filter(pk__in=RawSQL(*search.matches_sql(search.build_match_query(term)))).annotate(
+            **{search.RANK_ANNOTATION: ranking}
+        )
@@ -0,0 +1,48 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.core.management.base import BaseCommand
+
+from api.models import Category, ProductImage
+from api.utils import image_derivatives
+
+
+def _generate(name, force):
+    return image_derivatives.generate(name, force)
+
+
+class Command(BaseCommand):
+    help = 'Generate resized copies of every product and category image that lacks them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--force', action='store_true', help='Regenerate, overwriting derivatives that exist.')
+
+    def handle(self, *args, **options):
+        jobs = []
+        for model in (ProductImage, Category):
+            for pk, image, derivatives in model.objects.exclude(image='').exclude(image__isnull=True).values_list(
+                'pk', 'image', 'image_derivatives'
+            ).iterator():
+                if options['force'] or (derivatives or {}).get('source') != image:
+                    jobs.append((model, pk, image))
+
+        self.stdout.write(f'{len(jobs)} images to process on {options["workers"]} workers.')
+        done = failed = 0
+        # Resizing is CPU-bound, so it runs in separate processes; the rows
+        # are updated here, on this process's connection.
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup) as pool:
+            futures = {pool.submit(_generate, image, options['force']): (model, pk, image) for model, pk, image in jobs}
+            for future in as_completed(futures):
+                model, pk, image = futures[future]
+                try:
+                    image_derivatives.store(model, pk, future.result())
+                    done += 1
+                except Exception as exc:
+                    failed += 1
+                    self.stderr.write(f'{model.__name__} {pk} ({image}): {exc}')
+                if (done + failed) % 100 == 0:
+                    self.stdout.write(f'{done + failed}/{len(jobs)}')
+
+        self.stdout.write(self.style.SUCCESS(f'Processed {done} images, {failed} failed.'))
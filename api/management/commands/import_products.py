@@ -0,0 +1,50 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.utils import product_import
+
+
+class Command(BaseCommand):
+    help = 'Create or update products and their variants from a CSV or JSONL file.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='File to import, or - for standard input.')
+        parser.add_argument('--format', choices=product_import.FORMATS, help='Defaults to the file extension.')
+        parser.add_argument('--batch-size', type=int, default=product_import.BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        fmt = options['format'] or (None if path == '-' else product_import.format_for(path))
+        if fmt is None:
+            raise CommandError('Give --format; it cannot be told from the file name.')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive.')
+
+        reported = 0
+
+        def progress(report):
+            nonlocal reported
+            for error in report.errors[reported:]:
+                self.stderr.write(f'line {error["line"]}: {error["error"]}')
+            reported = len(report.errors)
+            self.stdout.write(f'{report.rows} rows, {report.products} products, {report.failed} failed')
+
+        # utf-8-sig drops the byte order mark spreadsheet exports start with.
+        if path == '-':
+            sys.stdin.reconfigure(encoding='utf-8-sig', newline='')
+            report = product_import.import_products(sys.stdin, fmt, options['batch_size'], progress)
+        else:
+            try:
+                stream = open(path, encoding='utf-8-sig', newline='')
+            except OSError as exc:
+                raise CommandError(exc)
+            with stream:
+                report = product_import.import_products(stream, fmt, options['batch_size'], progress)
+
+        if report.failed > len(report.errors):
+            self.stderr.write(f'... and {report.failed - len(report.errors)} more errors.')
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {report.products} products and {report.variants} variants from {report.rows} rows, '
+            f'{report.failed} failed.'
+        ))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from api.utils import idempotency
+
+
+class Command(BaseCommand):
+    help = 'Delete Idempotency-Key records older than IDEMPOTENCY_KEY_TTL (a day by default).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, help='Age in seconds, instead of the TTL.')
+
+    def handle(self, *args, **options):
+        count = idempotency.purge(options['older_than'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {count} keys.'))
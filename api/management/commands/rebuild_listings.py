@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from api.utils import listings
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized product listings from the catalog.'
+
+    def handle(self, *args, **options):
+        count = listings.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Wrote {count} listings.'))
@@ -0,0 +1,59 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from api.models import Order
+from api.utils import sales_rollups
+
+
+class Command(BaseCommand):
+    help = 'Recompute the daily sales rollups of a range of days (all of them by default) from the orders.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--start', type=date.fromisoformat, help='First day, YYYY-MM-DD.')
+        parser.add_argument('--end', type=date.fromisoformat, help='Last day, YYYY-MM-DD.')
+        parser.add_argument('--days', type=int, default=7, help='Days per partition.')
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+
+    def handle(self, *args, **options):
+        if options['days'] < 1 or options['workers'] < 1:
+            raise CommandError('--days and --workers must be positive.')
+        bounds = Order.objects.aggregate(first=Min('created_at'), last=Max('created_at'))
+        if bounds['first'] is None and not (options['start'] and options['end']):
+            self.stdout.write('No orders.')
+            return
+        start = options['start'] or timezone.localdate(bounds['first'])
+        end = options['end'] or timezone.localdate(bounds['last'])
+        if start > end:
+            raise CommandError('--start is after --end.')
+
+        parts = list(sales_rollups.partitions(start, end, options['days']))
+        self.stdout.write(f'{start} to {end}: {len(parts)} partitions on {options["workers"]} workers.')
+        written = [0, 0]
+
+        def write(part, rows):
+            counts = sales_rollups.write_partition(*part, rows)
+            written[0] += counts[0]
+            written[1] += counts[1]
+            self.stdout.write(f'{part[0]} to {part[1]}: {counts[0]} day rows, {counts[1]} variant rows')
+
+        if options['workers'] == 1:
+            for part in parts:
+                write(part, sales_rollups.build_partition(*part))
+        else:
+            # Partitions are read and summed in separate processes; the rows
+            # are written here, one partition per transaction. Forked workers
+            # mustn't inherit this process's open connections.
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options['workers'], initializer=django.setup) as pool:
+                futures = {pool.submit(sales_rollups.build_partition, *part): part for part in parts}
+                for future in as_completed(futures):
+                    write(futures[future], future.result())
+
+        self.stdout.write(self.style.SUCCESS(f'Wrote {written[0]} day rows and {written[1]} variant rows.'))
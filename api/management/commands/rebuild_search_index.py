@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from api.utils import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the product full-text search index from scratch.'
+
+    def handle(self, *args, **options):
+        if not search.is_available():
+            self.stderr.write('Full-text search needs the SQLite backend; nothing to rebuild.')
+            return
+        count = search.rebuild_index()
+        self.stdout.write(self.style.SUCCESS(f'Indexed {count} products.'))
@@ -0,0 +1,53 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from api.utils import profiling
+
+
+class Command(BaseCommand):
+    help = (
+        'Print per-view request latency, SQL query and response size statistics published by the workers. '
+        'Workers only see each other through a shared cache backend.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--json', action='store_true', help='Dump the raw summaries as JSON.')
+        parser.add_argument('--slowest', action='store_true', help='Also print the slowest requests and their SQL.')
+        parser.add_argument('--reset', action='store_true', help='Clear the statistics of every worker.')
+
+    def handle(self, *args, **options):
+        if options['reset']:
+            profiling.reset()
+            self.stdout.write(self.style.SUCCESS('Request statistics cleared.'))
+            return
+
+        data = profiling.collect()
+        if options['json']:
+            self.stdout.write(json.dumps(data, indent=2))
+            return
+
+        if not data['views']:
+            self.stdout.write('No requests recorded.')
+            return
+
+        self.stdout.write(
+            f'{"view":<45} {"requests":>8} {"p50 ms":>9} {"p99 ms":>9} {"max ms":>9} '
+            f'{"queries p50":>11} {"p99":>5} {"sql p99 ms":>10} {"bytes p50":>10}'
+        )
+        for view, summary in data['views'].items():
+            self.stdout.write(
+                f'{view:<45} {summary["requests"]:>8} {summary["latency_ms"]["p50"]:>9.1f} '
+                f'{summary["latency_ms"]["p99"]:>9.1f} {summary["latency_ms"]["max"]:>9.1f} '
+                f'{summary["queries"]["p50"]:>11.0f} {summary["queries"]["p99"]:>5.0f} '
+                f'{summary["sql_ms"]["p99"]:>10.1f} {summary["response_bytes"]["p50"]:>10.0f}'
+            )
+
+        if options['slowest']:
+            for entry in data['slowest']:
+                self.stdout.write(
+                    f'\n{entry["view"]} {entry["path"]} -> {entry["status"]}: {entry["latency_ms"]:.1f} ms, '
+                    f'{entry["queries"]} queries ({entry["sql_ms"]:.1f} ms SQL)'
+                )
+                for statement in entry['sql']:
+                    self.stdout.write(f'  {statement["ms"]:7.2f} ms  {statement["sql"]}')
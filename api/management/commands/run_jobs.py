@@ -0,0 +1,70 @@
+import os
+import signal
+import socket
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections
+
+from api.utils import jobs
+
+
+PURGE_INTERVAL = 60 * 60
+
+
+class Command(BaseCommand):
+    help = 'Run background jobs (api/utils/jobs.py) until stopped, on up to --concurrency threads.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=4, help='Jobs run at once by this worker.')
+        parser.add_argument('--poll', type=float, default=1.0, help='Seconds between looks at an empty queue.')
+        parser.add_argument('--burst', action='store_true', help='Exit once no jobs are due.')
+
+    def handle(self, *args, **options):
+        if options['concurrency'] < 1 or options['poll'] <= 0:
+            raise CommandError('--concurrency and --poll must be positive.')
+        concurrency = options['concurrency']
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+        stopping = threading.Event()
+        if threading.current_thread() is threading.main_thread():
+            # Finish the jobs in hand, then exit.
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                signal.signal(signum, lambda *args: stopping.set())
+
+        def run(job):
+            try:
+                return jobs.execute(job)
+            finally:
+                close_old_connections()
+
+        self.stdout.write(f'Worker {worker} running {len(jobs.get_tasks())} tasks, {concurrency} at a time.')
+        ran = succeeded = 0
+        next_purge = next_requeue = time.monotonic()
+        running = set()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            while not stopping.is_set():
+                if time.monotonic() >= next_purge:
+                    jobs.purge()
+                    next_purge = time.monotonic() + PURGE_INTERVAL
+                if time.monotonic() >= next_requeue:
+                    jobs.requeue_expired()
+                    next_requeue = time.monotonic() + options['poll']
+
+                if len(running) < concurrency:
+                    running.update(pool.submit(run, job) for job in jobs.claim(worker, concurrency - len(running)))
+                if not running:
+                    if options['burst']:
+                        break
+                    stopping.wait(options['poll'])
+                    continue
+                finished, running = wait(running, timeout=options['poll'], return_when=FIRST_COMPLETED)
+                ran += len(finished)
+                succeeded += sum(future.result() for future in finished)
+
+            finished, _ = wait(running)
+            ran += len(finished)
+            succeeded += sum(future.result() for future in finished)
+        close_old_connections()
+        self.stdout.write(self.style.SUCCESS(f'Ran {ran} jobs, {succeeded} done.'))
@@ -0,0 +1,112 @@
+import time
+from contextlib import ExitStack
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from api.utils import profiling
+
+
+class QueryRecorder:
+    """
+    Execute wrapper counting the queries of one request and the time spent
+    in them. Statements are only kept when slow requests are being logged.
+    """
+
+    def __init__(self, capture):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = [] if capture else None
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            self.seconds += elapsed
+            if self.statements is not None and len(self.statements) < profiling.MAX_CAPTURED_QUERIES:
+                self.statements.append((elapsed, sql))
+
+
+class RequestProfilingMiddleware:
+    """
+    Records latency, SQL query count, SQL time and response size of every
+    request under its resolved view name; see api/utils/profiling.py.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not getattr(settings, 'REQUEST_PROFILING_ENABLED', True):
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        threshold = profiling.get_slow_threshold()
+        recorder = QueryRecorder(capture=threshold is not None)
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            _watch(stack, recorder)
+            response = self.get_response(request)
+        self.record(request, response, recorder, started, threshold)
+        return response
+
+    async def __acall__(self, request):
+        threshold = profiling.get_slow_threshold()
+        recorder = QueryRecorder(capture=threshold is not None)
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            # Under ASGI the queries of a request (async ORM calls and sync
+            # views alike) run on its thread-sensitive executor thread, whose
+            # connections are the ones to watch.
+            await sync_to_async(_watch)(stack, recorder)
+            try:
+                response = await self.get_response(request)
+            finally:
+                await sync_to_async(stack.close)()
+        self.record(request, response, recorder, started, threshold)
+        return response
+
+    def record(self, request, response, recorder, started, threshold):
+        latency_ms = (time.perf_counter() - started) * 1000
+
+        match = request.resolver_match
+        view = f'{request.method} {match.view_name if match else "<unresolved>"}'
+        size = None if response.streaming else len(response.content)
+        profiling.profile.record(view, latency_ms, recorder.count, recorder.seconds * 1000, size)
+
+        if threshold is not None and latency_ms >= threshold:
+            entry = {
+                'view': view,
+                'path': request.get_full_path(),
+                'status': response.status_code,
+                'latency_ms': latency_ms,
+                'queries': recorder.count,
+                'sql_ms': recorder.seconds * 1000,
+                'sql': [
+                    {'ms': elapsed * 1000, 'sql': sql[:profiling.MAX_SQL_LENGTH]}
+                    for elapsed, sql in recorder.statements
+                ],
+            }
+            profiling.profile.record_slow(entry)
+            profiling.logger.warning(
+                'Slow request %s %s: %.1f ms, %d queries (%.1f ms SQL)',
+                request.method, entry['path'], latency_ms, recorder.count, entry['sql_ms'],
+                extra={'profile': entry},
+            )
+
+        profiling.publish()
+
+
+def _watch(stack, recorder):
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(recorder))
@@ -0,0 +1,53 @@
+# Generated by Django 5.1.7 on 2026-10-18 03:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def create_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    Product = apps.get_model('api', 'Product')
+    ProductSearchDocument = apps.get_model('api', 'ProductSearchDocument')
+
+    schema_editor.execute(
+        "CREATE VIRTUAL TABLE api_product_fts USING fts5("
+        "name, description, brand, tags, category, "
+        "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+    )
+    # Matches on the name count for the most, the description for the least.
+    schema_editor.execute(
+        "INSERT INTO api_product_fts (api_product_fts, rank) VALUES ('rank', 'bm25(10.0, 1.0, 3.0, 2.0, 4.0)')"
+    )
+
+    products = Product.objects.values_list('id', 'name', 'description', 'brand', 'tags', 'category__name')
+    for product_id, *columns in products.iterator():
+        document = ProductSearchDocument.objects.create(product_id=product_id)
+        schema_editor.execute(
+            "INSERT INTO api_product_fts (rowid, name, description, brand, tags, category) "
+            "VALUES (%s, %s, %s, %s, %s, %s)",
+            [document.id, *columns],
+        )
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS api_product_fts")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_keyset_pagination_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSearchDocument',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='search_document', to='api.product')),
+            ],
+        ),
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.7 on 2026-10-18 03:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_product_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customuser',
+            name='is_available',
+            field=models.BooleanField(default=True),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 5.1.7 on 2026-10-18 03:51
+
+from collections import defaultdict
+from decimal import Decimal, ROUND_HALF_UP
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def populate_listings(apps, schema_editor):
+    # A frozen copy of api/utils/listings.build(); later runs use
+    # `manage.py rebuild_listings`.
+    Product = apps.get_model('api', 'Product')
+    ProductImage = apps.get_model('api', 'ProductImage')
+    ProductListing = apps.get_model('api', 'ProductListing')
+    ProductVariant = apps.get_model('api', 'ProductVariant')
+
+    variants = defaultdict(list)
+    for product_id, price, discount_percent, stock in ProductVariant.objects.values_list(
+        'product_id', 'price', 'discount_percent', 'stock'
+    ):
+        discounted = (price * (Decimal('1.0') - Decimal(discount_percent) / Decimal('100'))).quantize(
+            Decimal('1.'), rounding=ROUND_HALF_UP
+        )
+        variants[product_id].append((discounted, discount_percent, stock))
+    images = dict(ProductImage.objects.order_by('is_primary', '-id').values_list('product_id', 'image'))
+
+    listings = []
+    for product in Product.objects.filter(is_active=True).values(
+        'id', 'name', 'slug', 'brand', 'category_id', 'category__slug', 'created_at'
+    ):
+        rows = variants.get(product['id'], [])
+        prices = [price for price, _, _ in rows]
+        total_stock = sum(stock for _, _, stock in rows)
+        listings.append(ProductListing(
+            product_id=product['id'], name=product['name'], slug=product['slug'], brand=product['brand'],
+            category_id=product['category_id'], category_slug=product['category__slug'],
+            min_price=min(prices, default=None), max_price=max(prices, default=None),
+            max_discount_percent=max((discount for _, discount, _ in rows), default=0),
+            total_stock=total_stock, in_stock=total_stock > 0,
+            primary_image=images.get(product['id'], ''), created_at=product['created_at'],
+        ))
+    ProductListing.objects.bulk_create(listings, batch_size=2000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_category_closure'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductListing',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='listing', serialize=False, to='api.product')),
+                ('name', models.CharField(max_length=255)),
+                ('slug', models.SlugField()),
+                ('brand', models.CharField(blank=True, max_length=100)),
+                ('category_slug', models.SlugField()),
+                ('min_price', models.DecimalField(decimal_places=2, max_digits=10, null=True)),
+                ('max_price', models.DecimalField(decimal_places=2, max_digits=10, null=True)),
+                ('max_discount_percent', models.PositiveIntegerField(default=0)),
+                ('total_stock', models.PositiveIntegerField(default=0)),
+                ('in_stock', models.BooleanField(default=False)),
+                ('primary_image', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField()),
+                ('category', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='listings', to='api.category')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at', 'product'], name='api_product_created_0be634_idx'), models.Index(fields=['min_price', 'product'], name='api_product_min_pri_051ecc_idx'), models.Index(fields=['in_stock', 'min_price'], name='api_product_in_stoc_94f065_idx'), models.Index(fields=['category', 'created_at'], name='api_product_categor_3c9dab_idx')],
+            },
+        ),
+        migrations.RunPython(populate_listings, migrations.RunPython.noop),
+    ]
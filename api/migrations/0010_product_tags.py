@@ -0,0 +1,72 @@
+# Generated by Django 5.1.7 on 2026-10-18 04:40
+
+from django.db import migrations, models
+
+
+BATCH_SIZE = 5000
+
+
+def split_tags(apps, schema_editor):
+    # Normalization matches api/utils/tags.parse().
+    Product = apps.get_model('api', 'Product')
+    Tag = apps.get_model('api', 'Tag')
+    ProductTag = Product.tags.through
+
+    parsed = {}
+    for product_id, text in Product.objects.exclude(tags_text='').values_list('id', 'tags_text').iterator():
+        names = (name.strip().lower()[:100] for name in text.split(','))
+        parsed[product_id] = set(name for name in names if name)
+
+    Tag.objects.bulk_create(
+        [Tag(name=name) for name in set().union(*parsed.values())], batch_size=BATCH_SIZE, ignore_conflicts=True
+    )
+    tag_ids = dict(Tag.objects.values_list('name', 'id'))
+    links = [
+        ProductTag(product_id=product_id, tag_id=tag_ids[name])
+        for product_id, names in parsed.items() for name in names
+    ]
+    ProductTag.objects.bulk_create(links, batch_size=BATCH_SIZE, ignore_conflicts=True)
+
+
+def join_tags(apps, schema_editor):
+    Product = apps.get_model('api', 'Product')
+
+    texts = {}
+    for product_id, name in Product.tags.through.objects.order_by('tag__name').values_list('product_id', 'tag__name'):
+        texts[product_id] = f'{texts[product_id]},{name}' if product_id in texts else name
+    Product.objects.bulk_update(
+        [Product(id=product_id, tags_text=text[:255]) for product_id, text in texts.items()], ['tags_text'],
+        batch_size=BATCH_SIZE,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_product_listing'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Tag',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+            ],
+        ),
+        migrations.RenameField(
+            model_name='product',
+            old_name='tags',
+            new_name='tags_text',
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='tags',
+            field=models.ManyToManyField(blank=True, related_name='products', to='api.tag'),
+        ),
+        migrations.RunPython(split_tags, join_tags),
+        migrations.RemoveField(
+            model_name='product',
+            name='tags_text',
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.1.7 on 2026-10-18 05:02
+
+from django.db import migrations, models
+
+
+BATCH_SIZE = 2000
+
+
+def merge_duplicate_lines(apps, schema_editor):
+    # Fold every repeated (user, variant) line into its oldest row, summing
+    # the quantities, so the unique constraint can be added.
+    Cart = apps.get_model('api', 'Cart')
+
+    lines = {}
+    merged, removed = {}, []
+    for line_id, user_id, product_id, quantity in Cart.objects.order_by('id').values_list(
+        'id', 'user_id', 'product_id', 'quantity'
+    ).iterator():
+        kept = lines.get((user_id, product_id))
+        if kept is None:
+            lines[(user_id, product_id)] = kept = Cart(id=line_id, quantity=quantity)
+        else:
+            kept.quantity += quantity
+            merged[kept.id] = kept
+            removed.append(line_id)
+
+    for start in range(0, len(removed), BATCH_SIZE):
+        Cart.objects.filter(id__in=removed[start:start + BATCH_SIZE]).delete()
+    Cart.objects.bulk_update(list(merged.values()), ['quantity'], batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_product_tags'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_lines, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='cart',
+            constraint=models.UniqueConstraint(fields=('user', 'product'), name='unique_cart_line'),
+        ),
+    ]
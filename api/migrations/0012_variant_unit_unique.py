@@ -0,0 +1,40 @@
+# Generated by Django 5.1.7 on 2026-10-18 07:15
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+BATCH_SIZE = 2000
+
+
+def rename_duplicate_units(apps, schema_editor):
+    # Variants repeating their product's unit keep existing, since carts and
+    # orders point at them; all but the oldest get their id appended to the
+    # unit so the unique constraint can be added.
+    ProductVariant = apps.get_model('api', 'ProductVariant')
+
+    duplicates = (
+        ProductVariant.objects.values('product_id', 'unit').annotate(count=Count('id')).filter(count__gt=1)
+    )
+    renamed = []
+    for group in list(duplicates):
+        variants = ProductVariant.objects.filter(product_id=group['product_id'], unit=group['unit']).order_by('id')
+        for variant in list(variants)[1:]:
+            variant.unit = f'{variant.unit[:50 - len(str(variant.id)) - 3]} ({variant.id})'
+            renamed.append(variant)
+    ProductVariant.objects.bulk_update(renamed, ['unit'], batch_size=BATCH_SIZE)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0011_cart_line_unique'),
+    ]
+
+    operations = [
+        migrations.RunPython(rename_duplicate_units, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='productvariant',
+            constraint=models.UniqueConstraint(fields=('product', 'unit'), name='unique_variant_unit'),
+        ),
+    ]
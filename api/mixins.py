@@ -0,0 +1,115 @@
+from django.core.exceptions import ValidationError
+from rest_framework.response import Response
+
+from api.utils import catalog_cache, conditional
+
+
+class ConditionalGetMixin:
+    """
+    ETag and Last-Modified support built from version stamps (see
+    api/utils/conditional.py). A handler calls `not_modified(names)` before
+    doing any work and returns the 304 it gets back, if any; the validators
+    are then set on whatever response it does return.
+    """
+    conditional_entity = None
+    # Per-user responses: not for shared caches.
+    conditional_private = False
+    _validators = None
+
+    def not_modified(self, names, last_modified=True):
+        """
+        `last_modified=False` leaves out Last-Modified, for responses whose
+        set of rows can change without any of `names` being bumped.
+        """
+        request = self.request
+        variant = f'{request.accepted_renderer.format} {request.build_absolute_uri()}'
+        etag, modified = conditional.validators(names, variant)
+        if not last_modified:
+            modified = None
+        self._validators = (etag, modified)
+        return conditional.evaluate(request, self.conditional_entity, etag, modified)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super().finalize_response(request, response, *args, **kwargs)
+        if self._validators is not None and response.status_code in (200, 304):
+            conditional.set_headers(response, *self._validators, private=self.conditional_private)
+        return response
+
+
+class CatalogCacheMixin(ConditionalGetMixin):
+    """
+    Serves `list` and `retrieve` of a catalog viewset from the versioned
+    catalog cache (see api/utils/catalog_cache.py).
+
+    `cache_entity` names the version stamps the signals bump. With
+    `cache_whole_list` the full list payload is cached under the entity's
+    collection stamp; otherwise only the page of primary keys is read from
+    the database and each row's payload comes from its own cache entry.
+    The same stamps are the responses' validators, so a conditional GET
+    that still matches is answered before any payload is looked up.
+    """
+    cache_entity = None
+    cache_whole_list = False
+
+    @property
+    def conditional_entity(self):
+        return self.cache_entity
+
+    def get_cache_scope(self):
+        # Payloads carry absolute media URLs, so they are only reusable for
+        # requests made against the same host.
+        return self.request.build_absolute_uri('/')
+
+    def serialize_many(self, pks):
+        queryset = self.get_queryset().filter(pk__in=pks)
+        serializer = self.get_serializer(queryset, many=True)
+        return {str(row['id']): dict(row) for row in serializer.data}
+
+    def list(self, request, *args, **kwargs):
+        scope = self.get_cache_scope()
+
+        if self.cache_whole_list:
+            def build():
+                return super(CatalogCacheMixin, self).list(request, *args, **kwargs).data
+
+            not_modified = self.not_modified([f'{self.cache_entity}:*'])
+            if not_modified is not None:
+                return not_modified
+            return Response(catalog_cache.get_collection(self.cache_entity, build, f'{scope}?{request.GET.urlencode()}'))
+
+        # Page over bare rows; the eager-loaded queryset is only needed for
+        # the rows whose payload has to be rebuilt.
+        queryset = self.filter_queryset(self.get_queryset().model._default_manager.all())
+        page = self.paginate_queryset(queryset)
+        rows = page if page is not None else queryset
+        pks = [row.pk for row in rows]
+        # Rows leaving the page bump no stamp, so there is no Last-Modified.
+        not_modified = self.not_modified([f'{self.cache_entity}:{pk}' for pk in pks], last_modified=False)
+        if not_modified is not None:
+            return not_modified
+        data = catalog_cache.get_many(self.cache_entity, pks, self.serialize_many, scope)
+        if page is not None:
+            return self.get_paginated_response(data)
+        return Response(data)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup = self.kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        if request.GET or self.lookup_field != 'pk':
+            return super().retrieve(request, *args, **kwargs)
+        try:
+            pk = str(self.get_queryset().model._meta.pk.to_python(lookup))
+        except ValidationError:
+            return super().retrieve(request, *args, **kwargs)
+
+        not_modified = self.not_modified([f'{self.cache_entity}:{pk}'])
+        if not_modified is not None:
+            return not_modified
+
+        def build():
+            payloads = self.serialize_many([pk])
+            return payloads.get(pk)
+
+        data = catalog_cache.get_one(self.cache_entity, pk, build, self.get_cache_scope())
+        if data is None:
+            return super().retrieve(request, *args, **kwargs)
+        return Response(data)
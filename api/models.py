@@ -1,11 +1,13 @@
-from decimal import Decimal, ROUND_HALF_UP
 import uuid
 from django.contrib.auth.models import AbstractUser
-from django.db import models
+from django.db import models, transaction
 from django.forms import ValidationError
+from django.utils import timezone
 from django.utils.text import slugify
 from backend import settings
 
+from api.utils import category_tree, order_calculator
+
 
 class CustomUser(AbstractUser):
     USER_ROLES = [
@@ -18,6 +20,8 @@ class CustomUser(AbstractUser):
     full_name = models.CharField(max_length=100)
     email = models.EmailField(blank=True, null=True, default=None)
     user_role = models.CharField(max_length=20, choices=USER_ROLES, default='Customer')
+    # Delivery persons only: whether new deliveries may be assigned to them.
+    is_available = models.BooleanField(default=True)
     USERNAME_FIELD = 'username'
     REQUIRED_FIELDS = ['full_name']
     class Meta:
@@ -56,17 +60,51 @@ class Category(models.Model):
     parent = models.ForeignKey('self', null=True, blank=True, on_delete=models.CASCADE, related_name='subcategories')
     description = models.TextField(blank=True)
     image = models.ImageField(upload_to='category_images/', blank=True, null=True)
+    # Resized copies of `image`; see api/utils/image_derivatives.py.
+    image_derivatives = models.JSONField(default=dict, blank=True, editable=False)
     is_active = models.BooleanField(default=True)
 
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.name)
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            if self._state.adding:
+                super().save(*args, **kwargs)
+                category_tree.insert_node(self)
+                return
+            previous = Category.objects.filter(pk=self.pk).values_list('parent_id', flat=True).first()
+            super().save(*args, **kwargs)
+            if previous != self.parent_id:
+                category_tree.relink(self.pk, self.parent_id)
 
     def __str__(self):
         return self.name
 
 
+class CategoryClosure(models.Model):
+    # One row per (ancestor, descendant) pair, including each category paired
+    # with itself at depth 0; kept up to date by Category.save() and
+    # api/utils/category_tree.py.
+    ancestor = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='descendant_links')
+    descendant = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='ancestor_links')
+    depth = models.PositiveIntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['ancestor', 'descendant'], name='unique_category_closure'),
+        ]
+
+    def __str__(self):
+        return f"{self.ancestor_id} > {self.descendant_id} ({self.depth})"
+
+
+
+class Tag(models.Model):
+    # Lower-cased and trimmed; see api/utils/tags.py.
+    name = models.CharField(max_length=100, unique=True)
+
+    def __str__(self):
+        return self.name
 
 class Product(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
@@ -75,10 +113,17 @@ class Product(models.Model):
     description = models.TextField()
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='products')
     brand = models.CharField(max_length=100, blank=True)
-    tags = models.CharField(max_length=255, blank=True)
+    tags = models.ManyToManyField(Tag, related_name='products', blank=True)
     is_active = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # Keyset pagination walks these in order; see api/pagination.py.
+        indexes = [
+            models.Index(fields=['created_at', 'id']),
+            models.Index(fields=['name', 'id']),
+        ]
+
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.name)
@@ -87,6 +132,43 @@ class Product(models.Model):
     def __str__(self):
         return self.name
 
+class ProductSearchDocument(models.Model):
+    # FTS5 rows are addressed by integer rowid, and Product's primary key is a
+    # UUID; this row's id is the rowid of the product in api_product_fts.
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, related_name='search_document')
+
+    def __str__(self):
+        return f"Search document for {self.product_id}"
+
+class ProductListing(models.Model):
+    # Read model for catalog grids: one row per active product with its
+    # variants and primary image folded in. Maintained by
+    # api/utils/listings.py; never edit directly.
+    product = models.OneToOneField(Product, on_delete=models.CASCADE, primary_key=True, related_name='listing')
+    name = models.CharField(max_length=255)
+    slug = models.SlugField()
+    brand = models.CharField(max_length=100, blank=True)
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='listings')
+    category_slug = models.SlugField()
+    min_price = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+    max_price = models.DecimalField(max_digits=10, decimal_places=2, null=True)
+    max_discount_percent = models.PositiveIntegerField(default=0)
+    total_stock = models.PositiveIntegerField(default=0)
+    in_stock = models.BooleanField(default=False)
+    primary_image = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'product']),
+            models.Index(fields=['min_price', 'product']),
+            models.Index(fields=['in_stock', 'min_price']),
+            models.Index(fields=['category', 'created_at']),
+        ]
+
+    def __str__(self):
+        return f"Listing of {self.name}"
+
 class ProductVariant(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='variants')
     unit = models.CharField(max_length=50)  
@@ -94,9 +176,15 @@ class ProductVariant(models.Model):
     stock = models.PositiveIntegerField(default=0)
     discount_percent = models.PositiveIntegerField(default=0)
 
+    class Meta:
+        # A product's variants are told apart by unit, which is what the
+        # bulk import (api/utils/product_import.py) upserts on.
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'unit'], name='unique_variant_unit'),
+        ]
+
     def discounted_price(self):
-        result = self.price * (Decimal('1.0') - Decimal(self.discount_percent) / Decimal('100'))
-        return result.quantize(Decimal('1.'), rounding=ROUND_HALF_UP)
+        return order_calculator.discounted_price(self.price, self.discount_percent)
 
     def __str__(self):
         return f"{self.product.name} - {self.unit}"
@@ -105,6 +193,7 @@ class ProductVariant(models.Model):
 class ProductImage(models.Model):
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='images')
     image = models.ImageField(upload_to='product_images/')
+    image_derivatives = models.JSONField(default=dict, blank=True, editable=False)
     is_primary = models.BooleanField(default=False)
 
     def __str__(self):
@@ -117,6 +206,13 @@ class Cart(models.Model):
     quantity = models.PositiveIntegerField(default=1)
     added_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        # One line per variant; adding more of it raises the quantity. See
+        # api/utils/carts.py.
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'product'], name='unique_cart_line'),
+        ]
+
     def __str__(self):
         return f"{self.quantity} of {self.product}"
 
@@ -141,6 +237,12 @@ class Order(models.Model):
     total_amount = models.DecimalField(max_digits=12, decimal_places=2, default=0.00)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'created_at', 'id']),
+            models.Index(fields=['created_at', 'id']),
+        ]
+
     def __str__(self):
         return f"Order {self.id} by {self.user.username}"
 
@@ -214,6 +316,112 @@ class Payment(models.Model):
         return f"Payment for Order {self.order.id}"
 
 
+class IdempotencyKey(models.Model):
+    # A client's Idempotency-Key for one request and the response it got,
+    # replayed to retries; see api/utils/idempotency.py.
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='idempotency_keys')
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)
+    # None while the request is still running.
+    response_status = models.PositiveSmallIntegerField(null=True)
+    response_body = models.JSONField(null=True)
+    locked_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'key'], name='unique_idempotency_key'),
+        ]
+
+    def __str__(self):
+        return self.key
+
+
+class Job(models.Model):
+    # Background work queued for `manage.py run_jobs`; see api/utils/jobs.py.
+    name = models.CharField(max_length=100)
+    args = models.JSONField(default=list)
+    status = models.CharField(max_length=20, choices=[
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed')
+    ], default='queued')
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=5)
+    # When it's due: on enqueue, or after the backoff of a failed attempt.
+    run_at = models.DateTimeField(default=timezone.now)
+    locked_by = models.CharField(max_length=100, blank=True)
+    # A running job not finished by then is taken to have died with its worker.
+    locked_until = models.DateTimeField(null=True, blank=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Seconds, of the latest attempt: from due to started, and running.
+    wait = models.FloatField(null=True, blank=True)
+    duration = models.FloatField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['status', 'run_at']),
+            models.Index(fields=['status', 'locked_until']),
+            models.Index(fields=['status', 'finished_at']),
+        ]
+
+    def __str__(self):
+        return f"{self.name} {self.args}"
+
+
+class DailySales(models.Model):
+    # Read model for sales dashboards: one row per day and coupon ('' for
+    # none) with the totals of that day's orders, cancelled ones left out.
+    # Maintained by api/utils/sales_rollups.py; never edit directly.
+    date = models.DateField()
+    coupon_code = models.CharField(max_length=50, blank=True)
+    orders = models.IntegerField(default=0)
+    subtotal = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    discount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    tax = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    shipping = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'coupon_code'], name='unique_daily_sales'),
+        ]
+
+    def __str__(self):
+        return f"Sales on {self.date}"
+
+
+class DailyVariantSales(models.Model):
+    # Same, one row per day and variant sold. The product and category are
+    # copied in so dashboards can group by them without joins; an order's
+    # discount and tax are shared out over its items by value.
+    date = models.DateField()
+    variant = models.ForeignKey(ProductVariant, on_delete=models.CASCADE, related_name='daily_sales')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='daily_sales')
+    category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='daily_sales')
+    orders = models.IntegerField(default=0)
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    discount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    tax = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['date', 'variant'], name='unique_daily_variant_sales'),
+        ]
+        indexes = [
+            models.Index(fields=['product', 'date']),
+            models.Index(fields=['category', 'date']),
+        ]
+
+    def __str__(self):
+        return f"Sales of {self.variant_id} on {self.date}"
+
+
 
 class PostalCode(models.Model):
     code = models.CharField(max_length=20, unique=True)
@@ -0,0 +1,148 @@
+import json
+
+from django.db.models import F, Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, _reverse_ordering
+
+from api.utils.search import RANK_ANNOTATION
+
+
+class KeysetCursorPagination(CursorPagination):
+    """
+    Cursor pagination keyed on `created_at` (or the field the client orders
+    by) together with the primary key: the cursor position is the pair, so
+    rows sharing a timestamp or a name keep a stable order across pages
+    however many of them there are. NULL sorts below every value in either
+    direction, whatever the database's default, and is kept as null in the
+    position.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    ordering = '-created_at'
+
+    def get_ordering(self, request, queryset, view):
+        ordering = super().get_ordering(request, queryset, view)
+        # Search results come in relevance order unless the client asked
+        # for a specific one.
+        if RANK_ANNOTATION in queryset.query.annotations and not request.query_params.get('ordering'):
+            ordering = (RANK_ANNOTATION,)
+        if ordering[0].lstrip('-') in self._pk_names(queryset):
+            return ordering[:1]
+        # Only the first field is part of the position, so later ones
+        # would sort rows in an order the cursor can't follow.
+        direction = '-' if ordering[0].startswith('-') else ''
+        return (ordering[0], direction + 'pk')
+
+    def _pk_names(self, queryset):
+        return {'pk', queryset.model._meta.pk.name}
+
+    def _get_position_from_instance(self, instance, ordering):
+        if len(ordering) == 1:
+            return super()._get_position_from_instance(instance, ordering)
+        field = ordering[0].lstrip('-')
+        value = instance[field] if isinstance(instance, dict) else getattr(instance, field)
+        pk = instance['pk'] if isinstance(instance, dict) else instance.pk
+        return json.dumps([None if value is None else str(value), str(pk)])
+
+    @staticmethod
+    def _order_by(ordering):
+        return [
+            F(name[1:]).desc(nulls_last=True) if name.startswith('-') else F(name).asc(nulls_first=True)
+            for name in ordering
+        ]
+
+    def _filter_position(self, queryset, position, reverse):
+        """
+        Rows after `position` in the page direction.
+        """
+        order = self.ordering[0]
+        # (cursor reversed) XOR (ordering descending)
+        lookup = 'lt' if reverse != order.startswith('-') else 'gt'
+        field = order.lstrip('-')
+        if len(self.ordering) == 1:
+            return queryset.filter(**{f'{field}__{lookup}': position})
+        try:
+            value, pk = json.loads(position)
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        nulls = Q(**{f'{field}__isnull': True})
+        if value is None:
+            if lookup == 'gt':
+                return queryset.filter(~nulls | Q(nulls, **{'pk__gt': pk}))
+            return queryset.filter(nulls, pk__lt=pk)
+        after = Q(**{f'{field}__{lookup}': value}) | Q(**{field: value, f'pk__{lookup}': pk})
+        # NULL is below every value, so it's after any value going down.
+        return queryset.filter(after | nulls if lookup == 'lt' else after)
+
+    def _page(self, queryset, offset, reverse, position):
+        # Up to a page and one row past `position`, in page order.
+        ordering = _reverse_ordering(self.ordering) if reverse else self.ordering
+        queryset = queryset.order_by(*self._order_by(ordering))
+        if position is not None:
+            queryset = self._filter_position(queryset, position, reverse)
+        return list(queryset[offset:offset + self.page_size + 1])
+
+    def paginate_queryset(self, queryset, request, view=None):
+        # CursorPagination.paginate_queryset, filtering on the composite
+        # position instead of the first ordering field alone.
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        if not self.page_size:
+            return None
+
+        self.base_url = request.build_absolute_uri()
+        self.ordering = self.get_ordering(request, queryset, view)
+
+        self.cursor = self.decode_cursor(request)
+        if self.cursor is None:
+            (offset, reverse, current_position) = (0, False, None)
+        else:
+            (offset, reverse, current_position) = self.cursor
+
+        results = None
+        ranked = getattr(view, 'search_ranked_queryset', None)
+        if ranked is not None and not reverse and self.ordering[0] == RANK_ANNOTATION:
+            # Search results: the ranked matches come before all the others,
+            # so a page they fill is read from them alone, without sorting
+            # every match.
+            head = self._page(ranked, offset, reverse, current_position)
+            if len(head) > self.page_size:
+                results = head
+        if results is None:
+            results = self._page(queryset, offset, reverse, current_position)
+        self.page = list(results[:self.page_size])
+
+        if len(results) > len(self.page):
+            has_following_position = True
+            following_position = self._get_position_from_instance(results[-1], self.ordering)
+        else:
+            has_following_position = False
+            following_position = None
+
+        if reverse:
+            self.page = list(reversed(self.page))
+            self.has_next = (current_position is not None) or (offset > 0)
+            self.has_previous = has_following_position
+            if self.has_next:
+                self.next_position = current_position
+            if self.has_previous:
+                self.previous_position = following_position
+        else:
+            self.has_next = has_following_position
+            self.has_previous = (current_position is not None) or (offset > 0)
+            if self.has_next:
+                self.next_position = following_position
+            if self.has_previous:
+                self.previous_position = current_position
+
+        if (self.has_previous or self.has_next) and self.template is not None:
+            self.display_page_controls = True
+
+        return self.page
+
+
+class DeliveryCursorPagination(KeysetCursorPagination):
+    # Delivery has no timestamp of its own; its auto-increment id is already
+    # in creation order.
+    ordering = '-id'
@@ -1,9 +1,53 @@
 from rest_framework import serializers
 from django.contrib.auth import get_user_model
-from .models import Category, PostalCode, Product, Cart, Address, Order, OrderItem, Delivery, Payment, ProductImage, ProductVariant
+from django.core.files.storage import default_storage
+from api.utils import tags
+from .models import Category, CategoryClosure, PostalCode, Product, Cart, Address, Order, OrderItem, Delivery, Payment, ProductImage, ProductVariant
 
 User = get_user_model()
 
+
+class EagerLoadingMixin:
+    # Relations this serializer reads from each instance. Nested serializers
+    # declare their own, and setup_eager_loading() folds them in under the
+    # nested field's source so a view only has to ask the top-level class.
+    select_related_fields = ()
+    prefetch_related_fields = ()
+
+    @classmethod
+    def get_related_lookups(cls, prefix=''):
+        select = [prefix + name for name in cls.select_related_fields]
+        prefetch = [prefix + name for name in cls.prefetch_related_fields]
+
+        for name, field in cls._declared_fields.items():
+            many = isinstance(field, serializers.ListSerializer)
+            child = field.child if many else field
+            if not isinstance(child, EagerLoadingMixin):
+                continue
+
+            child_select, child_prefetch = type(child).get_related_lookups(
+                prefix + (field.source or name) + '__'
+            )
+            if many:
+                # Joins below a reverse relation can't be select_related from
+                # the parent, so they ride along with the prefetch instead.
+                prefetch.extend(child_select + child_prefetch)
+            else:
+                select.extend(child_select)
+                prefetch.extend(child_prefetch)
+
+        return select, prefetch
+
+    @classmethod
+    def setup_eager_loading(cls, queryset):
+        select, prefetch = cls.get_related_lookups()
+        if select:
+            queryset = queryset.select_related(*select)
+        if prefetch:
+            queryset = queryset.prefetch_related(*prefetch)
+        return queryset
+
+
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
@@ -29,16 +73,47 @@ class RegisterSerializer(serializers.ModelSerializer):
 
 
 
+class ImageDerivativesField(serializers.ReadOnlyField):
+    """
+    {format: {width: url}} for the resized copies of an image.
+    """
+
+    def to_representation(self, value):
+        request = self.context.get('request')
+        urls = {}
+        for fmt, widths in (value or {}).items():
+            if fmt == 'source':
+                continue
+            urls[fmt] = {}
+            for width, name in widths.items():
+                url = default_storage.url(name)
+                urls[fmt][width] = request.build_absolute_uri(url) if request else url
+        return urls
+
+
 class CategorySerializer(serializers.ModelSerializer):
+    image_derivatives = ImageDerivativesField()
+
     class Meta:
         model = Category
         fields = '__all__'
 
+    def validate_parent(self, parent):
+        # Caught here rather than by category_tree.relink() in save(), which
+        # would surface as a server error.
+        if parent is not None and self.instance is not None and CategoryClosure.objects.filter(
+            ancestor=self.instance, descendant=parent
+        ).exists():
+            raise serializers.ValidationError('A category cannot be moved under itself or one of its subcategories.')
+        return parent
+
+
+class ProductImageSerializer(EagerLoadingMixin, serializers.ModelSerializer):
+    derivatives = ImageDerivativesField(source='image_derivatives')
 
-class ProductImageSerializer(serializers.ModelSerializer):
     class Meta:
         model = ProductImage
-        fields = ['id', 'image', 'is_primary']
+        fields = ['id', 'image', 'is_primary', 'derivatives']
 
 class AddressSerializer(serializers.ModelSerializer):
     class Meta:
@@ -61,16 +136,18 @@ class PostalCodeSerializer(serializers.ModelSerializer):
         fields = ['code']
 
 
-class ProductMiniSerializer(serializers.ModelSerializer):
+class ProductMiniSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     class Meta:
         model = Product
         fields = ['id', 'name', 'slug', 'brand']
 
 
-class ProductVariantSerializer(serializers.ModelSerializer):
+class ProductVariantSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     discounted_price = serializers.SerializerMethodField()
     product = serializers.SerializerMethodField()
 
+    select_related_fields = ('product',)
+
     class Meta:
         model = ProductVariant
         fields = ['id', 'unit', 'price', 'stock', 'discount_percent', 'discounted_price', 'product']
@@ -79,15 +156,32 @@ class ProductVariantSerializer(serializers.ModelSerializer):
         return obj.discounted_price()
 
     def get_product(self, obj):
-        from .serializers import ProductMiniSerializer  # avoid circular imports
         return ProductMiniSerializer(obj.product).data
 
 
   
 
-class ProductSerializer(serializers.ModelSerializer):
+class TagListField(serializers.Field):
+    """
+    A product's tags as the comma-separated string the API has always used.
+    """
+
+    def to_representation(self, value):
+        # Sorted here rather than in SQL so the prefetched tags are used.
+        return tags.as_text(sorted(tag.name for tag in value.all()))
+
+    def to_internal_value(self, data):
+        if not isinstance(data, str):
+            raise serializers.ValidationError('Expected a comma-separated string of tags.')
+        return tags.parse(data)
+
+
+class ProductSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     images = ProductImageSerializer(many=True, read_only=True)
     variants = ProductVariantSerializer(many=True, read_only=True)
+    tags = TagListField(required=False)
+
+    prefetch_related_fields = ('images', 'variants', 'tags')
 
     class Meta:
         model = Product
@@ -97,23 +191,52 @@ class ProductSerializer(serializers.ModelSerializer):
             'category', 'images', 'variants'
         ]
 
+    def create(self, validated_data):
+        names = validated_data.pop('tags', [])
+        product = super().create(validated_data)
+        tags.set_tags(product, names)
+        return product
+
+    def update(self, instance, validated_data):
+        names = validated_data.pop('tags', None)
+        product = super().update(instance, validated_data)
+        if names is not None:
+            tags.set_tags(product, names)
+        return product
+
 
 
 
-class CartSerializer(serializers.ModelSerializer):
+class CartSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     product = ProductVariantSerializer()
+
+    select_related_fields = ('product',)
     class Meta:
         model = Cart
         fields = ['id', 'product', 'quantity']
 
-class OrderItemSerializer(serializers.ModelSerializer):
+class CartLineSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=0)
+
+
+class SetCartSerializer(serializers.Serializer):
+    items = CartLineSerializer(many=True, allow_empty=True)
+    replace = serializers.BooleanField(default=False)
+
+
+class OrderItemSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     product = ProductVariantSerializer()
+
+    select_related_fields = ('product',)
     class Meta:
         model = OrderItem
         fields = ['product', 'quantity', 'price_at_order']
 
-class OrderSerializer(serializers.ModelSerializer):
+class OrderSerializer(EagerLoadingMixin, serializers.ModelSerializer):
     items = OrderItemSerializer(many=True)
+
+    prefetch_related_fields = ('items',)
     class Meta:
         model = Order
         fields = ['id', 'user', 'status', 'items', 'created_at']
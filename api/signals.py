@@ -0,0 +1,212 @@
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from api.authentication import invalidate_user
+from api.utils import (
+    catalog_cache, conditional, coupons, delivery_assignment, facets, image_derivatives, jobs, listings,
+    order_calculator, postal_codes, sales_rollups, search,
+)
+
+from .models import (
+    Address, Cart, Category, Coupon, CustomUser, Delivery, Order, OrderItem, PostalCode, Product, ProductImage,
+    ProductSearchDocument, ProductVariant, Tag,
+)
+
+
+@receiver([post_save, post_delete], sender=Product)
+def invalidate_product(sender, instance, **kwargs):
+    catalog_cache.invalidate('product', instance.pk)
+
+
+@receiver([post_save, post_delete], sender=ProductVariant)
+@receiver([post_save, post_delete], sender=ProductImage)
+def invalidate_parent_product(sender, instance, **kwargs):
+    catalog_cache.invalidate('product', instance.product_id)
+
+
+@receiver([post_save, post_delete], sender=Product)
+@receiver([post_save, post_delete], sender=ProductVariant)
+@receiver([post_save, post_delete], sender=ProductImage)
+def refresh_listing(sender, instance, **kwargs):
+    listings.refresh([instance.pk if sender is Product else instance.product_id])
+
+
+@receiver(post_save, sender=Category)
+def update_listing_category(sender, instance, created, **kwargs):
+    if not created:
+        listings.update_category(instance)
+
+
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_facets(sender, instance, **kwargs):
+    # Category facets count whole subtrees, keyed by slug.
+    facets.invalidate()
+
+
+@receiver([post_save, post_delete], sender=ProductVariant)
+def invalidate_prices(sender, instance, **kwargs):
+    order_calculator.invalidate_prices()
+
+
+@receiver([post_save, post_delete], sender=Coupon)
+def invalidate_coupons(sender, instance, **kwargs):
+    coupons.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Cart)
+def invalidate_cart_pricing(sender, instance, **kwargs):
+    order_calculator.invalidate_cart(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=Category)
+def invalidate_category(sender, instance, **kwargs):
+    catalog_cache.invalidate('category', instance.pk)
+    catalog_cache.invalidate('category')
+
+
+@receiver([post_save, post_delete], sender=Order)
+def invalidate_order_history(sender, instance, **kwargs):
+    conditional.orders_changed(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=OrderItem)
+def invalidate_item_order_history(sender, instance, **kwargs):
+    # Items placed with a new order are bulk-created, and covered by the
+    # order's own save; this catches later edits.
+    user_id = Order.objects.filter(pk=instance.order_id).values_list('user_id', flat=True).first()
+    if user_id is not None:
+        conditional.orders_changed(user_id)
+
+
+@receiver(pre_save, sender=Order)
+def remember_order_status(sender, instance, **kwargs):
+    if not instance._state.adding:
+        instance._stored_status = Order.objects.filter(pk=instance.pk).values_list('status', flat=True).first()
+
+
+def rolled_up(order):
+    # Until its roll_up_order job has run, a new order isn't in the rollups,
+    # and the job will count it or not by the status it finds.
+    return not jobs.pending('roll_up_order', str(order.pk))
+
+
+@receiver(post_save, sender=Order)
+def roll_up_order(sender, instance, created, **kwargs):
+    # Items placed with a new order are bulk-created after it, so it's
+    # rolled up by a job, which only runs once the transaction commits.
+    if created:
+        jobs.enqueue('roll_up_order', str(instance.pk))
+        return
+    stored_status = getattr(instance, '_stored_status', None)
+    was_counted = stored_status is not None and sales_rollups.counts(stored_status)
+    if was_counted != sales_rollups.counts(instance.status) and rolled_up(instance):
+        sales_rollups.apply([instance.pk], -1 if was_counted else 1)
+    instance._stored_status = instance.status
+
+
+@receiver(pre_delete, sender=Order)
+def unroll_order(sender, instance, **kwargs):
+    # Before the items go with it.
+    if sales_rollups.counts(instance.status) and rolled_up(instance):
+        sales_rollups.apply([instance.pk], -1)
+
+
+@receiver(post_save, sender=Product)
+def index_product(sender, instance, **kwargs):
+    search.index_products(Product.objects.filter(pk=instance.pk))
+
+
+def retag_products(product_ids):
+    # Tags aren't part of the listing row, only of the cached payload, the
+    # facet index and the search document.
+    for product_id in product_ids:
+        catalog_cache.invalidate('product', product_id)
+    facets.changed(product_ids)
+    search.index_products(Product.objects.filter(pk__in=product_ids))
+
+
+@receiver(m2m_changed, sender=Product.tags.through)
+def reindex_retagged_products(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear' and reverse:
+        # Once cleared, the tag can't tell which products it was on.
+        instance._cleared_product_ids = list(instance.products.values_list('pk', flat=True))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        if not reverse:
+            retag_products([instance.pk])
+        elif action == 'post_clear':
+            retag_products(instance._cleared_product_ids)
+        else:
+            retag_products(list(pk_set))
+
+
+@receiver(pre_delete, sender=Tag)
+def remember_tagged_products(sender, instance, **kwargs):
+    instance._tagged_product_ids = list(instance.products.values_list('pk', flat=True))
+
+
+@receiver(post_delete, sender=Tag)
+def reindex_untagged_products(sender, instance, **kwargs):
+    retag_products(instance._tagged_product_ids)
+
+
+@receiver(post_save, sender=Tag)
+def reindex_renamed_tag_products(sender, instance, created, **kwargs):
+    if not created:
+        retag_products(list(instance.products.values_list('pk', flat=True)))
+
+
+@receiver(post_save, sender=Category)
+def reindex_category_products(sender, instance, created, **kwargs):
+    if not created:
+        search.index_products(instance.products.all())
+
+
+@receiver(post_delete, sender=ProductSearchDocument)
+def remove_search_document(sender, instance, **kwargs):
+    # Deleting a product cascades to its search document, which still knows
+    # the FTS rowid at this point.
+    search.remove_document(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=PostalCode)
+def invalidate_postal_codes(sender, instance, **kwargs):
+    postal_codes.invalidate()
+
+
+@receiver([post_save, post_delete], sender=CustomUser)
+def invalidate_rider_index(sender, instance, **kwargs):
+    if instance.user_role == 'Delivery_Person' or delivery_assignment.is_indexed(instance.pk):
+        delivery_assignment.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Address)
+def invalidate_rider_position(sender, instance, **kwargs):
+    if CustomUser.objects.filter(pk=instance.user_id, user_role='Delivery_Person').exists():
+        delivery_assignment.invalidate()
+
+
+@receiver([post_save, post_delete], sender=Delivery)
+def recount_rider_load(sender, instance, created=False, **kwargs):
+    # New deliveries are counted by the engine when it hands them out.
+    if instance.delivery_person_id and not created:
+        delivery_assignment.mark_dirty(instance.delivery_person_id)
+
+
+@receiver(post_save, sender=CustomUser)
+def invalidate_cached_auth(sender, instance, created, **kwargs):
+    # Covers deactivation and role changes; both must take effect at once.
+    if not created:
+        invalidate_user(instance.pk)
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_cached_token(sender, instance, **kwargs):
+    invalidate_user(instance.user_id)
+
+
+@receiver(post_save, sender=ProductImage)
+@receiver(post_save, sender=Category)
+def schedule_image_derivatives(sender, instance, **kwargs):
+    if image_derivatives.needs_derivatives(instance.image, instance.image_derivatives):
+        image_derivatives.schedule(sender, instance.pk)
@@ -0,0 +1,44 @@
+from api.utils import delivery_assignment, jobs, sales_rollups
+
+from .models import Address, Delivery, Order
+
+
+class NoRiderFree(Exception):
+    pass
+
+
+# One at a time, so workers seldom wait on each other's locks. Retried
+# (with backoff, for a couple of hours) while every rider is at capacity.
+@jobs.task('assign_delivery', max_attempts=20, concurrency=1)
+def assign_delivery(order_id):
+    delivery = Delivery.objects.filter(
+        order_id=order_id, delivery_person__isnull=True, delivery_status='pending'
+    ).select_related('order').first()
+    if delivery is None:
+        return
+    # The default address, else any; like PlaceOrderAPIView, which
+    # requires one.
+    address = Address.objects.filter(user=delivery.order.user_id).order_by('-is_default').first()
+    if address is None:
+        return
+    full = set()
+    while True:
+        rider_id = delivery_assignment.choose_rider(address.latitude, address.longitude, exclude=full)
+        if rider_id is None:
+            raise NoRiderFree(f'No rider free for order {order_id}')
+        # Nobody else can assign the rider until the job's transaction
+        # commits; see hold_rider().
+        if delivery_assignment.hold_rider(rider_id):
+            Delivery.objects.filter(pk=delivery.pk).update(delivery_person_id=rider_id)
+            return
+        full.add(rider_id)
+
+
+@jobs.task('roll_up_order')
+def roll_up_order(order_id):
+    # The row lock (on SQLite, where select_for_update() does nothing, the
+    # write lock the transaction opened with) holds off a status change until
+    # this commits; the signal handlers leave the rollups alone while this
+    # job is pending.
+    list(Order.objects.select_for_update().filter(pk=order_id).values_list('pk'))
+    sales_rollups.order_placed(order_id)
@@ -1,3 +1,1774 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.db.models import Sum
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import AsyncClient, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+
+from api.models import (
+    Address, Cart, Category, CategoryClosure, Coupon, CustomUser, DailySales, DailyVariantSales, Delivery,
+    IdempotencyKey, Job, Order, OrderItem, Payment, PostalCode, Product, ProductImage, ProductListing, ProductVariant,
+    Tag,
+)
+from api.authentication import token_cache
+from api.utils import (
+    carts, category_tree, conditional, coupons, delivery_assignment, facets, image_derivatives, jobs, listings,
+    order_calculator, product_import, profiling, tags,
+)
+from api.utils.inventory import reserve_stock
+from api.views import OrderViewSet
+
+User = get_user_model()
+
+
+def make_product(category, index):
+    product = Product.objects.create(
+        name=f'Product {index}',
+        description='Fresh produce',
+        category=category,
+        brand='Farm',
+    )
+    ProductImage.objects.create(product=product, image=f'product_images/p{index}.webp', is_primary=True)
+    ProductImage.objects.create(product=product, image=f'product_images/p{index}-alt.webp')
+    ProductVariant.objects.create(product=product, unit='500g', price=Decimal('40.00'), stock=10, discount_percent=10)
+    ProductVariant.objects.create(product=product, unit='1kg', price=Decimal('75.00'), stock=10)
+    return product
+
+
+class ListQueryCountTests(TestCase):
+    """
+    A list endpoint must cost the same number of queries for 2 rows as for 6.
+    """
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(username='shopper', full_name='Shopper', password='secret')
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=self.user).key}')
+        self.category = Category.objects.create(name='Vegetables')
+        self.created = 0
+
+    def add_rows(self, count):
+        for _ in range(count):
+            self.created += 1
+            product = make_product(self.category, self.created)
+            variant = product.variants.first()
+            Cart.objects.create(user=self.user, product=variant, quantity=2)
+            order = Order.objects.create(user=self.user)
+            OrderItem.objects.create(order=order, product=variant, quantity=1, price_at_order=Decimal('36.00'))
+            OrderItem.objects.create(order=order, product=product.variants.last(), quantity=1, price_at_order=Decimal('75.00'))
+
+    def count_queries(self, url):
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def assertConstantQueries(self, url):
+        self.add_rows(2)
+        few = self.count_queries(url)
+        self.add_rows(4)
+        many = self.count_queries(url)
+        self.assertEqual(few, many, f'{url} issued {few} queries for 2 rows but {many} for 6')
+
+    def test_product_list(self):
+        self.assertConstantQueries('/api/products/')
+
+    def test_cart_list(self):
+        self.assertConstantQueries('/api/cart/')
+
+    def test_cart_viewset_list(self):
+        self.assertConstantQueries('/api/carts/')
+
+    def test_order_viewset_list(self):
+        # /api/orders/ resolves to UserOrdersAPIView, so call the viewset directly.
+        view = OrderViewSet.as_view({'get': 'list'})
+
+        def count():
+            cache.clear()
+            request = APIRequestFactory().get('/api/orders/')
+            force_authenticate(request, user=self.user)
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(view(request).status_code, 200)
+            return len(queries)
+
+        self.add_rows(2)
+        few = count()
+        self.add_rows(4)
+        self.assertEqual(few, count())
+
+    def test_user_orders_list(self):
+        self.assertConstantQueries('/api/orders/')
+
+
+class KeysetPaginationTests(TestCase):
+
+    def setUp(self):
+        category = Category.objects.create(name='Fruits')
+        # Duplicate names force the primary-key tie-breaker to do its job.
+        for index in range(7):
+            Product.objects.create(name=f'Apple {index % 3}', slug=f'apple-{index}', description='', category=category)
+        self.client = APIClient()
+
+    def walk(self, url):
+        seen = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen.extend(str(row['id']) for row in response.data['results'])
+            url = response.data['next']
+        return seen
+
+    def test_pages_cover_every_row_once(self):
+        expected = {str(pk) for pk in Product.objects.values_list('pk', flat=True)}
+        for url in ['/api/products/?page_size=2', '/api/products/?page_size=2&ordering=name',
+                    '/api/listings/?page_size=2&ordering=name']:
+            seen = self.walk(url)
+            self.assertEqual(len(seen), len(expected), url)
+            self.assertEqual(set(seen), expected, url)
+
+    def test_long_runs_of_one_value_page_by_primary_key(self):
+        category = Category.objects.get()
+        Product.objects.bulk_create([
+            Product(name='Banana', slug=f'banana-{index}', description='', category=category) for index in range(130)
+        ])
+        expected = set(map(str, Product.objects.filter(name='Banana').values_list('pk', flat=True)))
+        url = '/api/products/?page_size=40&ordering=-name'
+        seen = self.walk(url)
+        self.assertEqual(len(seen), 137)
+        self.assertEqual(set(seen[:130]), expected)
+
+        # And back again from the last page.
+        last = self.client.get(url)
+        while last.data['next']:
+            last = self.client.get(last.data['next'])
+        backwards, url = [], last.data['previous']
+        while url:
+            response = self.client.get(url)
+            backwards[:0] = [row['id'] for row in response.data['results']]
+            url = response.data['previous']
+        self.assertEqual(backwards + [row['id'] for row in last.data['results']], seen)
+
+    def test_pages_cross_null_values(self):
+        user = User.objects.create_user(username='staff', full_name='Staff', password='secret', is_staff=True)
+        self.client.force_authenticate(user)
+        deliveries = [Delivery.objects.create(order=Order.objects.create(user=user)) for _ in range(5)]
+        now = timezone.now()
+        for index in (1, 3):
+            Delivery.objects.filter(pk=deliveries[index].pk).update(
+                delivery_status='delivered', delivered_at=now + timedelta(minutes=index),
+            )
+        expected = {str(delivery.pk) for delivery in deliveries}
+        for ordering in ('delivered_at', '-delivered_at'):
+            url = f'/api/deliveries/?ordering={ordering}&page_size=1'
+            seen = self.walk(url)
+            self.assertEqual(len(seen), 5, ordering)
+            self.assertEqual(set(seen), expected, ordering)
+
+            last = self.client.get(url)
+            while last.data['next']:
+                last = self.client.get(last.data['next'])
+            backwards, url = [str(row['id']) for row in last.data['results']], last.data['previous']
+            while url:
+                response = self.client.get(url)
+                backwards[:0] = [str(row['id']) for row in response.data['results']]
+                url = response.data['previous']
+            self.assertEqual(backwards, seen, ordering)
+
+        self.assertEqual(seen[:2], [str(deliveries[3].pk), str(deliveries[1].pk)])
+
+        # Only the listed fields can key the cursor; others fall back to the default.
+        self.assertEqual(len(self.walk('/api/deliveries/?ordering=delivery_person&page_size=1')), 5)
+
+    def test_page_size_is_capped(self):
+        response = self.client.get('/api/products/?page_size=100000')
+        self.assertEqual(len(response.data['results']), 7)
+        self.assertNotIn('count', response.data)
+
+
+class CatalogCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Greens')
+        self.product = make_product(self.category, 1)
+        self.other = make_product(self.category, 2)
+        self.client = APIClient()
+
+    def test_repeat_reads_skip_the_serializers(self):
+        self.client.get(f'/api/products/{self.product.pk}/')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(f'/api/products/{self.product.pk}/')
+        self.assertEqual(response.data['name'], 'Product 1')
+        self.assertEqual(len(queries), 0)
+
+        self.client.get('/api/products/')
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get('/api/products/')
+        self.assertEqual(len(queries), 1)
+
+    def test_variant_change_invalidates_only_its_product(self):
+        self.client.get('/api/products/')
+        variant = self.product.variants.get(unit='1kg')
+        variant.price = Decimal('90.00')
+        variant.save()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/products/')
+        prices = {row['id']: [v['price'] for v in row['variants']] for row in response.data['results']}
+        self.assertIn('90.00', prices[str(self.product.pk)])
+        # Page query plus one rebuild (product, images, variants, tags) for the edited row.
+        self.assertEqual(len(queries), 5)
+
+    def test_local_stamps_run_out_so_other_workers_catch_up(self):
+        url = f'/api/products/{self.product.pk}/'
+        self.client.get(url)
+        # As if saved through another worker, whose bump this one never sees.
+        Product.objects.filter(pk=self.product.pk).update(name='Renamed')
+        self.assertEqual(self.client.get(url).data['name'], 'Product 1')
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertEqual(self.client.get(url).data['name'], 'Renamed')
+
+    def test_category_list_is_invalidated_on_save(self):
+        self.assertEqual(len(self.client.get('/api/categories/').data), 1)
+        Category.objects.create(name='Herbs')
+        self.assertEqual(len(self.client.get('/api/categories/').data), 2)
+
+    def test_missing_product_is_not_cached(self):
+        response = self.client.get('/api/products/00000000-0000-0000-0000-000000000000/')
+        self.assertEqual(response.status_code, 404)
+
+
+class ProductSearchTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Vegetables')
+        self.tomato = Product.objects.create(name='Hybrid Tomato', description='Juicy', category=self.category)
+        self.puree = Product.objects.create(name='Puree', description='Made from ripe tomatoes', category=self.category)
+        self.onion = Product.objects.create(name='Onion', description='Red', category=self.category, brand='Ooty')
+        self.client = APIClient()
+
+    def search(self, term):
+        response = self.client.get('/api/products/', {'search': term})
+        self.assertEqual(response.status_code, 200)
+        return [row['name'] for row in response.data['results']]
+
+    def test_prefix_match_ranked_by_relevance(self):
+        self.assertEqual(self.search('tom'), ['Hybrid Tomato', 'Puree'])
+
+    def test_matches_brand_and_category(self):
+        self.assertEqual(self.search('ooty'), ['Onion'])
+        self.assertEqual(len(self.search('vegetab')), 3)
+
+    def test_matches_beyond_the_ranked_ones_are_returned(self):
+        with self.settings(SEARCH_RANK_LIMIT=1):
+            self.assertEqual(self.search('tom'), ['Hybrid Tomato', 'Puree'])
+            response = self.client.get('/api/products/', {'search': 'vegetab', 'page_size': 1})
+            names = []
+            while True:
+                names += [row['name'] for row in response.data['results']]
+                if not response.data['next']:
+                    break
+                response = self.client.get(response.data['next'])
+        self.assertEqual(sorted(names), ['Hybrid Tomato', 'Onion', 'Puree'])
+
+    def test_pages_run_from_the_ranked_matches_into_the_rest(self):
+        with self.settings(SEARCH_RANK_LIMIT=2):
+            ranked = self.search('vegetab')[:2]
+            response = self.client.get('/api/products/', {'search': 'vegetab', 'page_size': 1})
+            names = []
+            while True:
+                names += [row['name'] for row in response.data['results']]
+                if not response.data['next']:
+                    break
+                response = self.client.get(response.data['next'])
+        self.assertEqual(names[:2], ranked)
+        self.assertEqual(sorted(names), ['Hybrid Tomato', 'Onion', 'Puree'])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.onion.name = 'Shallot'
+        self.onion.save()
+        self.assertEqual(self.search('shallot'), ['Shallot'])
+        self.assertEqual(self.search('onion'), [])
+
+        self.tomato.delete()
+        self.assertEqual(self.search('tomato'), ['Puree'])
+
+        self.category.name = 'Produce'
+        self.category.save()
+        self.assertEqual(len(self.search('produce')), 2)
+
+    def test_query_syntax_is_not_interpreted(self):
+        self.assertEqual(self.search('tomato OR "onion'), [])
+        self.assertEqual(self.search('***'), ['Hybrid Tomato', 'Puree', 'Onion'][::-1])
+
+
+class PlaceOrderTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Flash sale')
+        self.product = make_product(category, 1)
+        self.variant = self.product.variants.get(unit='500g')
+        self.variant.stock = 3
+        self.variant.save()
+        User.objects.create_user(username='rider', full_name='Rider', password='secret', user_role='Delivery_Person')
+
+    def make_shopper(self, name, lines):
+        user = User.objects.create_user(username=name, full_name=name, password='secret')
+        Address.objects.create(user=user, address_line='1 Main St', city='Mysuru', postal_code='570001')
+        for variant, quantity in lines:
+            Cart.objects.create(user=user, product=variant, quantity=quantity)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=user).key}')
+        return client
+
+    def test_query_count_does_not_grow_with_cart_lines(self):
+        def place(name, variants):
+            client = self.make_shopper(name, [(variant, 1) for variant in variants])
+            delivery_assignment.get_index()
+            with CaptureQueriesContext(connection) as queries:
+                self.assertEqual(client.post('/api/order/place/').status_code, 201)
+            return len(queries)
+
+        variants = [make_product(self.product.category, index).variants.first() for index in range(2, 7)]
+        self.assertEqual(place('one', variants[:1]), place('five', variants))
+        self.assertEqual(OrderItem.objects.count(), 6)
+        self.assertEqual(ProductVariant.objects.get(pk=variants[0].pk).stock, 8)
+
+    def test_short_stock_rolls_back(self):
+        client = self.make_shopper('greedy', [(self.variant, 5)])
+        response = client.post('/api/order/place/')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.data['variants'], [self.variant.pk])
+        self.assertFalse(Order.objects.exists())
+        self.assertEqual(Cart.objects.count(), 1)
+        self.variant.refresh_from_db()
+        self.assertEqual(self.variant.stock, 3)
+
+    def test_parallel_checkouts_never_oversell(self):
+        clients = [self.make_shopper(f'buyer{index}', [(self.variant, 1)]) for index in range(8)]
+        barrier = threading.Barrier(len(clients))
+
+        def checkout(client):
+            barrier.wait()
+            try:
+                return client.post('/api/order/place/').status_code
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=len(clients)) as pool:
+            codes = list(pool.map(checkout, clients))
+
+        self.assertEqual(sorted(codes), [201] * 3 + [409] * 5)
+        self.variant.refresh_from_db()
+        self.assertEqual(self.variant.stock, 0)
+        self.assertEqual(Order.objects.count(), 3)
+        self.assertEqual(OrderItem.objects.aggregate(total=Sum('quantity'))['total'], 3)
+
+    def test_retries_with_a_key_replay_the_first_response(self):
+        client = self.make_shopper('retry', [(self.variant, 1)])
+        first = client.post('/api/order/place/', HTTP_IDEMPOTENCY_KEY='k1')
+        self.assertEqual(first.status_code, 201)
+        Cart.objects.create(user=Order.objects.get().user, product=self.variant, quantity=1)
+
+        with CaptureQueriesContext(connection) as queries:
+            again = client.post('/api/order/place/', HTTP_IDEMPOTENCY_KEY='k1')
+        self.assertEqual((again.status_code, again.data), (201, first.data))
+        self.assertEqual(again['Idempotent-Replayed'], 'true')
+        self.assertEqual(len(queries), 1)
+        self.assertEqual((Order.objects.count(), Payment.objects.count(), Delivery.objects.count()), (1, 1, 1))
+        self.assertEqual(Cart.objects.count(), 1)
+
+        self.assertEqual(client.post('/api/order/place/', {'note': 'x'}, HTTP_IDEMPOTENCY_KEY='k1').status_code, 422)
+        self.assertEqual(client.post('/api/order/place/', HTTP_IDEMPOTENCY_KEY='k2').status_code, 201)
+        self.assertEqual(Order.objects.count(), 2)
+
+    def test_failures_are_not_replayed(self):
+        client = self.make_shopper('empty', [])
+        self.assertEqual(client.post('/api/order/place/', HTTP_IDEMPOTENCY_KEY='k').status_code, 400)
+        Cart.objects.create(user=User.objects.get(username='empty'), product=self.variant, quantity=1)
+        self.assertEqual(client.post('/api/order/place/', HTTP_IDEMPOTENCY_KEY='k').status_code, 201)
+        self.assertEqual(client.post('/api/order/place/', HTTP_IDEMPOTENCY_KEY='').status_code, 400)
+
+    def test_concurrent_duplicates_place_one_order(self):
+        self.make_shopper('racer', [(self.variant, 1)])
+        token = Token.objects.get(user__username='racer').key
+        barrier = threading.Barrier(6)
+
+        def checkout(_):
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+            barrier.wait()
+            try:
+                response = client.post('/api/order/place/', HTTP_IDEMPOTENCY_KEY='same')
+                return response.status_code, response.data.get('order_id')
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            results = list(pool.map(checkout, range(6)))
+
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertEqual(results, [(201, str(Order.objects.get().pk))] * 6)
+        self.variant.refresh_from_db()
+        self.assertEqual(self.variant.stock, 2)
+
+    def test_rider_is_assigned_by_the_job_worker(self):
+        client = self.make_shopper('later', [(self.variant, 1)])
+        self.assertEqual(client.post('/api/order/place/').status_code, 201)
+        delivery = Delivery.objects.get()
+        self.assertIsNone(delivery.delivery_person_id)
+        self.assertEqual(
+            sorted(Job.objects.filter(status='queued').values_list('name', flat=True)),
+            ['assign_delivery', 'roll_up_order'],
+        )
+
+        stdout = io.StringIO()
+        call_command('run_jobs', '--burst', '--concurrency', '2', stdout=stdout)
+        self.assertIn('Ran 2 jobs, 2 done.', stdout.getvalue())
+        delivery.refresh_from_db()
+        self.assertEqual(delivery.delivery_person, User.objects.get(username='rider'))
+        self.assertEqual(DailyVariantSales.objects.get(variant=self.variant).units, 1)
+
+    def test_assignment_is_retried_until_a_rider_is_free(self):
+        User.objects.filter(username='rider').update(is_available=False)
+        delivery_assignment.invalidate()
+        client = self.make_shopper('waiting', [(self.variant, 1)])
+        self.assertEqual(client.post('/api/order/place/').status_code, 201)
+        with self.assertLogs('api.utils.jobs', 'WARNING'):
+            jobs.run_pending()
+        job = Job.objects.get(name='assign_delivery')
+        self.assertEqual((job.status, job.attempts), ('queued', 1))
+        self.assertTrue(job.last_error.startswith('NoRiderFree'))
+        self.assertIsNone(Delivery.objects.get().delivery_person_id)
+
+        User.objects.filter(username='rider').update(is_available=True)
+        delivery_assignment.invalidate()
+        Job.objects.update(run_at=timezone.now())
+        jobs.run_pending()
+        self.assertEqual(Job.objects.get(name='assign_delivery').status, 'done')
+        self.assertEqual(Delivery.objects.get().delivery_person, User.objects.get(username='rider'))
+
+    def test_concurrent_assignments_keep_the_rider_under_capacity(self):
+        rider = User.objects.get(username='rider')
+        customer = User.objects.create_user(username='cust', full_name='Cust', password='secret')
+        first, second = [Delivery.objects.create(order=Order.objects.create(user=customer)) for _ in range(2)]
+        holding, release = threading.Event(), threading.Event()
+        results = {}
+
+        def assign(delivery, wait):
+            try:
+                with transaction.atomic():
+                    results[delivery.pk] = delivery_assignment.hold_rider(rider.pk)
+                    if results[delivery.pk]:
+                        Delivery.objects.filter(pk=delivery.pk).update(delivery_person=rider)
+                    if wait:
+                        holding.set()
+                        release.wait(5)
+            finally:
+                connections.close_all()
+
+        with self.settings(DELIVERY_RIDER_CAPACITY=1):
+            holder = threading.Thread(target=assign, args=(first, True))
+            holder.start()
+            self.assertTrue(holding.wait(5))
+            waiter = threading.Thread(target=assign, args=(second, False))
+            waiter.start()
+            # The second assignment waits for the first to commit...
+            waiter.join(0.5)
+            self.assertTrue(waiter.is_alive())
+            release.set()
+            holder.join()
+            waiter.join()
+        # ...and then counts its delivery.
+        self.assertEqual(results, {first.pk: True, second.pk: False})
+        self.assertEqual(Delivery.objects.filter(delivery_person=rider).count(), 1)
+
+    def test_purge_deletes_expired_keys(self):
+        client = self.make_shopper('old', [(self.variant, 1)])
+        client.post('/api/order/place/', HTTP_IDEMPOTENCY_KEY='old')
+        IdempotencyKey.objects.update(created_at=timezone.now() - timedelta(days=2))
+        stdout = io.StringIO()
+        call_command('purge_idempotency_keys', stdout=stdout)
+        self.assertIn('Deleted 1 keys.', stdout.getvalue())
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+
+class PostalCodeIndexTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        PostalCode.objects.create(code='570001')
+        self.client = APIClient()
+
+    def test_hot_path_runs_no_queries(self):
+        self.client.post('/api/validate-postal/', {'postal_code': '570001'})
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.post('/api/validate-postal/', {'postal_code': '570001'}).status_code, 200)
+            self.assertEqual(self.client.post('/api/validate-postal/', {'postal_code': '560001'}).status_code, 404)
+        self.assertEqual(len(queries), 0)
+
+    def test_index_follows_writes(self):
+        self.assertEqual(self.client.post('/api/validate-postal/', {'postal_code': '560001'}).status_code, 404)
+        code = PostalCode.objects.create(code='560001')
+        self.assertEqual(self.client.post('/api/validate-postal/', {'postal_code': '560001'}).status_code, 200)
+        code.delete()
+        self.assertEqual(self.client.post('/api/validate-postal/', {'postal_code': '560001'}).status_code, 404)
+
+    def test_batch(self):
+        response = self.client.post(
+            '/api/validate-postal/batch/', {'postal_codes': ['570001', ' 560001 ']}, format='json'
+        )
+        self.assertEqual(response.data['results'], {'570001': True, '560001': False})
+        self.assertEqual(self.client.post('/api/validate-postal/batch/', {}, format='json').status_code, 400)
+
+
+class DeliveryAssignmentTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def make_rider(self, name, latitude, longitude):
+        rider = User.objects.create_user(username=name, full_name=name, password='secret', user_role='Delivery_Person')
+        Address.objects.create(
+            user=rider, address_line='Depot', city='Mysuru', postal_code='570001',
+            latitude=latitude, longitude=longitude, is_default=True,
+        )
+        return rider
+
+    def test_grid_lookup_matches_brute_force(self):
+        rng = random.Random(7)
+        riders = [(index, 12.2 + rng.random() * 0.5, 76.5 + rng.random() * 0.5) for index in range(500)]
+        loads = {index: rng.randint(0, 3) for index in range(500)}
+        index = delivery_assignment.RiderIndex(riders, loads, capacity=3)
+
+        for _ in range(50):
+            latitude, longitude = 12.2 + rng.random() * 0.5, 76.5 + rng.random() * 0.5
+            expected = sorted(
+                (delivery_assignment.distance_km(latitude, longitude, lat, lon), rider_id)
+                for rider_id, lat, lon in riders if loads[rider_id] < 3
+            )[:3]
+            self.assertEqual(index.nearest(latitude, longitude, k=3), [rider_id for _, rider_id in expected])
+
+    def test_nearest_rider_under_capacity(self):
+        near = self.make_rider('near', 12.30, 76.64)
+        far = self.make_rider('far', 12.35, 76.70)
+        with self.settings(DELIVERY_RIDER_CAPACITY=1):
+            self.assertEqual(delivery_assignment.choose_rider(12.301, 76.641), near.pk)
+            self.assertEqual(delivery_assignment.choose_rider(12.301, 76.641), far.pk)
+
+    def test_offline_rider_work_is_reassigned(self):
+        leaving = self.make_rider('leaving', 12.30, 76.64)
+        staying = self.make_rider('staying', 12.40, 76.70)
+        customer = User.objects.create_user(username='cust', full_name='Cust', password='secret')
+        Address.objects.create(user=customer, address_line='Home', city='Mysuru', postal_code='570001',
+                               latitude=12.3, longitude=76.64)
+        for _ in range(2):
+            Delivery.objects.create(order=Order.objects.create(user=customer), delivery_person=leaving)
+
+        admin = User.objects.create_user(username='admin', full_name='Admin', password='secret', is_staff=True)
+        client = APIClient()
+        client.force_authenticate(admin)
+        response = client.post('/api/deliveries/rider-offline/', {'rider_id': str(leaving.pk)})
+
+        self.assertEqual(response.data['reassigned'], 2)
+        self.assertEqual(Delivery.objects.filter(delivery_person=staying).count(), 2)
+        self.assertEqual(delivery_assignment.choose_rider(12.3, 76.64), staying.pk)
+
+    def test_hold_rider_counts_assignments_made_elsewhere(self):
+        rider = self.make_rider('rider', 12.30, 76.64)
+        customer = User.objects.create_user(username='cust', full_name='Cust', password='secret')
+        with self.settings(DELIVERY_RIDER_CAPACITY=1):
+            self.assertEqual(delivery_assignment.choose_rider(12.3, 76.64), rider.pk)
+            self.assertTrue(delivery_assignment.hold_rider(rider.pk))
+            # Another worker's assignment, committed since the index counted.
+            Delivery.objects.create(order=Order.objects.create(user=customer), delivery_person=rider)
+            self.assertFalse(delivery_assignment.hold_rider(rider.pk))
+
+    def test_work_nobody_can_take_goes_back_to_pending(self):
+        leaving = self.make_rider('leaving', 12.30, 76.64)
+        customer = User.objects.create_user(username='cust', full_name='Cust', password='secret')
+        delivery = Delivery.objects.create(
+            order=Order.objects.create(user=customer), delivery_person=leaving, delivery_status='assigned',
+        )
+        self.assertEqual(delivery_assignment.reassign_rider(leaving), 1)
+        delivery.refresh_from_db()
+        self.assertEqual((delivery.delivery_person, delivery.delivery_status), (None, 'pending'))
+        self.assertTrue(jobs.pending('assign_delivery', str(delivery.order_id)))
+
+
+class CachedTokenAuthenticationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+        self.user = User.objects.create_user(username='member', full_name='Member', password='secret')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def test_repeat_requests_skip_the_token_query(self):
+        self.assertEqual(self.client.get('/api/addresses/').status_code, 200)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.get('/api/addresses/').status_code, 200)
+        self.assertFalse([q for q in queries if 'authtoken_token' in q['sql']])
+
+    def test_logout_revokes_cached_token(self):
+        self.client.get('/api/addresses/')
+        self.assertEqual(self.client.post('/logout/').status_code, 200)
+        self.assertEqual(self.client.get('/api/addresses/').status_code, 401)
+
+    def test_deactivation_and_role_change_take_effect(self):
+        self.client.get('/api/addresses/')
+        self.user.user_role = 'Delivery_Person'
+        self.user.save()
+        self.client.get('/api/addresses/')
+        self.assertEqual(token_cache.get(self.token.key)[0].user_role, 'Delivery_Person')
+
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/api/addresses/').status_code, 401)
+
+
+@override_settings(IMAGE_DERIVATIVES_ASYNC=False, IMAGE_DERIVATIVE_WIDTHS=(64, 128, 4096))
+class ImageDerivativeTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=self.media)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def upload(self, name):
+        buffer = io.BytesIO()
+        Image.new('RGB', (300, 200), 'red').save(buffer, format='PNG')
+        return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+    def test_upload_gets_resized_copies(self):
+        product = make_product(Category.objects.create(name='Veg'), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            image = ProductImage.objects.create(product=product, image=self.upload('tomato.png'))
+
+        image.refresh_from_db()
+        self.assertEqual(image.image_derivatives['source'], image.image.name)
+        self.assertEqual(sorted(image.image_derivatives['webp']), ['128', '64'])
+        for name in image.image_derivatives['webp'].values():
+            self.assertRegex(name, r'^product_images/tomato\.[0-9a-f]{12}\.w\d+\.webp$')
+            with Image.open(os.path.join(self.media, name)) as derivative:
+                self.assertIn(derivative.width, (64, 128))
+
+        response = APIClient().get(f'/api/products/{product.pk}/')
+        payload = next(row for row in response.data['images'] if row['id'] == image.pk)
+        self.assertTrue(payload['derivatives']['webp']['64'].startswith('http://testserver/media/product_images/'))
+
+    def test_force_overwrites_existing_files(self):
+        product = make_product(Category.objects.create(name='Veg'), 1)
+        with self.captureOnCommitCallbacks(execute=True):
+            image = ProductImage.objects.create(product=product, image=self.upload('tomato.png'))
+        image.refresh_from_db()
+        path = os.path.join(self.media, image.image_derivatives['webp']['64'])
+        with open(path, 'wb') as handle:
+            handle.write(b'broken')
+
+        self.assertEqual(image_derivatives.generate(image.image.name), image.image_derivatives)
+        with open(path, 'rb') as handle:
+            self.assertEqual(handle.read(), b'broken')
+        self.assertEqual(image_derivatives.generate(image.image.name, force=True), image.image_derivatives)
+        with Image.open(path) as derivative:
+            self.assertEqual(derivative.width, 64)
+
+
+class RequestProfilingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        profiling.reset()
+        self.staff = User.objects.create_user(username='staff', full_name='Staff', password='secret', is_staff=True)
+        self.client = APIClient()
+        self.client.force_authenticate(self.staff)
+        make_product(Category.objects.create(name='Veg'), 1)
+
+    def test_records_queries_and_size_per_view(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/api/products/?ordering=name')
+        views = profiling.collect()['views']
+        summary = views['GET product-list']
+        self.assertEqual(summary['requests'], 1)
+        self.assertEqual(summary['queries']['max'], len(queries))
+        self.assertEqual(summary['response_bytes']['max'], len(response.content))
+
+        self.client.get('/api/no-such-route/')
+        self.assertIn('GET <unresolved>', profiling.collect()['views'])
+
+    def test_profiles_outlive_local_version_stamps(self):
+        self.client.get('/api/categories/')
+        with mock.patch('time.time', return_value=time.time() + 61):
+            self.assertIn('GET category-list', profiling.collect()['views'])
+
+    def test_dead_workers_drop_out(self):
+        self.client.get('/api/categories/')
+        marker = cache.get(profiling.RESET_KEY)
+        dead = profiling.profile.to_dict()
+        dead['views'] = {'GET dead-view': dead['views']['GET category-list']}
+        cache.set('profiling:worker:1', {'version': marker, **dead}, profiling.get_worker_ttl())
+        cache.set(profiling.WORKERS_KEY, cache.get(profiling.WORKERS_KEY) | {'1'}, None)
+        self.assertIn('GET dead-view', profiling.collect()['views'])
+
+        # Worker 1 never publishes again; this one does.
+        with mock.patch('time.time', return_value=time.time() + profiling.get_worker_ttl() + 1):
+            views = profiling.collect()['views']
+        self.assertNotIn('GET dead-view', views)
+        self.assertIn('GET category-list', views)
+        self.assertEqual(cache.get(profiling.WORKERS_KEY), {str(os.getpid())})
+
+    def test_workers_join_under_a_lock(self):
+        cache.delete(profiling.WORKERS_KEY)
+        cache.add(f'{profiling.WORKERS_KEY}:lock', 1)
+        profiling.publish(force=True)
+        self.assertIsNone(cache.get(profiling.WORKERS_KEY))
+        cache.delete(f'{profiling.WORKERS_KEY}:lock')
+        profiling.publish(force=True)
+        self.assertEqual(cache.get(profiling.WORKERS_KEY), {str(os.getpid())})
+
+    @override_settings(REQUEST_PROFILING_SLOW_MS=0)
+    def test_slow_requests_keep_their_sql(self):
+        with self.assertLogs('api.utils.profiling', 'WARNING'):
+            self.client.get('/api/products/')
+        slowest = profiling.collect()['slowest']
+        self.assertEqual(slowest[0]['view'], 'GET product-list')
+        self.assertTrue(any('api_product' in statement['sql'] for statement in slowest[0]['sql']))
+
+    def test_endpoint_is_staff_only_and_resets(self):
+        self.client.get('/api/categories/')
+        self.assertIn('GET category-list', self.client.get('/api/stats/requests/').data['views'])
+        self.assertEqual(APIClient().get('/api/stats/requests/').status_code, 401)
+
+        self.assertEqual(self.client.delete('/api/stats/requests/').status_code, 204)
+        self.assertNotIn('GET category-list', profiling.collect()['views'])
+
+        out = io.StringIO()
+        call_command('request_stats', stdout=out)
+        self.assertIn('DELETE request-stats', out.getvalue())
+
+
+class CartPricingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(username='pricing', full_name='Pricing', password='secret')
+        Address.objects.create(user=self.user, address_line='1 Main St', city='Mysuru', postal_code='570001')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        category = Category.objects.create(name='Veg')
+        self.variants = [make_product(category, index).variants.get(unit='500g') for index in range(3)]
+        for variant in self.variants:
+            Cart.objects.create(user=self.user, product=variant, quantity=2)
+        Coupon.objects.create(code='FRESH20', discount_amount=Decimal('20.00'), minimum_amount=Decimal('100.00'))
+
+    def test_one_query_with_line_breakdown(self):
+        with self.assertNumQueries(2):
+            summary = order_calculator.price_cart(self.user, 'FRESH20')
+        # 40.00 less 10%, twice, on three lines.
+        self.assertEqual([line['line_total'] for line in summary['lines']], [Decimal('72')] * 3)
+        self.assertEqual(summary['subtotal'], Decimal('216'))
+        self.assertEqual(summary['discount'], Decimal('20.00'))
+        self.assertEqual(summary['total_amount'], Decimal('216') + Decimal('11') + Decimal('50.00') - Decimal('20.00'))
+
+    def test_place_order_reuses_checkout_pricing(self):
+        response = self.client.post('/api/cart/checkout/', {'coupon_code': 'FRESH20'})
+        self.assertEqual(response.status_code, 200)
+        order_calculator.stats.reset()
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.client.post('/api/order/place/', {'coupon_code': 'FRESH20'}).status_code, 201)
+        self.assertFalse([q for q in queries if 'api_coupon' in q['sql']])
+        self.assertEqual(order_calculator.stats.snapshot(), {'hits': 1, 'misses': 0})
+        self.assertEqual(Order.objects.get().total_amount, response.data['total_amount'])
+
+    def test_place_order_rechecks_the_memoized_quote(self):
+        response = self.client.post('/api/cart/checkout/')
+        # As if changed through a worker whose cache this one doesn't share:
+        # no signals, so no version stamps bumped.
+        Cart.objects.filter(product=self.variants[0]).update(quantity=3)
+        ProductVariant.objects.filter(pk=self.variants[1].pk).update(price=Decimal('100.00'))
+        self.assertEqual(self.client.post('/api/order/place/').status_code, 201)
+
+        order = Order.objects.get()
+        self.assertNotEqual(order.total_amount, response.data['total_amount'])
+        self.assertEqual(
+            sorted(order.items.values_list('quantity', 'price_at_order')),
+            [(2, Decimal('36')), (2, Decimal('90')), (3, Decimal('36'))],
+        )
+
+    def test_cart_and_price_changes_reprice(self):
+        first = order_calculator.price_cart(self.user)
+        item = Cart.objects.get(product=self.variants[0])
+        item.quantity = 5
+        item.save()
+        self.assertEqual(order_calculator.price_cart(self.user)['lines'][0]['quantity'], 5)
+
+        self.variants[1].price = Decimal('100.00')
+        self.variants[1].save()
+        second = order_calculator.price_cart(self.user)
+        self.assertEqual(second['lines'][1]['unit_price'], Decimal('90'))
+        self.assertNotEqual(first['subtotal'], second['subtotal'])
+
+
+class CouponRegistryTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        for code, discount, minimum in [('SAVE10', 10, 100), ('SAVE50', 50, 500), ('Big75', 75, 1000), ('TINY5', 5, 0)]:
+            Coupon.objects.create(code=code, discount_amount=discount, minimum_amount=minimum)
+        Coupon.objects.create(code='OLD', discount_amount=500, minimum_amount=0, active=False)
+        coupons.get_index()
+
+    def test_lookups_run_no_queries(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(coupons.lookup(' big75 ').discount_amount, Decimal('75'))
+            self.assertIsNone(coupons.lookup('OLD'))
+            self.assertEqual([c.code for c in coupons.applicable(Decimal('600'))], ['SAVE50', 'SAVE10', 'TINY5'])
+            self.assertEqual(coupons.best_for(Decimal('99')).code, 'TINY5')
+            self.assertIsNone(coupons.best_for(Decimal('-1')))
+
+    def test_changes_reload_the_registry(self):
+        Coupon.objects.filter(code='SAVE50').update(active=False)
+        coupons.invalidate()
+        self.assertIsNone(coupons.lookup('SAVE50'))
+
+        Coupon.objects.create(code='MEGA', discount_amount=200, minimum_amount=300)
+        self.assertEqual(coupons.best_for(Decimal('600')).code, 'MEGA')
+
+    def test_applicable_endpoint(self):
+        response = APIClient().get('/api/coupons/applicable/', {'subtotal': '150'})
+        self.assertEqual(response.data['best']['code'], 'SAVE10')
+        self.assertEqual([c['code'] for c in response.data['coupons']], ['SAVE10', 'TINY5'])
+        self.assertEqual(APIClient().get('/api/coupons/applicable/', {'subtotal': 'nan'}).status_code, 400)
+        self.assertEqual(APIClient().get('/api/coupons/applicable/').status_code, 400)
+
+
+class CategoryTreeTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.fruits = Category.objects.create(name='Fruits')
+        self.citrus = Category.objects.create(name='Citrus', parent=self.fruits)
+        self.lemons = Category.objects.create(name='Lemons', parent=self.citrus)
+        self.vegetables = Category.objects.create(name='Vegetables')
+        self.products = {
+            category.name: make_product(category, index)
+            for index, category in enumerate([self.fruits, self.citrus, self.lemons, self.vegetables])
+        }
+
+    def subtree(self, category):
+        return set(
+            Product.objects.filter(category__in=category_tree.subtree_ids(category.pk)).values_list('name', flat=True)
+        )
+
+    def test_subtree_filter_is_one_query(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.subtree(self.fruits), {'Product 0', 'Product 1', 'Product 2'})
+
+        response = APIClient().get('/api/products/', {'category': str(self.citrus.pk)})
+        self.assertEqual({row['name'] for row in response.data['results']}, {'Product 1', 'Product 2'})
+        response = APIClient().get('/api/products/', {'category_slug': 'fruits'})
+        self.assertEqual(len(response.data['results']), 3)
+
+    def test_tree_endpoint(self):
+        with self.assertNumQueries(1):
+            response = APIClient().get('/api/categories/tree/')
+        self.assertEqual([node['name'] for node in response.data], ['Fruits', 'Vegetables'])
+        self.assertEqual(response.data[0]['children'][0]['children'][0]['name'], 'Lemons')
+
+    def test_moves_update_descendants(self):
+        category_tree.move([self.citrus], self.vegetables)
+        self.assertEqual(self.subtree(self.fruits), {'Product 0'})
+        self.assertEqual(self.subtree(self.vegetables), {'Product 1', 'Product 2', 'Product 3'})
+        self.assertEqual(
+            CategoryClosure.objects.get(ancestor=self.vegetables, descendant=self.lemons).depth, 2
+        )
+        self.assertEqual(APIClient().get('/api/categories/tree/').data[1]['children'][0]['name'], 'Citrus')
+
+        self.citrus.refresh_from_db()
+        self.citrus.parent = None
+        self.citrus.save()
+        self.assertEqual(self.subtree(self.vegetables), {'Product 3'})
+
+        with self.assertRaises(ValueError):
+            category_tree.move([self.fruits], self.fruits)
+        with self.assertRaises(ValueError):
+            category_tree.move([self.citrus], self.lemons)
+
+    def test_api_rejects_moving_a_category_under_itself(self):
+        admin = User.objects.create_user(username='admin', full_name='Admin', password='secret', is_staff=True)
+        client = APIClient()
+        client.force_authenticate(admin)
+        for parent in (self.fruits, self.lemons):
+            response = client.patch(f'/api/categories/{self.fruits.pk}/', {'parent': str(parent.pk)}, format='json')
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('parent', response.data)
+        self.assertEqual(self.subtree(self.fruits), {'Product 0', 'Product 1', 'Product 2'})
+
+        response = client.patch(f'/api/categories/{self.citrus.pk}/', {'parent': str(self.vegetables.pk)}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.subtree(self.vegetables), {'Product 1', 'Product 2', 'Product 3'})
+
+
+class ProductListingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.fruits = Category.objects.create(name='Fruits')
+        self.citrus = Category.objects.create(name='Citrus', parent=self.fruits)
+        self.apple = make_product(self.fruits, 1)
+        self.lemon = make_product(self.citrus, 2)
+        self.lemon.variants.update(stock=0, price=Decimal('30.00'))
+        listings.refresh([self.lemon.pk])
+
+    def test_rows_follow_the_catalog(self):
+        listing = ProductListing.objects.get(pk=self.apple.pk)
+        self.assertEqual((listing.min_price, listing.max_price), (Decimal('36'), Decimal('75')))
+        self.assertEqual((listing.total_stock, listing.in_stock, listing.category_slug), (20, True, 'fruits'))
+        self.assertEqual(listing.primary_image, 'product_images/p1.webp')
+
+        variant = self.apple.variants.get(unit='1kg')
+        variant.price = Decimal('20.00')
+        variant.save()
+        self.assertEqual(ProductListing.objects.get(pk=self.apple.pk).min_price, Decimal('20'))
+
+        self.apple.is_active = False
+        self.apple.save()
+        self.assertFalse(ProductListing.objects.filter(pk=self.apple.pk).exists())
+
+        self.assertEqual(listings.rebuild(), 1)
+
+    def test_stock_reservation_updates_listing(self):
+        variant = self.apple.variants.get(unit='500g')
+        reserve_stock([(variant.pk, 10)])
+        self.assertEqual(ProductListing.objects.get(pk=self.apple.pk).total_stock, 10)
+        reserve_stock([(self.apple.variants.get(unit='1kg').pk, 10)])
+        self.assertFalse(ProductListing.objects.get(pk=self.apple.pk).in_stock)
+
+    def test_endpoint_is_one_query(self):
+        client = APIClient()
+        with self.assertNumQueries(1):
+            response = client.get('/api/listings/', {'ordering': 'min_price'})
+        self.assertEqual([row['name'] for row in response.data['results']], ['Product 2', 'Product 1'])
+        self.assertEqual(response.data['results'][1]['image'], 'http://testserver/media/product_images/p1.webp')
+
+        response = client.get('/api/listings/', {'in_stock': 'true', 'category_slug': 'fruits'})
+        self.assertEqual([row['name'] for row in response.data['results']], ['Product 1'])
+        response = client.get('/api/listings/', {'category': str(self.citrus.pk), 'price_max': '40'})
+        self.assertEqual([row['name'] for row in response.data['results']], ['Product 2'])
+
+    def test_price_orderings_page_past_products_without_variants(self):
+        bare = Product.objects.create(name='Bare', description='', category=self.fruits)
+        self.assertIsNone(ProductListing.objects.get(pk=bare.pk).min_price)
+        client = APIClient()
+        for ordering in ('min_price', '-min_price', 'max_price', '-max_price'):
+            names, url = [], f'/api/listings/?ordering={ordering}&page_size=1'
+            while url:
+                response = client.get(url)
+                self.assertEqual(response.status_code, 200, ordering)
+                names += [row['name'] for row in response.data['results']]
+                url = response.data['next']
+            self.assertEqual(sorted(names), ['Product 1', 'Product 2'], ordering)
+        self.assertEqual(len(client.get('/api/listings/').data['results']), 3)
+
+
+class ProductFacetTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.fruits = Category.objects.create(name='Fruits')
+        self.citrus = Category.objects.create(name='Citrus', parent=self.fruits)
+        self.apple = make_product(self.fruits, 1)
+        self.lemon = make_product(self.citrus, 2)
+        tags.set_tags(self.apple, ['fresh', 'red'])
+        Product.objects.filter(pk=self.lemon.pk).update(brand='Zest')
+        tags.set_tags(self.lemon, ['fresh', 'sour'])
+        self.lemon.variants.update(stock=0, price=Decimal('300.00'))
+        listings.refresh([self.apple.pk, self.lemon.pk])
+        self.client = APIClient()
+
+    def counts(self, response, facet):
+        return {row['value']: row['count'] for row in response.data['facets'][facet]}
+
+    def test_results_and_counts_in_one_request(self):
+        response = self.client.get('/api/products/facets/')
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual([row['name'] for row in response.data['results']], ['Product 2', 'Product 1'])
+        self.assertEqual(self.counts(response, 'brand'), {'Farm': 1, 'Zest': 1})
+        self.assertEqual(self.counts(response, 'tag'), {'fresh': 2, 'red': 1, 'sour': 1})
+        self.assertEqual(self.counts(response, 'category'), {'fruits': 2, 'citrus': 1})
+        self.assertEqual(response.data['facets']['price'], [
+            {'value': '0-100', 'count': 1}, {'value': '250-500', 'count': 1},
+        ])
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/products/facets/', {'category': 'citrus'})
+        self.assertEqual([row['name'] for row in response.data['results']], ['Product 2'])
+        self.assertEqual(self.counts(response, 'brand'), {'Zest': 1})
+        # A facet isn't narrowed by its own selection, only by the others.
+        self.assertEqual(self.counts(response, 'category'), {'fruits': 2, 'citrus': 1})
+
+        response = self.client.get('/api/products/facets/', {'tag': 'FRESH', 'availability': 'in_stock'})
+        self.assertEqual([row['name'] for row in response.data['results']], ['Product 1'])
+        response = self.client.get('/api/products/facets/', {'brand': ['Farm', 'Zest'], 'price': '250-500'})
+        self.assertEqual([row['name'] for row in response.data['results']], ['Product 2'])
+
+    def test_pages_follow_the_cursor(self):
+        response = self.client.get('/api/products/facets/', {'page_size': 1})
+        self.assertEqual([row['name'] for row in response.data['results']], ['Product 2'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual([row['name'] for row in response.data['results']], ['Product 1'])
+        self.assertIsNone(response.data['next'])
+        self.assertEqual(self.client.get('/api/products/facets/', {'cursor': 'nope'}).status_code, 404)
+
+    def test_index_replays_writes_instead_of_rebuilding(self):
+        self.client.get('/api/products/facets/')
+        rebuilds = facets.stats.snapshot()['rebuilds']
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.apple.brand = 'Orchard'
+            self.apple.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            reserve_stock([(variant.pk, 10) for variant in self.apple.variants.all()])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.lemon.delete()
+
+        response = self.client.get('/api/products/facets/')
+        self.assertEqual(self.counts(response, 'brand'), {'Orchard': 1})
+        self.assertEqual(self.counts(response, 'availability'), {'out_of_stock': 1})
+        self.assertEqual(self.counts(response, 'category'), {'fruits': 1})
+        self.assertEqual(facets.stats.snapshot()['rebuilds'], rebuilds)
+
+        # Category changes rebuild the index.
+        with self.captureOnCommitCallbacks(execute=True):
+            category_tree.move([self.citrus], None)
+        self.client.get('/api/products/facets/')
+        self.assertEqual(facets.stats.snapshot()['rebuilds'], rebuilds + 1)
+
+
+class ProductTagTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Fruits')
+        self.apple = make_product(self.category, 1)
+        self.lemon = make_product(self.category, 2)
+        tags.set_tags(self.apple, ['organic', 'red'])
+        tags.set_tags(self.lemon, ['inorganic'])
+        self.admin = User.objects.create_user(username='admin', password='pw', is_staff=True)
+
+    def test_filter_matches_whole_tags(self):
+        client = APIClient()
+        response = client.get('/api/products/', {'tags': 'Organic'})
+        self.assertEqual([row['name'] for row in response.data['results']], ['Product 1'])
+        response = client.get('/api/products/', {'tags': 'organic,inorganic,red'})
+        self.assertEqual(sorted(row['name'] for row in response.data['results']), ['Product 1', 'Product 2'])
+
+    def test_serializer_keeps_the_comma_separated_shape(self):
+        client = APIClient()
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/api/products/')
+        self.assertEqual([row['tags'] for row in response.data['results']], ['inorganic', 'organic,red'])
+        self.assertEqual(sum('"api_tag"' in query['sql'] for query in queries.captured_queries), 1)
+
+        client.force_authenticate(self.admin)
+        response = client.patch(f'/api/products/{self.lemon.pk}/', {'tags': ' Sour, citrus,,sour'}, format='json')
+        self.assertEqual(response.data['tags'], 'citrus,sour')
+        self.assertEqual(Tag.objects.filter(name__in=['citrus', 'sour']).count(), 2)
+        self.assertEqual(client.get(f'/api/products/{self.lemon.pk}/').data['tags'], 'citrus,sour')
+        self.assertEqual(client.get('/api/products/', {'search': 'citrus'}).data['results'][0]['name'], 'Product 2')
+
+
+class CartServiceTests(TransactionTestCase):
+
+    def setUp(self):
+        cache.clear()
+        category = Category.objects.create(name='Fruits')
+        self.apple, self.apple_kg = make_product(category, 1).variants.order_by('pk')
+        self.lemon, self.lemon_kg = make_product(category, 2).variants.order_by('pk')
+        self.user = User.objects.create_user(username='shopper', full_name='Shopper', password='secret')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def quantities(self):
+        return dict(Cart.objects.filter(user=self.user).values_list('product_id', 'quantity'))
+
+    def test_adding_to_an_existing_line_is_one_update(self):
+        response = self.client.post('/api/cart/add/', {'product_id': self.apple.pk, 'quantity': 2})
+        self.assertEqual(response.status_code, 200)
+        with self.assertNumQueries(1):
+            carts.add_item(self.user, self.apple.pk, 3)
+        self.assertEqual(self.quantities(), {self.apple.pk: 5})
+        self.assertEqual(self.client.post('/api/cart/add/', {'product_id': 999999}).status_code, 404)
+        response = self.client.post('/api/cart/add/', {'product_id': self.apple.pk, 'quantity': 0})
+        self.assertEqual(response.status_code, 400)
+
+    def test_unknown_variant_is_refused_inside_a_transaction(self):
+        with transaction.atomic():
+            with self.assertRaises(carts.UnknownVariants):
+                carts.add_item(self.user, 999999, 1)
+            carts.add_item(self.user, self.lemon.pk, 1)
+        self.assertEqual(self.quantities(), {self.lemon.pk: 1})
+
+    def test_concurrent_adds_are_not_lost(self):
+        barrier = threading.Barrier(6)
+
+        def add(_):
+            barrier.wait()
+            try:
+                carts.add_item(self.user, self.apple.pk, 1)
+            finally:
+                connections.close_all()
+
+        with ThreadPoolExecutor(max_workers=6) as pool:
+            list(pool.map(add, range(6)))
+        self.assertEqual(self.quantities(), {self.apple.pk: 6})
+
+    def test_set_cart_applies_every_line_or_none(self):
+        carts.add_item(self.user, self.apple.pk, 1)
+        carts.add_item(self.user, self.lemon.pk, 1)
+
+        response = self.client.post('/api/cart/set/', {'items': [
+            {'product_id': self.apple.pk, 'quantity': 4},
+            {'product_id': self.lemon.pk, 'quantity': 0},
+            {'product_id': self.apple_kg.pk, 'quantity': 1},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['subtotal'], Decimal('219'))
+        self.assertEqual(self.quantities(), {self.apple.pk: 4, self.apple_kg.pk: 1})
+
+        response = self.client.post('/api/cart/set/', {'items': [
+            {'product_id': self.lemon_kg.pk, 'quantity': 1}, {'product_id': 999999, 'quantity': 1},
+        ]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['product_ids'], [999999])
+        self.assertEqual(self.quantities(), {self.apple.pk: 4, self.apple_kg.pk: 1})
+
+        response = self.client.post('/api/cart/set/', {
+            'items': [{'product_id': self.lemon_kg.pk, 'quantity': 2}], 'replace': True,
+        }, format='json')
+        self.assertEqual(self.quantities(), {self.lemon_kg.pk: 2})
+
+    @override_settings(CART_WRITE_BUFFER=True)
+    def test_buffered_adds_reach_the_table_at_checkout(self):
+        Address.objects.create(user=self.user, address_line='1 Main St', city='Mysuru', postal_code='570001')
+        carts.add_item(self.user, self.apple.pk, 1)
+        with self.assertNumQueries(0):
+            carts.add_item(self.user, self.apple.pk, 2)
+            carts.add_item(self.user, self.lemon.pk, 1)
+            carts.add_item(self.user, 999999, 1)
+        self.assertEqual(self.quantities(), {})
+
+        response = self.client.post('/api/cart/checkout/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.quantities(), {self.apple.pk: 3, self.lemon.pk: 1})
+        self.assertEqual(len(response.data['lines']), 2)
+        self.assertGreater(carts.stats.snapshot()['flushes'], 0)
+
+    @override_settings(CART_WRITE_BUFFER=True)
+    def test_checkout_waits_for_a_locked_buffer_and_never_skips_it(self):
+        Address.objects.create(user=self.user, address_line='1 Main St', city='Mysuru', postal_code='570001')
+        carts.add_item(self.user, self.apple.pk, 2)
+        lock = f'cart-buffer:{self.user.pk}:lock'
+        cache.add(lock, 1, 60)
+        with mock.patch.object(carts, 'LOCK_TIMEOUT', 0.05):
+            response = self.client.post('/api/order/place/')
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(Order.objects.exists())
+
+        # Released while checkout waits.
+        threading.Timer(0.1, cache.delete, [lock]).start()
+        self.assertEqual(self.client.post('/api/order/place/').status_code, 201)
+        self.assertEqual(list(Order.objects.get().items.values_list('quantity', flat=True)), [2])
+
+
+class ConditionalGetTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        conditional.stats.reset()
+        self.category = Category.objects.create(name='Veg')
+        self.product = make_product(self.category, 1)
+        self.user = User.objects.create_user(username='buyer', full_name='Buyer', password='secret')
+        variant = self.product.variants.first()
+        order = Order.objects.create(user=self.user, total_amount=Decimal('40.00'))
+        OrderItem.objects.create(order=order, product=variant, quantity=1, price_at_order=variant.price)
+        self.client = APIClient()
+
+    def revalidate(self, path, response, queries):
+        with CaptureQueriesContext(connection) as captured:
+            again = self.client.get(path, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again['ETag'], response['ETag'])
+        self.assertEqual(len(captured), queries)
+
+    def test_product_detail(self):
+        path = f'/api/products/{self.product.pk}/'
+        response = self.client.get(path)
+        self.assertTrue(response['ETag'].startswith('W/'))
+        self.assertIn('Last-Modified', response)
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.revalidate(path, response, 0)
+        self.assertEqual(self.client.get(path, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+
+        variant = self.product.variants.first()
+        variant.price = Decimal('99.00')
+        variant.save()
+        changed = self.client.get(path, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+        self.assertEqual(self.client.get('/api/products/00000000-0000-0000-0000-000000000000/').status_code, 404)
+
+    def test_placed_orders_refresh_the_stock_shown(self):
+        path = f'/api/products/{self.product.pk}/'
+        variant = self.product.variants.get(unit='1kg')
+        response = self.client.get(path)
+        self.assertEqual({row['unit']: row['stock'] for row in response.data['variants']}['1kg'], 10)
+
+        Address.objects.create(user=self.user, address_line='1 Main St', city='Mysuru', postal_code='570001')
+        Cart.objects.create(user=self.user, product=variant, quantity=4)
+        self.client.force_authenticate(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.client.post('/api/order/place/').status_code, 201)
+        self.client.force_authenticate(None)
+
+        changed = self.client.get(path, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+        self.assertEqual({row['unit']: row['stock'] for row in changed.data['variants']}['1kg'], 6)
+
+    def test_product_list_revalidates_on_the_page_query(self):
+        response = self.client.get('/api/products/')
+        self.assertNotIn('Last-Modified', response)
+        self.revalidate('/api/products/', response, 1)
+
+        make_product(self.category, 2)
+        self.assertEqual(self.client.get('/api/products/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+        # Validators depend on the query too.
+        self.assertNotEqual(self.client.get('/api/products/?ordering=name')['ETag'], response['ETag'])
+
+    def test_categories(self):
+        for path in ('/api/categories/', '/api/categories/tree/', f'/api/categories/{self.category.pk}/'):
+            response = self.client.get(path)
+            self.revalidate(path, response, 0)
+
+        response = self.client.get('/api/categories/')
+        Category.objects.create(name='Herbs')
+        self.assertEqual(self.client.get('/api/categories/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_order_history_follows_orders_and_their_products(self):
+        self.client.force_authenticate(self.user)
+        response = self.client.get('/api/orders/')
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('Authorization', response['Vary'])
+        self.revalidate('/api/orders/', response, 0)
+
+        variant = self.product.variants.first()
+        variant.stock = 3
+        variant.save()
+        response = self.client.get('/api/orders/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+
+        Order.objects.create(user=self.user, total_amount=Decimal('10.00'))
+        response = self.client.get('/api/orders/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(len(response.data['results']), 2)
+
+        other = User.objects.create_user(username='other', full_name='Other', password='secret')
+        self.client.force_authenticate(other)
+        self.assertEqual(self.client.get('/api/orders/', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200)
+
+    def test_not_modified_ratio_is_counted(self):
+        response = self.client.get('/api/categories/')
+        self.client.get('/api/categories/', HTTP_IF_NONE_MATCH=response['ETag'])
+        counts = conditional.stats.snapshot()
+        self.assertEqual((counts['requests'], counts['not_modified']), (2, 1))
+        self.assertEqual((counts['category_requests'], counts['category_not_modified']), (2, 1))
+
+
+class AsyncViewTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+        profiling.reset()
+        self.category = Category.objects.create(name='Veg')
+        Category.objects.create(name='Leafy', parent=self.category)
+        self.products = [make_product(self.category, index) for index in range(3)]
+        PostalCode.objects.create(code='570001')
+        self.user = User.objects.create_user(username='buyer', full_name='Buyer', password='secret')
+        self.other = User.objects.create_user(username='other', full_name='Other', password='secret')
+        variant = self.products[0].variants.first()
+        for user in (self.user, self.user, self.other):
+            order = Order.objects.create(user=user, total_amount=Decimal('40.00'))
+            OrderItem.objects.create(order=order, product=variant, quantity=1, price_at_order=variant.price)
+        self.token = Token.objects.create(user=self.user).key
+        self.sync = APIClient()
+        self.client = AsyncClient()
+
+    async def test_product_pages_match_the_sync_endpoint(self):
+        expected = (await self.sync_get('/api/products/'))['results']
+        first = await self.client.get('/api/async/products/?page_size=2')
+        self.assertEqual(first.status_code, 200)
+        second = await self.client.get(first.json()['next'])
+        self.assertIsNone(second.json()['next'])
+        self.assertEqual(first.json()['results'] + second.json()['results'], expected)
+
+        detail = await self.client.get(f'/api/async/products/{self.products[1].pk}/')
+        self.assertEqual(detail.json(), await self.sync_get(f'/api/products/{self.products[1].pk}/'))
+        missing = await self.client.get('/api/async/products/00000000-0000-0000-0000-000000000000/')
+        self.assertEqual(missing.status_code, 404)
+        self.assertEqual((await self.client.get('/api/async/products/?cursor=nope')).status_code, 404)
+
+    async def test_category_tree_matches_the_sync_endpoint(self):
+        response = await self.client.get('/api/async/categories/tree/')
+        self.assertEqual(response.json(), await self.sync_get('/api/categories/tree/'))
+        self.assertEqual(response.json()[0]['children'][0]['name'], 'Leafy')
+
+    async def test_postal_validation(self):
+        post = self.client.post
+        self.assertEqual((await post('/api/async/validate-postal/', {'postal_code': '570001'},
+                                     content_type='application/json')).status_code, 200)
+        self.assertEqual((await post('/api/async/validate-postal/', {'postal_code': '560001'})).status_code, 404)
+        self.assertEqual((await post('/api/async/validate-postal/', {})).status_code, 400)
+        self.assertEqual((await post('/api/async/validate-postal/', '[', content_type='application/json')).status_code,
+                         400)
+
+    async def test_order_history_is_the_users_own(self):
+        self.assertEqual((await self.client.get('/api/async/orders/')).status_code, 401)
+        invalid = await self.client.get('/api/async/orders/', headers={'Authorization': 'Token nope'})
+        self.assertEqual(invalid.status_code, 401)
+
+        response = await self.client.get('/api/async/orders/', headers={'Authorization': f'Token {self.token}'})
+        results = response.json()['results']
+        self.assertEqual(len(results), 2)
+        self.assertEqual({order['user'] for order in results}, {str(self.user.pk)})
+        self.assertEqual(results[0]['items'][0]['product']['product']['name'], 'Product 0')
+
+    async def test_queries_are_profiled(self):
+        await self.client.get('/api/async/products/')
+        self.assertGreater(profiling.collect()['views']['GET async-product-list']['queries']['max'], 0)
+
+    async def sync_get(self, path):
+        response = await sync_to_async(self.sync.get)(path)
+        return json.loads(response.content)
+
+
+class ProductImportTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Fresh Fruits')
+        self.vegetables = Category.objects.create(name='Vegetables')
+        self.admin = User.objects.create_user(username='admin', password='pw', is_staff=True)
+
+    def import_csv(self, text, **kwargs):
+        return product_import.import_products(io.StringIO(text), 'csv', **kwargs)
+
+    def test_csv_creates_and_then_updates(self):
+        report = self.import_csv(
+            'name,category,brand,tags,unit,price,stock\n'
+            'Red Apple,fresh-fruits,Farm,"Organic, red",1kg,120.00,5\n'
+            'Red Apple,fresh-fruits,Farm,,500g,65.00,3\n'
+            'Lemon,vegetables,,sour,piece,4,100\n'
+        )
+        self.assertEqual((report.rows, report.products, report.variants, report.failed), (3, 2, 3, 0))
+        apple = Product.objects.get(slug='red-apple')
+        self.assertEqual(apple.category, self.category)
+        self.assertEqual(
+            sorted(apple.variants.values_list('unit', 'price', 'stock')),
+            [('1kg', Decimal('120.00'), 5), ('500g', Decimal('65.00'), 3)],
+        )
+        # The second row's empty tags replace the first's.
+        self.assertEqual(list(apple.tags.all()), [])
+        self.assertEqual(ProductListing.objects.get(product=apple).min_price, Decimal('65.00'))
+
+        report = self.import_csv('slug,name,unit,stock\nred-apple,Green Apple,1kg,0\n')
+        self.assertEqual((report.products, report.variants, report.failed), (1, 1, 0))
+        apple.refresh_from_db()
+        self.assertEqual((apple.name, apple.brand, apple.category), ('Green Apple', 'Farm', self.category))
+        self.assertEqual(apple.variants.get(unit='1kg').price, Decimal('120.00'))
+        self.assertEqual(apple.variants.get(unit='1kg').stock, 0)
+        self.assertEqual(Product.objects.count(), 2)
+        self.assertEqual(APIClient().get(f'/api/products/{apple.pk}/').data['name'], 'Green Apple')
+        self.assertEqual(APIClient().get('/api/products/', {'search': 'green'}).data['results'][0]['name'], 'Green Apple')
+
+    def test_jsonl_variants_and_tags(self):
+        report = product_import.import_products(io.StringIO(
+            json.dumps({'name': 'Mango', 'category': 'Fresh fruits', 'tags': ['Sweet', 'seasonal'], 'variants': [
+                {'unit': '1kg', 'price': '150', 'discount_percent': 10}, {'unit': '3kg', 'price': 420},
+            ]}) + '\n\n' + json.dumps({'name': 'Papaya', 'category': 'vegetables', 'is_active': 'no'}) + '\n'
+        ), 'jsonl')
+        self.assertEqual((report.rows, report.products, report.variants, report.failed), (2, 2, 2, 0))
+        mango = Product.objects.get(slug='mango')
+        self.assertEqual(sorted(mango.tags.values_list('name', flat=True)), ['seasonal', 'sweet'])
+        self.assertEqual(mango.variants.get(unit='1kg').discount_percent, 10)
+        self.assertFalse(Product.objects.get(slug='papaya').is_active)
+
+    def test_bad_rows_are_reported_and_skipped(self):
+        make_product(self.category, 1)
+        report = self.import_csv(
+            'name,category,unit,price\n'
+            ',fresh-fruits,1kg,10\n'
+            'Kiwi,dairy,1kg,10\n'
+            'Kiwi,fresh-fruits,1kg,ten\n'
+            'Kiwi,fresh-fruits,1kg,-1\n'
+            'Kiwi,fresh-fruits,1kg,10.001\n'
+            'Fig,fresh-fruits,1kg,\n'
+            'Plum,fresh-fruits,1kg,30\n',
+            batch_size=3,
+        )
+        self.assertEqual((report.rows, report.products, report.failed), (7, 1, 6))
+        self.assertEqual([error['line'] for error in report.errors], [2, 3, 4, 5, 6, 7])
+        self.assertEqual(report.errors[1]['error'], "Unknown category 'dairy'")
+        self.assertEqual(report.errors[5]['error'], "price is required for new variant '1kg'")
+        self.assertTrue(Product.objects.filter(slug='plum').exists())
+
+        report = product_import.import_products(io.StringIO('{"name": "Orphan"}\nnot json\n[1]\n'), 'jsonl')
+        self.assertEqual({error['line']: error['error'] for error in report.errors}, {
+            1: 'category is required for a new product', 2: 'Invalid JSON', 3: 'Expected a JSON object',
+        })
+        # Existing products don't need a category, nor existing variants a price.
+        report = self.import_csv('slug,name,unit,stock\nproduct-1,Product 1,500g,1\n')
+        self.assertEqual(report.failed, 0)
+
+    def test_rows_without_a_slug_create_products(self):
+        existing = make_product(self.category, 1)
+        Product.objects.create(name='Other', slug='product-1-2', category=self.category)
+        report = self.import_csv(
+            'name,category,unit,price\n'
+            'Product 1,vegetables,1kg,5\n'
+            'Product  1,vegetables,2kg,9\n'
+            f'{"Long " * 20},vegetables,1kg,1\n'
+            'Product 1,vegetables,3kg,12\n',
+            batch_size=3,
+        )
+        self.assertEqual((report.products, report.variants, report.failed), (3, 4, 0))
+        existing.refresh_from_db()
+        self.assertEqual((existing.name, existing.category), ('Product 1', self.category))
+        self.assertEqual(existing.variants.count(), 2)
+        # Rows with the same name, in a batch or not, make one product.
+        imported = Product.objects.get(slug='product-1-3')
+        self.assertEqual((imported.name, imported.category), ('Product 1', self.vegetables))
+        self.assertEqual(sorted(imported.variants.values_list('unit', flat=True)), ['1kg', '2kg', '3kg'])
+
+        report = self.import_csv(f'name,category\nProduct 1,vegetables\n{"Long " * 20},vegetables\n')
+        self.assertEqual(report.products, 2)
+        self.assertTrue(Product.objects.filter(slug='product-1-4').exists())
+        self.assertEqual(
+            sorted(Product.objects.filter(name__startswith='Long').values_list('slug', flat=True)),
+            ['long-' * 9 + 'lon-2', 'long-' * 9 + 'long'],
+        )
+
+    def test_batches_write_without_per_row_queries(self):
+        rows = ''.join(f'Item {index},fresh-fruits,1kg,{index}\n' for index in range(200))
+        with CaptureQueriesContext(connection) as queries:
+            report = self.import_csv('name,category,unit,price\n' + rows, batch_size=100)
+        self.assertEqual((report.products, report.variants), (200, 200))
+        self.assertLess(len(queries), 60)
+
+    def test_command(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as handle:
+            handle.write('﻿name,category,unit,price\nQuince,fresh-fruits,1kg,80\nBad,,1kg,1\n')
+        self.addCleanup(os.remove, handle.name)
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command('import_products', handle.name, stdout=stdout, stderr=stderr)
+        self.assertIn('Imported 1 products and 1 variants from 2 rows, 1 failed.', stdout.getvalue())
+        self.assertIn('line 3: category is required', stderr.getvalue())
+        self.assertTrue(Product.objects.filter(slug='quince').exists())
+
+    def test_endpoint_streams_progress_for_staff(self):
+        upload = SimpleUploadedFile('products.jsonl', b'{"name": "Guava", "category": "fresh-fruits"}\n')
+        client = APIClient()
+        self.assertEqual(client.post('/api/products/import/', {'file': upload}).status_code, 401)
+
+        client.force_authenticate(self.admin)
+        self.assertEqual(client.post('/api/products/import/', {}).status_code, 400)
+        upload.seek(0)
+        response = client.post('/api/products/import/', {'file': upload})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(lines[0], {'rows': 1, 'products': 1, 'failed': 0})
+        self.assertEqual(lines[-1]['errors'], [])
+        self.assertTrue(Product.objects.filter(slug='guava').exists())
+
+        # Large uploads arrive as temporary files rather than in memory.
+        with override_settings(FILE_UPLOAD_MAX_MEMORY_SIZE=0):
+            upload = SimpleUploadedFile('products.txt', b'name,category\nPear,fresh-fruits\n')
+            self.assertEqual(client.post('/api/products/import/', {'file': upload}).status_code, 400)
+            upload.seek(0)
+            response = client.post('/api/products/import/', {'file': upload, 'format': 'csv'})
+            self.assertEqual(json.loads(b''.join(response.streaming_content).splitlines()[-1])['products'], 1)
+
+
+class OrderExportTests(TestCase):
+
+    def setUp(self):
+        self.category = Category.objects.create(name='Veg')
+        product = make_product(self.category, 1)
+        self.variants = list(product.variants.order_by('unit'))
+        self.user = User.objects.create_user(username='buyer', full_name='Buyer', password='secret')
+        self.admin = User.objects.create_user(username='admin', password='pw', is_staff=True)
+        self.first = Order.objects.create(user=self.user, status='completed', total_amount=Decimal('115.00'))
+        for variant in self.variants:
+            OrderItem.objects.create(order=self.first, product=variant, quantity=1, price_at_order=variant.price)
+        Payment.objects.create(order=self.first, payment_method='upi', payment_status='paid',
+                               amount_paid=Decimal('115.00'))
+        self.second = Order.objects.create(user=self.user, status='cancelled')
+        Order.objects.filter(pk=self.second.pk).update(created_at=self.first.created_at + timedelta(days=2))
+        self.client = APIClient()
+        self.client.force_authenticate(self.admin)
+
+    def export(self, **params):
+        response = self.client.get('/api/orders/export/', params)
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content).decode()
+
+    def test_csv_has_a_row_per_item(self):
+        rows = list(csv.DictReader(io.StringIO(self.export())))
+        self.assertEqual([row['order_id'] for row in rows], [str(self.first.pk)] * 2 + [str(self.second.pk)])
+        self.assertEqual([row['unit'] for row in rows], ['1kg', '500g', ''])
+        self.assertEqual(rows[0]['payment_status'], 'paid')
+        self.assertEqual(rows[0]['product_name'], 'Product 1')
+        self.assertEqual(rows[2]['payment_method'], '')
+
+    def test_jsonl_and_filters(self):
+        lines = [json.loads(line) for line in self.export(output='jsonl', status='completed').splitlines()]
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[1]['price_at_order'], '40.00')
+        self.assertIsNone(lines[0]['delivery_status'])
+
+        day = (self.first.created_at + timedelta(days=1)).date().isoformat()
+        self.assertEqual(len(self.export(output='jsonl', created_after=day).splitlines()), 1)
+        self.assertEqual(len(self.export(output='jsonl', created_before=day).splitlines()), 2)
+        self.assertEqual(self.client.get('/api/orders/export/', {'status': 'lost'}).status_code, 400)
+        self.assertEqual(self.client.get('/api/orders/export/', {'output': 'xml'}).status_code, 400)
+
+    def test_one_query_and_staff_only(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.export()
+        self.assertEqual(len(queries), 1)
+        self.client.force_authenticate(self.user)
+        self.assertEqual(self.client.get('/api/orders/export/').status_code, 403)
+
+
+class SalesRollupTests(TestCase):
+
+    def setUp(self):
+        self.fruits = Category.objects.create(name='Fruits')
+        self.citrus = Category.objects.create(name='Citrus', parent=self.fruits)
+        self.dairy = Category.objects.create(name='Dairy')
+        self.apple = make_product(self.fruits, 1).variants.get(unit='1kg')
+        self.lemon = make_product(self.citrus, 2).variants.get(unit='500g')
+        self.milk = make_product(self.dairy, 3).variants.get(unit='1kg')
+        self.user = User.objects.create_user(username='buyer', full_name='Buyer', password='secret')
+        self.admin = User.objects.create_user(username='admin', password='pw', is_staff=True)
+
+    def place(self, lines, coupon_code=None, discount='0', tax='0', days_ago=0):
+        with transaction.atomic():
+            order = Order.objects.create(
+                user=self.user, coupon_code=coupon_code, discount_amount=Decimal(discount),
+                tax_amount=Decimal(tax), total_amount=Decimal('0'),
+            )
+            if days_ago:
+                created_at = order.created_at - timedelta(days=days_ago)
+                Order.objects.filter(pk=order.pk).update(created_at=created_at)
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=variant, quantity=quantity, price_at_order=variant.price)
+                for variant, quantity in lines
+            ])
+        jobs.run_pending()
+        return order
+
+    def snapshot(self):
+        return (
+            sorted(DailySales.objects.filter(orders__gt=0).values_list(
+                'date', 'coupon_code', 'orders', 'subtotal', 'discount', 'tax', 'revenue',
+            )),
+            sorted(DailyVariantSales.objects.filter(orders__gt=0).values_list(
+                'date', 'variant_id', 'category_id', 'orders', 'units', 'revenue', 'discount', 'tax',
+            )),
+        )
+
+    def test_incremental_rollups_match_a_rebuild(self):
+        self.place([(self.apple, 2), (self.lemon, 1)], coupon_code='SAVE10', discount='10', tax='9.50')
+        self.place([(self.apple, 1)], days_ago=3)
+        self.place([(self.lemon, 1), (self.milk, 1)], tax='5.75')
+        cancelled = self.place([(self.milk, 3)])
+        cancelled.status = 'cancelled'
+        cancelled.save()
+
+        day = DailySales.objects.get(date=timezone.localdate(), coupon_code='SAVE10')
+        self.assertEqual((day.orders, day.subtotal, day.discount), (1, Decimal('190.00'), Decimal('10.00')))
+        apple = DailyVariantSales.objects.get(date=timezone.localdate(), variant=self.apple)
+        lemon = DailyVariantSales.objects.get(date=timezone.localdate(), variant=self.lemon)
+        self.assertEqual((apple.units, apple.revenue), (2, Decimal('150.00')))
+        # Shares of an order's discount and tax add up to it.
+        self.assertEqual(apple.discount + lemon.discount, Decimal('10.00'))
+        self.assertEqual(DailyVariantSales.objects.filter(variant=self.milk).get().orders, 1)
+
+        incremental = self.snapshot()
+        call_command('rebuild_sales_rollups', '--workers', '1', '--days', '2', stdout=io.StringIO())
+        self.assertEqual(self.snapshot(), incremental)
+
+        cancelled.status = 'pending'
+        cancelled.save()
+        self.assertEqual(DailyVariantSales.objects.get(variant=self.milk).units, 4)
+        cancelled.delete()
+        self.assertEqual(DailyVariantSales.objects.get(variant=self.milk).units, 1)
+
+    def test_changes_before_the_job_runs_are_not_counted_twice(self):
+        with transaction.atomic():
+            cancelled = Order.objects.create(user=self.user, total_amount=Decimal('0'))
+            OrderItem.objects.create(order=cancelled, product=self.milk, quantity=2, price_at_order=self.milk.price)
+            deleted = Order.objects.create(user=self.user, total_amount=Decimal('0'))
+            OrderItem.objects.create(order=deleted, product=self.milk, quantity=5, price_at_order=self.milk.price)
+        cancelled.status = 'cancelled'
+        cancelled.save()
+        deleted.delete()
+        jobs.run_pending()
+        self.place([(self.milk, 1)])
+        self.assertEqual(DailyVariantSales.objects.get(variant=self.milk).units, 1)
+
+    def test_report(self):
+        self.place([(self.apple, 2), (self.lemon, 1)], coupon_code='SAVE10', discount='10')
+        self.place([(self.lemon, 4)], days_ago=2)
+        self.place([(self.milk, 1)], days_ago=40)
+        client = APIClient()
+        self.assertEqual(client.get('/api/stats/sales/').status_code, 401)
+        client.force_authenticate(self.admin)
+
+        with CaptureQueriesContext(connection) as queries:
+            daily = client.get('/api/stats/sales/').data['results']
+        self.assertEqual(len(queries), 1)
+        self.assertEqual([row['orders'] for row in daily], [1, 1])
+        self.assertEqual(daily[-1]['revenue'], Decimal('0'))
+
+        products = client.get('/api/stats/sales/', {'by': 'product', 'limit': 1}).data['results']
+        self.assertEqual(products, [{
+            'product_id': self.lemon.product_id, 'product_name': 'Product 2', 'orders': 2, 'units': 5,
+            'revenue': Decimal('200.00'), 'discount': Decimal('2.11'), 'tax': Decimal('0.00'),
+        }])
+        categories = client.get('/api/stats/sales/', {'by': 'category', 'category': self.fruits.pk}).data['results']
+        self.assertEqual([row['category_name'] for row in categories], ['Citrus', 'Fruits'])
+        start = (timezone.localdate() - timedelta(days=60)).isoformat()
+        coupons = client.get('/api/stats/sales/', {'by': 'coupon', 'start': start}).data['results']
+        self.assertEqual({row['coupon_code']: row['orders'] for row in coupons}, {'SAVE10': 1, '': 2})
+
+        self.assertEqual(client.get('/api/stats/sales/', {'by': 'hour'}).status_code, 400)
+        self.assertEqual(client.get('/api/stats/sales/', {'start': 'yesterday'}).status_code, 400)
+
+
+flaky_calls = []
+
+
+@jobs.task('test_flaky', max_attempts=3)
+def flaky(name, failures):
+    # Creates tag `name`, after raising the first `failures` times.
+    flaky_calls.append(name)
+    Tag.objects.create(name=name)
+    if flaky_calls.count(name) <= failures:
+        raise RuntimeError(f'{name} went wrong')
+
+
+@jobs.task('test_single', concurrency=1)
+def single():
+    pass
+
+
+class JobQueueTests(TestCase):
+
+    def setUp(self):
+        flaky_calls.clear()
+        jobs.stats.reset()
+
+    def test_retries_back_off_until_out_of_attempts(self):
+        recovers = jobs.enqueue('test_flaky', 'recovers', 1)
+        gives_up = jobs.enqueue('test_flaky', 'gives-up', 5)
+        with self.assertLogs('api.utils.jobs', 'WARNING'):
+            self.assertEqual(jobs.run_pending(), 2)
+        recovers.refresh_from_db()
+        self.assertEqual((recovers.status, recovers.attempts), ('queued', 1))
+        self.assertIn('recovers went wrong', recovers.last_error)
+        self.assertGreaterEqual((recovers.run_at - timezone.now()).total_seconds(), 4)
+
+        with self.settings(JOB_RETRY_BASE=0):
+            Job.objects.update(run_at=timezone.now())
+            with self.assertLogs('api.utils.jobs', 'WARNING') as logs:
+                self.assertEqual(jobs.run_pending(), 3)
+        recovers.refresh_from_db()
+        gives_up.refresh_from_db()
+        self.assertEqual((recovers.status, recovers.attempts, recovers.last_error), ('done', 2, ''))
+        self.assertEqual((gives_up.status, gives_up.attempts), ('failed', 3))
+        # Failed attempts roll back what they did.
+        self.assertEqual(list(Tag.objects.values_list('name', flat=True)), ['recovers'])
+        self.assertIn('failed for good after 3 attempts', logs.output[-1])
+        self.assertEqual(jobs.stats.snapshot()['retried'], 3)
+        self.assertRaises(LookupError, jobs.enqueue, 'test_missing')
+
+    def test_expired_jobs_run_again_and_the_late_run_rolls_back(self):
+        job = jobs.enqueue('test_flaky', 'slow', 0)
+        [stale] = jobs.claim('dead-worker')
+        Job.objects.filter(pk=job.pk).update(locked_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(jobs.requeue_expired(), 1)
+
+        with self.assertLogs('api.utils.jobs', 'WARNING'):
+            self.assertFalse(jobs.execute(stale))
+        self.assertFalse(Tag.objects.exists())
+        self.assertEqual(jobs.run_pending(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), ('done', 2))
+        self.assertEqual(Tag.objects.filter(name='slow').count(), 1)
+
+    def test_concurrency_limit(self):
+        for _ in range(3):
+            jobs.enqueue('test_single')
+        jobs.enqueue('test_flaky', 'other', 0)
+        claimed = jobs.claim('worker', 4)
+        self.assertEqual(sorted(job.name for job in claimed), ['test_flaky', 'test_single'])
+        self.assertEqual(jobs.claim('worker', 4), [])
+
+    def test_metrics_endpoint(self):
+        jobs.enqueue('test_flaky', 'a', 0)
+        jobs.enqueue('test_flaky', 'b', 0, delay=60)
+        jobs.enqueue('test_single', delay=60)
+        jobs.run_pending()
+        client = APIClient()
+        self.assertEqual(client.get('/api/stats/jobs/').status_code, 401)
+        client.force_authenticate(User.objects.create_user(username='admin', password='pw', is_staff=True))
+
+        data = client.get('/api/stats/jobs/').data
+        self.assertEqual(
+            {key: data['test_flaky'][key] for key in ('queued', 'running', 'done', 'failed', 'finished')},
+            {'queued': 1, 'running': 0, 'done': 1, 'failed': 0, 'finished': 1},
+        )
+        self.assertEqual(set(data['test_flaky']['run_ms']), {'mean', 'p50', 'p90', 'p99', 'max'})
+        self.assertEqual(data['test_single']['queued'], 1)
+        self.assertEqual(client.get('/api/stats/jobs/', {'window': 'day'}).status_code, 400)
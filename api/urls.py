@@ -1,8 +1,11 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
+from .async_views import (
+    AsyncCategoryTreeView, AsyncProductDetailView, AsyncProductListView, AsyncUserOrdersView, AsyncValidatePostalCodeView
+)
 from .views import (
-    AddToCartAPIView, CartListAPIView, CheckoutAPIView, PlaceOrderAPIView, PostalCodeViewSet, RegisterView, UserOrdersAPIView, UserViewSet, CategoryViewSet, ProductViewSet,
-    CartViewSet, AddressViewSet, OrderViewSet, DeliveryViewSet, PaymentViewSet, ValidatePostalCodeView
+    AddToCartAPIView, ApplicableCouponsView, CartListAPIView, CheckoutAPIView, PlaceOrderAPIView, PostalCodeViewSet, RegisterView, SetCartAPIView, UserOrdersAPIView, UserViewSet, CategoryViewSet, ProductViewSet,
+    CartViewSet, AddressViewSet, OrderExportView, OrderViewSet, DeliveryViewSet, PaymentViewSet, ProductFacetView, JobStatsView, ProductListingView, RequestStatsView, SalesReportView, StatsView, ValidatePostalCodeBatchView, ValidatePostalCodeView
 )
 
 router = DefaultRouter()
@@ -19,11 +22,26 @@ router.register(r'postal-codes', PostalCodeViewSet, basename='postalcode')
 urlpatterns = [
     path('users/register/', RegisterView.as_view(), name='register'),
     path('validate-postal/', ValidatePostalCodeView.as_view(), name='validate-postal'),
+    path('validate-postal/batch/', ValidatePostalCodeBatchView.as_view(), name='validate-postal-batch'),
     path('cart/add/', AddToCartAPIView.as_view(), name='add-to-cart'),
+    path('coupons/applicable/', ApplicableCouponsView.as_view(), name='applicable-coupons'),
+    path('cart/set/', SetCartAPIView.as_view(), name='set-cart'),
     path('cart/checkout/', CheckoutAPIView.as_view(), name='checkout'),
     path('cart/', CartListAPIView.as_view(), name='view-cart'),
     path('order/place/', PlaceOrderAPIView.as_view(), name='place-order'),
     path('orders/', UserOrdersAPIView.as_view(), name='user-orders'),
+    path('orders/export/', OrderExportView.as_view(), name='order-export'),
+    path('listings/', ProductListingView.as_view(), name='product-listings'),
+    path('products/facets/', ProductFacetView.as_view(), name='product-facets'),
+    path('async/products/', AsyncProductListView.as_view(), name='async-product-list'),
+    path('async/products/<uuid:pk>/', AsyncProductDetailView.as_view(), name='async-product-detail'),
+    path('async/categories/tree/', AsyncCategoryTreeView.as_view(), name='async-category-tree'),
+    path('async/validate-postal/', AsyncValidatePostalCodeView.as_view(), name='async-validate-postal'),
+    path('async/orders/', AsyncUserOrdersView.as_view(), name='async-user-orders'),
+    path('stats/', StatsView.as_view(), name='stats'),
+    path('stats/requests/', RequestStatsView.as_view(), name='request-stats'),
+    path('stats/sales/', SalesReportView.as_view(), name='sales-report'),
+    path('stats/jobs/', JobStatsView.as_view(), name='job-stats'),
     path('', include(router.urls)),
 ]
 
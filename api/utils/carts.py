@@ -0,0 +1,184 @@
+import time
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+from api.utils import order_calculator
+from api.utils.stats import register
+from api.utils.versions import get_cache
+
+
+stats = register('carts', 'writes', 'buffered', 'flushes', 'lock_timeouts')
+
+# How long a buffer may stay locked, and how long a writer waits for it
+# before writing to the database directly instead. A flush waits as long
+# as the lock can be held.
+LOCK_TIMEOUT = 5
+LOCK_WAIT = 0.5
+WAIT_INTERVAL = 0.005
+
+
+class UnknownVariants(Exception):
+    def __init__(self, variant_ids):
+        self.variant_ids = sorted(variant_ids)
+        super().__init__('Unknown product variants')
+
+
+class CartBusy(APIException):
+    # The buffered adds couldn't be flushed; going on would read a cart
+    # without them.
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'The cart is being updated, try again.'
+    default_code = 'cart_busy'
+
+
+def is_buffered():
+    return getattr(settings, 'CART_WRITE_BUFFER', False)
+
+
+def _buffer_key(user_id):
+    return f'cart-buffer:{user_id}'
+
+
+def _lock(user_id, wait=None):
+    """
+    Take the user's buffer lock, waiting up to `wait` seconds (LOCK_WAIT by
+    default). Returns whether it was taken.
+    """
+    cache = get_cache()
+    deadline = time.monotonic() + (LOCK_WAIT if wait is None else wait)
+    while not cache.add(f'{_buffer_key(user_id)}:lock', 1, LOCK_TIMEOUT):
+        if time.monotonic() >= deadline:
+            stats.incr('lock_timeouts')
+            return False
+        time.sleep(WAIT_INTERVAL)
+    return True
+
+
+def _unlock(user_id):
+    get_cache().delete(f'{_buffer_key(user_id)}:lock')
+
+
+def _increment(user_id, deltas):
+    """
+    Add `deltas` (variant id -> quantity) to the user's cart lines in one
+    UPDATE, creating the lines that don't exist yet. Variants that don't
+    exist are skipped.
+    """
+    from api.models import Cart, ProductVariant
+
+    quantity = F('quantity') + Case(
+        *[When(product_id=variant_id, then=Value(delta)) for variant_id, delta in deltas.items()],
+        output_field=IntegerField(),
+    )
+    Cart.objects.filter(user_id=user_id, product_id__in=deltas).update(quantity=quantity)
+
+    existing = set(Cart.objects.filter(user_id=user_id, product_id__in=deltas).values_list('product_id', flat=True))
+    missing = [variant_id for variant_id in deltas if variant_id not in existing]
+    if missing:
+        known = set(ProductVariant.objects.filter(pk__in=missing).values_list('pk', flat=True))
+        Cart.objects.bulk_create([
+            Cart(user_id=user_id, product_id=variant_id, quantity=deltas[variant_id])
+            for variant_id in missing if variant_id in known
+        ])
+
+
+def add_item(user, variant_id, quantity=1):
+    """
+    Add `quantity` of a variant to the user's cart. The common case, a line
+    that already exists, is a single `quantity = quantity + n` UPDATE, so
+    concurrent adds (a double click) both count.
+
+    With CART_WRITE_BUFFER on, the add is only recorded in the cache and
+    reaches the Cart table on the next flush(); unknown variants are then
+    dropped instead of raising UnknownVariants here.
+    """
+    from api.models import Cart, ProductVariant
+
+    stats.incr('writes')
+    if is_buffered() and _lock(user.pk):
+        try:
+            cache = get_cache()
+            buffer = cache.get(_buffer_key(user.pk)) or {}
+            buffer[variant_id] = buffer.get(variant_id, 0) + quantity
+            cache.set(_buffer_key(user.pk), buffer, None)
+        finally:
+            _unlock(user.pk)
+        stats.incr('buffered')
+        return
+
+    line = Cart.objects.filter(user=user, product_id=variant_id)
+    if not line.update(quantity=F('quantity') + quantity):
+        # Checked rather than left to the foreign key, which SQLite only
+        # enforces at commit: inside an outer transaction that's too late.
+        if not ProductVariant.objects.filter(pk=variant_id).exists():
+            raise UnknownVariants([variant_id])
+        try:
+            with transaction.atomic():
+                # Sends post_save, which invalidates the cart's price quote.
+                Cart.objects.create(user=user, product_id=variant_id, quantity=quantity)
+            return
+        except IntegrityError:
+            # Another request created the line in between; add to it instead.
+            line.update(quantity=F('quantity') + quantity)
+    # UPDATEs send no signals.
+    order_calculator.invalidate_cart(user.pk)
+
+
+def set_items(user, quantities, replace=False):
+    """
+    Set the quantities of many lines (variant id -> quantity, 0 removes the
+    line) in one transaction. With `replace`, lines not mentioned are
+    removed too. Raises UnknownVariants, changing nothing, if any variant
+    doesn't exist.
+    """
+    from api.models import Cart, ProductVariant
+
+    stats.incr('writes')
+    flush(user)
+    keep = {variant_id: quantity for variant_id, quantity in quantities.items() if quantity > 0}
+    known = set(ProductVariant.objects.filter(pk__in=keep).values_list('pk', flat=True))
+    if len(known) != len(keep):
+        raise UnknownVariants(set(keep) - known)
+
+    with transaction.atomic():
+        lines = Cart.objects.filter(user=user)
+        if replace:
+            lines = lines.exclude(product_id__in=keep)
+        else:
+            lines = lines.filter(product_id__in=[variant_id for variant_id in quantities if variant_id not in keep])
+        lines.delete()
+        Cart.objects.bulk_create(
+            [Cart(user=user, product_id=variant_id, quantity=quantity) for variant_id, quantity in keep.items()],
+            update_conflicts=True, unique_fields=['user', 'product'], update_fields=['quantity'],
+        )
+        order_calculator.invalidate_cart(user.pk)
+
+
+def flush(user):
+    """
+    Write the user's buffered adds to the Cart table. Anything that reads
+    the cart (listing, pricing, checkout) calls this first; it costs one
+    cache read when there is nothing buffered. Raises CartBusy if the
+    buffer stays locked for longer than a lock can be held.
+    """
+    if not is_buffered():
+        return
+    cache = get_cache()
+    if not cache.get(_buffer_key(user.pk)):
+        return
+    if not _lock(user.pk, LOCK_TIMEOUT):
+        raise CartBusy()
+    try:
+        buffer = cache.get(_buffer_key(user.pk))
+        if buffer:
+            with transaction.atomic():
+                _increment(user.pk, buffer)
+                order_calculator.invalidate_cart(user.pk)
+            cache.delete(_buffer_key(user.pk))
+            stats.incr('flushes')
+    finally:
+        _unlock(user.pk)
@@ -0,0 +1,197 @@
+import asyncio
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+from api.utils.stats import register
+from api.utils.versions import bump_version_on_commit, get_versions
+
+
+stats = register('catalog_cache', 'hits', 'misses', 'evictions', 'rebuild_waits')
+
+# How long a rebuild may hold its lock, and how long other requests wait on
+# it before giving up and building the entry themselves.
+LOCK_TIMEOUT = 5
+WAIT_INTERVAL = 0.02
+
+
+def get_cache():
+    return caches[getattr(settings, 'CATALOG_CACHE_ALIAS', 'default')]
+
+
+def get_timeout():
+    return getattr(settings, 'CATALOG_CACHE_TIMEOUT', 60 * 60)
+
+
+def invalidate(entity, pk=None):
+    """
+    Retire the cached payload of one entity, or the entity's collection-wide
+    payloads (e.g. the category list) when `pk` is None.
+    """
+    bump_version_on_commit(f'{entity}:{pk}' if pk is not None else f'{entity}:*')
+    stats.incr('evictions')
+
+
+def get_many(entity, pks, build_many, scope=''):
+    """
+    Return the cached payloads for `pks`, in order. Entries missing from the
+    cache are built in one call to `build_many(missing_pks)`, which must
+    return a dict keyed by the same pk strings.
+    """
+    pks = [str(pk) for pk in pks]
+    keys, payloads = _lookup(entity, pks, scope)
+    missing = [pk for pk in pks if pk not in payloads]
+    if missing:
+        stats.incr('misses', len(missing))
+        payloads.update(_build_locked({pk: keys[pk] for pk in missing}, build_many))
+
+    return [payloads[pk] for pk in pks if pk in payloads]
+
+
+async def aget_many(entity, pks, build_many, scope=''):
+    """
+    get_many() for async views, with `build_many` a coroutine function. The
+    cache itself is still read synchronously: it is in-process or a quick
+    round trip, and only a rebuild goes to the database.
+    """
+    pks = [str(pk) for pk in pks]
+    keys, payloads = _lookup(entity, pks, scope)
+    missing = [pk for pk in pks if pk not in payloads]
+    if missing:
+        stats.incr('misses', len(missing))
+        payloads.update(await _abuild_locked({pk: keys[pk] for pk in missing}, build_many))
+
+    return [payloads[pk] for pk in pks if pk in payloads]
+
+
+def get_one(entity, pk, build, scope=''):
+    """
+    Cached payload of a single entity. `build()` returns the payload, or None
+    when the entity doesn't exist (nothing is cached in that case).
+    """
+    payloads = get_many(entity, [pk], lambda missing: {str(pk): build()}, scope)
+    return payloads[0] if payloads and payloads[0] is not None else None
+
+
+def get_collection(entity, build, scope=''):
+    """
+    Cached payload that depends on every row of `entity`, such as a full list.
+    """
+    return get_one(entity, '*', build, scope)
+
+
+async def aget_one(entity, pk, build, scope=''):
+    async def build_many(missing):
+        return {str(pk): await build()}
+
+    payloads = await aget_many(entity, [pk], build_many, scope)
+    return payloads[0] if payloads and payloads[0] is not None else None
+
+
+async def aget_collection(entity, build, scope=''):
+    return await aget_one(entity, '*', build, scope)
+
+
+def _lookup(entity, pks, scope):
+    # Cache keys of `pks` under their current version stamps, and the
+    # payloads found for them.
+    if not pks:
+        return {}, {}
+    scope = hashlib.md5(scope.encode()).hexdigest()[:12]
+    versions = get_versions([f'{entity}:{pk}' for pk in pks])
+    keys = {pk: f'catalog:{scope}:{entity}:{pk}:{versions[f"{entity}:{pk}"]}' for pk in pks}
+
+    found = get_cache().get_many(keys.values())
+    payloads = {pk: found[key] for pk, key in keys.items() if key in found}
+    stats.incr('hits', len(payloads))
+    return keys, payloads
+
+
+def _lock(keys):
+    cache = get_cache()
+    return {pk: key for pk, key in keys.items() if cache.add(f'{key}:lock', 1, LOCK_TIMEOUT)}
+
+
+def _store(owned, built):
+    cache = get_cache()
+    try:
+        cache.set_many(
+            {owned[pk]: payload for pk, payload in built.items() if pk in owned and payload is not None},
+            get_timeout(),
+        )
+    finally:
+        _unlock(owned)
+
+
+def _unlock(owned):
+    get_cache().delete_many([f'{key}:lock' for key in owned.values()])
+
+
+def _collect(waiting, payloads):
+    # Move the entries other requests have finished building from `waiting`
+    # to `payloads`. Returns whether any of the rest are still being built.
+    cache = get_cache()
+    found = cache.get_many(waiting.values())
+    for pk, key in list(waiting.items()):
+        if key in found:
+            payloads[pk] = found[key]
+            del waiting[pk]
+    return any(cache.get(f'{key}:lock') for key in waiting.values())
+
+
+def _build_locked(keys, build_many):
+    # Only one request rebuilds a given entry at a time; the rest wait for it
+    # instead of all hitting the database with the same query.
+    owned = _lock(keys)
+    waiting = {pk: key for pk, key in keys.items() if pk not in owned}
+
+    payloads = {}
+    if owned:
+        try:
+            built = build_many(list(owned))
+        except BaseException:
+            _unlock(owned)
+            raise
+        _store(owned, built)
+        payloads.update(built)
+
+    if waiting:
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while waiting and time.monotonic() < deadline:
+            time.sleep(WAIT_INTERVAL)
+            if not _collect(waiting, payloads):
+                break
+        stats.incr('rebuild_waits', len(keys) - len(owned))
+        if waiting:
+            payloads.update(build_many(list(waiting)))
+
+    return payloads
+
+
+async def _abuild_locked(keys, build_many):
+    owned = _lock(keys)
+    waiting = {pk: key for pk, key in keys.items() if pk not in owned}
+
+    payloads = {}
+    if owned:
+        try:
+            built = await build_many(list(owned))
+        except BaseException:
+            _unlock(owned)
+            raise
+        _store(owned, built)
+        payloads.update(built)
+
+    if waiting:
+        deadline = time.monotonic() + LOCK_TIMEOUT
+        while waiting and time.monotonic() < deadline:
+            await asyncio.sleep(WAIT_INTERVAL)
+            if not _collect(waiting, payloads):
+                break
+        stats.incr('rebuild_waits', len(keys) - len(owned))
+        if waiting:
+            payloads.update(await build_many(list(waiting)))
+
+    return payloads
@@ -0,0 +1,101 @@
+from django.db import connection, transaction
+
+from api.utils import catalog_cache, facets
+
+
+def _closure():
+    from api.models import CategoryClosure
+
+    return CategoryClosure
+
+
+def _db_id(pk):
+    from api.models import Category
+
+    return Category._meta.pk.get_db_prep_value(pk, connection)
+
+
+def subtree_ids(category_id):
+    """
+    Queryset of the ids of `category_id` and every category below it, for use
+    as a subquery.
+    """
+    return _closure().objects.filter(ancestor_id=category_id).values('descendant_id')
+
+
+def insert_node(category):
+    """
+    Link a newly saved category to itself and to all of its parent's ancestors.
+    """
+    CategoryClosure = _closure()
+    links = [CategoryClosure(ancestor_id=category.pk, descendant_id=category.pk, depth=0)]
+    if category.parent_id is not None:
+        links += [
+            CategoryClosure(ancestor_id=ancestor_id, descendant_id=category.pk, depth=depth + 1)
+            for ancestor_id, depth in CategoryClosure.objects.filter(descendant_id=category.parent_id)
+            .values_list('ancestor_id', 'depth')
+        ]
+    CategoryClosure.objects.bulk_create(links)
+
+
+def relink(category_id, parent_id):
+    """
+    Re-attach the subtree under `category_id` to `parent_id` (None for the
+    top level) with two statements, however large the subtree is.
+    """
+    CategoryClosure = _closure()
+    if parent_id is not None and CategoryClosure.objects.filter(
+        ancestor_id=category_id, descendant_id=parent_id
+    ).exists():
+        raise ValueError('A category cannot be moved under itself or one of its subcategories')
+
+    table = connection.ops.quote_name(CategoryClosure._meta.db_table)
+    category_id = _db_id(category_id)
+    with connection.cursor() as cursor:
+        # Drop the links from anything outside the subtree into it...
+        cursor.execute(
+            f'DELETE FROM {table} '
+            f'WHERE descendant_id IN (SELECT descendant_id FROM {table} WHERE ancestor_id = %s) '
+            f'AND ancestor_id NOT IN (SELECT descendant_id FROM {table} WHERE ancestor_id = %s)',
+            [category_id, category_id],
+        )
+        # ...and link every ancestor of the new parent to every node in it.
+        if parent_id is not None:
+            cursor.execute(
+                f'INSERT INTO {table} (ancestor_id, descendant_id, depth) '
+                f'SELECT above.ancestor_id, below.descendant_id, above.depth + below.depth + 1 '
+                f'FROM {table} above, {table} below '
+                f'WHERE above.descendant_id = %s AND below.ancestor_id = %s',
+                [_db_id(parent_id), category_id],
+            )
+
+
+def move(categories, parent):
+    """
+    Re-parent `categories` (instances or ids), with everything below them,
+    under `parent` (instance, id or None) in one transaction.
+    """
+    from api.models import Category
+
+    ids = [getattr(category, 'pk', category) for category in categories]
+    parent_id = getattr(parent, 'pk', parent)
+    with transaction.atomic():
+        Category.objects.filter(pk__in=ids).update(parent_id=parent_id)
+        for category_id in ids:
+            relink(category_id, parent_id)
+            catalog_cache.invalidate('category', category_id)
+        catalog_cache.invalidate('category')
+        facets.invalidate()
+
+
+def build_tree(rows):
+    """
+    Nest category payloads (dicts with 'id' and 'parent') under 'children',
+    keeping their order; returns the top-level ones.
+    """
+    nodes = {str(row['id']): {**row, 'children': []} for row in rows}
+    roots = []
+    for node in nodes.values():
+        parent = nodes.get(str(node['parent'])) if node['parent'] is not None else None
+        (parent['children'] if parent is not None else roots).append(node)
+    return roots
@@ -0,0 +1,86 @@
+import hashlib
+
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date
+
+from api.utils.stats import register
+from api.utils.versions import bump_version_on_commit, get_cache, get_versions, stamp_time
+
+
+# Per endpoint family, `<entity>_requests` and `<entity>_not_modified` count
+# alongside the totals; their ratio is the share answered with a 304.
+stats = register('conditional_get', 'requests', 'not_modified')
+
+ORDER_PRODUCTS_TIMEOUT = 24 * 60 * 60
+
+
+def orders_version_name(user_id):
+    return f'orders:{user_id}'
+
+
+def orders_changed(user_id):
+    bump_version_on_commit(orders_version_name(user_id))
+
+
+def order_history_names(user_id):
+    """
+    Version stamps a user's order history is built from: their own, bumped
+    whenever one of their orders changes, and those of the products in the
+    orders, whose current variants the history shows. The product ids are
+    kept in the cache under the user's stamp.
+    """
+    from api.models import OrderItem
+
+    name = orders_version_name(user_id)
+    key = f'order-products:{user_id}:{get_versions([name])[name]}'
+    product_ids = get_cache().get(key)
+    if product_ids is None:
+        product_ids = [
+            str(pk) for pk in OrderItem.objects.filter(order__user_id=user_id)
+            .values_list('product__product_id', flat=True).distinct()
+        ]
+        get_cache().set(key, product_ids, ORDER_PRODUCTS_TIMEOUT)
+    return [name] + [f'product:{pk}' for pk in product_ids]
+
+
+def validators(names, variant=''):
+    """
+    Weak ETag and Last-Modified (a Unix time, or None) of a response that
+    depends only on `variant` (its URL and format, say) and the version
+    stamps `names`.
+    """
+    stamps = get_versions(names)
+    digest = hashlib.md5(variant.encode())
+    for name in names:
+        digest.update(f'\n{name}={stamps[name]}'.encode())
+    times = [stamp_time(stamp) for stamp in stamps.values()]
+    last_modified = max(times) if times and None not in times else None
+    return f'W/"{digest.hexdigest()}"', last_modified
+
+
+def evaluate(request, entity, etag, last_modified):
+    """
+    A 304 when the request's If-None-Match (or, without one,
+    If-Modified-Since) still matches; otherwise None.
+    """
+    stats.incr('requests')
+    stats.incr(f'{entity}_requests')
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None or response.status_code != 304:
+        return None
+    stats.incr('not_modified')
+    stats.incr(f'{entity}_not_modified')
+    return response
+
+
+def set_headers(response, etag, last_modified, private=False):
+    response['ETag'] = etag
+    if last_modified is not None:
+        response['Last-Modified'] = http_date(last_modified)
+    # Have clients revalidate every time instead of guessing a freshness
+    # lifetime from Last-Modified.
+    if private:
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['Authorization'])
+    else:
+        patch_cache_control(response, no_cache=True)
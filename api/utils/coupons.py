@@ -0,0 +1,102 @@
+import bisect
+import threading
+from collections import namedtuple
+
+from api.utils.stats import register
+from api.utils.versions import bump_version_on_commit, get_version
+
+
+stats = register('coupons', 'lookups', 'reloads')
+
+VERSION = 'coupons'
+
+ActiveCoupon = namedtuple('ActiveCoupon', ['code', 'discount_amount', 'minimum_amount'])
+
+_lock = threading.Lock()
+_index = None
+_loaded_version = None
+
+
+def normalize(code):
+    return str(code).strip().upper()
+
+
+def invalidate():
+    """
+    Tell every worker to reload its coupons on next use. Signals call this on
+    save/delete; call it directly after bulk writes, which send no signals.
+    """
+    bump_version_on_commit(VERSION)
+
+
+class CouponIndex:
+    """
+    Active coupons by normalized code, plus the same coupons sorted by
+    minimum amount so the ones a subtotal qualifies for are a prefix found
+    by bisection. `best[i]` is the biggest discount among the first i + 1.
+    """
+
+    def __init__(self, coupons):
+        self.by_code = {coupon.code: coupon for coupon in coupons}
+        self.ordered = sorted(self.by_code.values(), key=lambda coupon: coupon.minimum_amount)
+        self.minimums = [coupon.minimum_amount for coupon in self.ordered]
+        self.best = []
+        for coupon in self.ordered:
+            if not self.best or coupon.discount_amount > self.best[-1].discount_amount:
+                self.best.append(coupon)
+            else:
+                self.best.append(self.best[-1])
+
+    def get(self, code):
+        return self.by_code.get(normalize(code))
+
+    def applicable(self, subtotal):
+        return self.ordered[:bisect.bisect_right(self.minimums, subtotal)]
+
+    def best_for(self, subtotal):
+        count = bisect.bisect_right(self.minimums, subtotal)
+        return self.best[count - 1] if count else None
+
+
+def get_index():
+    """
+    The index of active coupons, reloaded when another worker (or this one)
+    has bumped the version since it was last built.
+    """
+    global _index, _loaded_version
+
+    version = get_version(VERSION)
+    if version == _loaded_version:
+        return _index
+
+    with _lock:
+        if version != _loaded_version:
+            from api.models import Coupon
+
+            rows = Coupon.objects.filter(active=True).values_list('code', 'discount_amount', 'minimum_amount')
+            # Readers keep using the old index until the new one is swapped in.
+            _index = CouponIndex([ActiveCoupon(normalize(code), *amounts) for code, *amounts in rows])
+            _loaded_version = version
+            stats.incr('reloads')
+        return _index
+
+
+def lookup(code):
+    """
+    The active coupon for `code`, or None.
+    """
+    stats.incr('lookups')
+    return get_index().get(code)
+
+
+def applicable(subtotal):
+    """
+    Coupons a cart with this subtotal qualifies for, biggest discount first.
+    """
+    stats.incr('lookups')
+    return sorted(get_index().applicable(subtotal), key=lambda coupon: -coupon.discount_amount)
+
+
+def best_for(subtotal):
+    stats.incr('lookups')
+    return get_index().best_for(subtotal)
@@ -0,0 +1,319 @@
+import itertools
+import math
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import Count
+
+from api.utils import jobs
+from api.utils.stats import register
+from api.utils.versions import bump_version_on_commit, get_version
+
+
+stats = register('delivery_assignment', 'assigned', 'unassigned', 'index_builds', 'reassigned')
+
+VERSION = 'delivery_riders'
+OPEN_STATUSES = ('pending', 'assigned', 'out_for_delivery')
+# Deliveries a rider hasn't picked up yet; these move when the rider goes offline.
+REASSIGNABLE_STATUSES = ('pending', 'assigned')
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = 111.19
+
+
+def get_capacity():
+    return getattr(settings, 'DELIVERY_RIDER_CAPACITY', 5)
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+class RiderIndex:
+    """
+    Uniform grid over rider positions. Only riders with spare capacity are
+    kept in the grid, so a lookup never has to step over full riders and
+    costs roughly the number of riders in the cells around the destination.
+    Riders without coordinates are only used when nobody in the grid is.
+    """
+
+    def __init__(self, riders, loads, capacity, cell_size=None):
+        self.cell_size = cell_size or getattr(settings, 'DELIVERY_GRID_CELL_DEGREES', 0.02)
+        self.capacity = capacity
+        self.positions = {}
+        self.loads = defaultdict(int, loads)
+        self.cells = defaultdict(set)
+        self.unplaced = set()
+        self.bounds = None
+        for rider_id, latitude, longitude in riders:
+            if latitude is None or longitude is None:
+                self.positions[rider_id] = None
+            else:
+                self.positions[rider_id] = (latitude, longitude)
+            self._place(rider_id)
+
+    def _cell(self, latitude, longitude):
+        return (math.floor(latitude / self.cell_size), math.floor(longitude / self.cell_size))
+
+    def _place(self, rider_id):
+        position = self.positions[rider_id]
+        if self.loads[rider_id] >= self.capacity:
+            return
+        if position is None:
+            self.unplaced.add(rider_id)
+            return
+        cell = self._cell(*position)
+        self.cells[cell].add(rider_id)
+        if self.bounds is None:
+            self.bounds = [cell[0], cell[0], cell[1], cell[1]]
+        else:
+            self.bounds = [
+                min(self.bounds[0], cell[0]), max(self.bounds[1], cell[0]),
+                min(self.bounds[2], cell[1]), max(self.bounds[3], cell[1]),
+            ]
+
+    def _unplace(self, rider_id):
+        self.unplaced.discard(rider_id)
+        position = self.positions.get(rider_id)
+        if position is not None:
+            cell = self._cell(*position)
+            self.cells[cell].discard(rider_id)
+            if not self.cells[cell]:
+                del self.cells[cell]
+
+    def __contains__(self, rider_id):
+        return rider_id in self.positions
+
+    def set_load(self, rider_id, load):
+        if rider_id not in self.positions:
+            return
+        self._unplace(rider_id)
+        self.loads[rider_id] = load
+        self._place(rider_id)
+
+    def remove(self, rider_id):
+        self._unplace(rider_id)
+        self.positions.pop(rider_id, None)
+        self.loads.pop(rider_id, None)
+
+    def nearest(self, latitude, longitude, k=1, exclude=()):
+        """
+        Up to `k` rider ids with spare capacity, nearest first.
+        """
+        if latitude is None or longitude is None or not self.cells:
+            # Nothing to measure from: any rider with spare capacity will do.
+            spare = itertools.chain(self.unplaced, itertools.chain.from_iterable(self.cells.values()))
+            return list(itertools.islice((rider_id for rider_id in spare if rider_id not in exclude), k))
+
+        row, col = self._cell(latitude, longitude)
+        # Lower bound on the distance to anything `ring` cells away; the
+        # longitude side of a cell is the short one away from the equator.
+        cell_km = self.cell_size * KM_PER_DEGREE * max(math.cos(math.radians(latitude)), 0.01)
+        max_ring = max(
+            abs(row - self.bounds[0]), abs(row - self.bounds[1]),
+            abs(col - self.bounds[2]), abs(col - self.bounds[3]),
+        )
+
+        found = []
+        ring = 0
+        while ring <= max_ring:
+            if len(found) >= k and found[k - 1][0] < (ring - 1) * cell_km:
+                break
+            for cell in self._ring(row, col, ring):
+                for rider_id in self.cells.get(cell, ()):
+                    if rider_id not in exclude:
+                        found.append((distance_km(latitude, longitude, *self.positions[rider_id]), rider_id))
+            found.sort()
+            ring += 1
+
+        result = [rider_id for _, rider_id in found[:k]]
+        if len(result) < k:
+            result += [rider_id for rider_id in self.unplaced if rider_id not in exclude][:k - len(result)]
+        return result
+
+    @staticmethod
+    def _ring(row, col, ring):
+        if ring == 0:
+            yield (row, col)
+            return
+        for offset in range(-ring, ring + 1):
+            yield (row - ring, col + offset)
+            yield (row + ring, col + offset)
+        for offset in range(-ring + 1, ring):
+            yield (row + offset, col - ring)
+            yield (row + offset, col + ring)
+
+
+_lock = threading.RLock()
+_index = None
+_index_version = None
+_index_built_at = 0.0
+_dirty = set()
+
+
+def invalidate():
+    bump_version_on_commit(VERSION)
+
+
+def is_indexed(rider_id):
+    return _index is not None and rider_id in _index
+
+
+def mark_dirty(rider_id):
+    """
+    The rider's load changed outside the engine (e.g. a delivery completed);
+    it is re-counted on the next lookup.
+    """
+    _dirty.add(rider_id)
+
+
+def _open_loads(rider_ids=None):
+    from api.models import Delivery
+
+    deliveries = Delivery.objects.filter(delivery_status__in=OPEN_STATUSES, delivery_person__isnull=False)
+    if rider_ids is not None:
+        deliveries = deliveries.filter(delivery_person__in=rider_ids)
+    return dict(
+        deliveries.values('delivery_person').annotate(load=Count('id')).values_list('delivery_person', 'load')
+    )
+
+
+def build_index():
+    from django.contrib.auth import get_user_model
+
+    User = get_user_model()
+    riders = (
+        User.objects.filter(user_role='Delivery_Person', is_active=True, is_available=True)
+        .values_list('id', 'addresses__latitude', 'addresses__longitude', 'addresses__is_default')
+    )
+    positions = {}
+    for rider_id, latitude, longitude, is_default in riders:
+        # Prefer the rider's default address; otherwise any address with coordinates.
+        if rider_id not in positions or (is_default and latitude is not None) or positions[rider_id][0] is None:
+            positions[rider_id] = (latitude, longitude)
+    stats.incr('index_builds')
+    return RiderIndex(
+        [(rider_id, *position) for rider_id, position in positions.items()], _open_loads(), get_capacity()
+    )
+
+
+def get_index():
+    """
+    The process-local rider index, rebuilt when riders or their addresses
+    change (version stamp) and at least every DELIVERY_INDEX_TTL seconds so
+    loads changed by other workers are picked up.
+    """
+    global _index, _index_version, _index_built_at
+
+    version = get_version(VERSION)
+    ttl = getattr(settings, 'DELIVERY_INDEX_TTL', 60)
+    with _lock:
+        if _index is None or version != _index_version or time.monotonic() - _index_built_at > ttl:
+            _index = build_index()
+            _index_version = version
+            _index_built_at = time.monotonic()
+            _dirty.clear()
+        elif _dirty:
+            dirty = [rider_id for rider_id in list(_dirty) if rider_id in _index]
+            _dirty.clear()
+            loads = _open_loads(dirty)
+            for rider_id in dirty:
+                _index.set_load(rider_id, loads.get(rider_id, 0))
+        return _index
+
+
+def choose_rider(latitude, longitude, exclude=(), candidates=5):
+    """
+    Nearest rider under capacity, or None. The index proposes the nearest few
+    and their loads are re-counted in one query, since other workers may
+    have handed them orders since the index was built.
+    """
+    index = get_index()
+    exclude = set(exclude)
+    while True:
+        with _lock:
+            proposed = index.nearest(latitude, longitude, k=candidates, exclude=exclude)
+        if not proposed:
+            stats.incr('unassigned')
+            return None
+
+        loads = _open_loads(proposed)
+        with _lock:
+            for rider_id in proposed:
+                if loads.get(rider_id, 0) < index.capacity:
+                    index.set_load(rider_id, loads.get(rider_id, 0) + 1)
+                    stats.incr('assigned')
+                    return rider_id
+                index.set_load(rider_id, loads.get(rider_id, 0))
+
+        # Every proposed rider turned out to be full. They are out of the grid
+        # now, so the next proposal comes from further out.
+        exclude.update(proposed)
+
+
+def hold_rider(rider_id):
+    """
+    Lock the rider until the transaction ends and say whether the rider is
+    still under capacity, counting after the lock. Assignments to one rider
+    in separate transactions queue behind each other this way rather than
+    all count the same load, which is how choose_rider() alone can take a
+    rider past capacity. The lock is select_for_update() on the rider's
+    row; SQLite has none, and there the write lock every transaction opens
+    with (transaction_mode in settings) already keeps them apart.
+    """
+    from django.contrib.auth import get_user_model
+
+    list(get_user_model().objects.select_for_update().filter(pk=rider_id).values_list('pk'))
+    load = _open_loads([rider_id]).get(rider_id, 0)
+    if load < get_capacity():
+        return True
+    with _lock:
+        if _index is not None:
+            _index.set_load(rider_id, load)
+    return False
+
+
+def reassign_rider(rider):
+    """
+    Hand the rider's not-yet-picked-up deliveries to the nearest other riders
+    with spare capacity. Those nobody can take go back to pending, with an
+    assign_delivery job (api/tasks.py) to keep trying. Returns the number
+    of deliveries moved.
+    """
+    from api.models import Address, Delivery
+
+    deliveries = list(
+        Delivery.objects.filter(delivery_person=rider, delivery_status__in=REASSIGNABLE_STATUSES)
+        .select_related('order')
+    )
+    if not deliveries:
+        return 0
+
+    coordinates = {}
+    addresses = Address.objects.filter(user__in={d.order.user_id for d in deliveries}).order_by('is_default')
+    for address in addresses:
+        # Default addresses come last and win.
+        coordinates[address.user_id] = (address.latitude, address.longitude)
+
+    with _lock:
+        if _index is not None:
+            _index.remove(rider.pk)
+
+    moved = []
+    for delivery in deliveries:
+        latitude, longitude = coordinates.get(delivery.order.user_id, (None, None))
+        delivery.delivery_person_id = choose_rider(latitude, longitude, exclude=(rider.pk,))
+        if delivery.delivery_person_id is None:
+            delivery.delivery_status = 'pending'
+        moved.append(delivery)
+
+    Delivery.objects.bulk_update(moved, ['delivery_person', 'delivery_status'])
+    for delivery in moved:
+        if delivery.delivery_person_id is None and not jobs.pending('assign_delivery', str(delivery.order_id)):
+            jobs.enqueue('assign_delivery', str(delivery.order_id))
+    stats.incr('reassigned', len(moved))
+    return len(moved)
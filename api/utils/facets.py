@@ -0,0 +1,345 @@
+import bisect
+import random
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from api.utils import tags
+from api.utils.stats import register
+from api.utils.versions import bump_version, bump_version_on_commit, get_cache, get_version
+
+
+stats = register('facets', 'queries', 'rebuilds', 'updates')
+
+# Bumped to make every worker rebuild its index from scratch: after bulk
+# writes, category changes, or when the change log below is lost.
+VERSION = 'facets'
+
+FACETS = ('brand', 'tag', 'category', 'price', 'availability')
+# Facets whose values keep their natural order in the counts instead of
+# being sorted by count.
+ORDERED_FACETS = ('price', 'availability')
+AVAILABILITY = ('in_stock', 'out_of_stock')
+
+# Products changed since a worker built its index are replayed from a log
+# in the cache, one numbered entry per committed write, under the current
+# VERSION stamp. A worker further behind than this rebuilds instead.
+# Numbering starts at a random point, so a log restarted after its head
+# was evicted can't be mistaken for the one a worker was following.
+MAX_REPLAY = 1000
+LOG_TIMEOUT = 24 * 60 * 60
+
+_lock = threading.Lock()
+_index = None
+_loaded_version = None
+_applied = 0
+
+
+def get_price_bands():
+    return tuple(getattr(settings, 'FACET_PRICE_BANDS', (100, 250, 500, 1000)))
+
+
+def band_labels(bands):
+    bounds = (0,) + tuple(bands)
+    return [f'{lower}-{upper}' for lower, upper in zip(bounds, bounds[1:])] + [f'{bounds[-1]}+']
+
+
+def _bitset(slots, size):
+    buffer = bytearray((size + 7) // 8)
+    for slot in slots:
+        buffer[slot >> 3] |= 1 << (slot & 7)
+    return int.from_bytes(buffer, 'little')
+
+
+class FacetIndex:
+    """
+    Inverted index from facet values to the products having them, as
+    bitsets: each product gets a slot, and every (facet, value) an int with
+    the bits of its products set. Filtering is OR within a facet and AND
+    across facets, and a value's count under a filter is one AND and a
+    popcount. Unfiltered counts are kept up to date as products change.
+
+    Slots are handed out in creation order and only ever appended, so the
+    highest set bits of a result are its newest products.
+    """
+
+    def __init__(self, rows, ancestors, bands):
+        # Category slugs of each category and everything above it, so
+        # picking a category matches its whole subtree.
+        self.ancestors = ancestors
+        self.bands = bands
+        self.band_labels = band_labels(bands)
+        self.slots = {}
+        self.products = []
+        self.entries = {}
+        self.bits = {facet: defaultdict(int) for facet in FACETS}
+        self.totals = {facet: defaultdict(int) for facet in FACETS}
+        self.live = 0
+
+        # Setting bits one product at a time copies the growing ints over
+        # and over; collect each value's slots first and build it once.
+        slots = {facet: defaultdict(list) for facet in FACETS}
+        for row in rows:
+            slot = self.slots[row['product_id']] = len(self.products)
+            self.products.append(row['product_id'])
+            entries = self.entries[slot] = tuple(self._entries(row))
+            for facet, value in entries:
+                slots[facet][value].append(slot)
+        for facet, values in slots.items():
+            for value, members in values.items():
+                self.bits[facet][value] = _bitset(members, len(self.products))
+                self.totals[facet][value] = len(members)
+        self.live = _bitset(self.entries, len(self.products))
+
+    def _entries(self, row):
+        if row['brand']:
+            yield 'brand', row['brand']
+        for tag in row['tags']:
+            yield 'tag', tag
+        for slug in self.ancestors.get(row['category_id'], ()):
+            yield 'category', slug
+        if row['min_price'] is not None:
+            yield 'price', self.band_labels[bisect.bisect_right(self.bands, row['min_price'])]
+        yield 'availability', AVAILABILITY[0] if row['in_stock'] else AVAILABILITY[1]
+
+    def add(self, row):
+        """
+        Index (or re-index) a listing row.
+        """
+        product_id = row['product_id']
+        slot = self.slots.get(product_id)
+        if slot is None:
+            slot = self.slots[product_id] = len(self.products)
+            self.products.append(product_id)
+        else:
+            self._clear(slot)
+        bit = 1 << slot
+        entries = self.entries[slot] = tuple(self._entries(row))
+        for facet, value in entries:
+            self.bits[facet][value] |= bit
+            self.totals[facet][value] += 1
+        self.live |= bit
+
+    def remove(self, product_id):
+        # The slot stays reserved, so cursors pointing at it keep working.
+        slot = self.slots.get(product_id)
+        if slot is not None:
+            self._clear(slot)
+
+    def _clear(self, slot):
+        bit = 1 << slot
+        for facet, value in self.entries.pop(slot, ()):
+            self.bits[facet][value] &= ~bit
+            self.totals[facet][value] -= 1
+            if not self.totals[facet][value]:
+                del self.bits[facet][value]
+                del self.totals[facet][value]
+        self.live &= ~bit
+
+    def __len__(self):
+        return len(self.entries)
+
+    def select(self, selected):
+        """
+        `selected` maps facets to the values picked in them. Returns the
+        matching products' bitset and each facet's value counts, the latter
+        filtered by every other facet's selection so a client can offer
+        alternatives to what it already picked.
+        """
+        masks = {}
+        for facet, values in selected.items():
+            if values:
+                bits = self.bits[facet]
+                masks[facet] = 0
+                for value in values:
+                    masks[facet] |= bits.get(value, 0)
+
+        matched = self.live
+        for mask in masks.values():
+            matched &= mask
+
+        counts = {}
+        for facet in FACETS:
+            others = [mask for other, mask in masks.items() if other != facet]
+            if not others:
+                counts[facet] = dict(self.totals[facet])
+                continue
+            scope = self.live
+            for mask in others:
+                scope &= mask
+            counts[facet] = {}
+            if scope:
+                for value, bits in self.bits[facet].items():
+                    count = (bits & scope).bit_count()
+                    if count:
+                        counts[facet][value] = count
+        return matched, counts
+
+    def page(self, matched, size, after=None):
+        """
+        Up to `size` product ids from `matched`, newest first, starting
+        below the slot of product `after`. Raises KeyError for a product
+        the index has never seen.
+        """
+        if after is not None:
+            matched &= (1 << self.slots[after]) - 1
+        product_ids = []
+        while matched and len(product_ids) < size:
+            slot = matched.bit_length() - 1
+            product_ids.append(self.products[slot])
+            matched ^= 1 << slot
+        return product_ids, bool(matched)
+
+
+def invalidate():
+    """
+    Make every worker rebuild its index. Call after bulk writes, which send
+    no signals.
+    """
+    bump_version_on_commit(VERSION)
+
+
+def changed(product_ids=(), variant_ids=()):
+    """
+    Log products (or the products owning variants) whose listing changed,
+    once the current transaction commits, for every worker to re-index.
+    """
+    product_ids, variant_ids = list(product_ids), list(variant_ids)
+    if product_ids or variant_ids:
+        transaction.on_commit(lambda: _log(product_ids, variant_ids))
+
+
+def _head_key(version):
+    return f'facets:{version}:head'
+
+
+def _entry_key(version, number):
+    return f'facets:{version}:{number}'
+
+
+def _log(product_ids, variant_ids):
+    cache = get_cache()
+    version = get_version(VERSION)
+    try:
+        number = cache.incr(_head_key(version))
+    except ValueError:
+        # The log is gone (evicted, or nobody has built an index under this
+        # version yet); changes can't be replayed, so rebuild.
+        bump_version(VERSION)
+        return
+    cache.set(_entry_key(version, number), (product_ids, variant_ids), LOG_TIMEOUT)
+
+
+def _rows():
+    from api.models import ProductListing
+
+    return ProductListing.objects.values('product_id', 'brand', 'category_id', 'min_price', 'in_stock')
+
+
+def _with_tags(rows, product_ids):
+    names = tags.names_by_product(product_ids)
+    for row in rows:
+        row['tags'] = names.get(row['product_id'], ())
+        yield row
+
+
+def build_index():
+    from api.models import CategoryClosure
+
+    ancestors = defaultdict(list)
+    for category_id, slug in CategoryClosure.objects.values_list('descendant_id', 'ancestor__slug'):
+        ancestors[category_id].append(slug)
+    stats.incr('rebuilds')
+    rows = _with_tags(_rows().order_by('created_at', 'product_id').iterator(), _rows().values('product_id'))
+    return FacetIndex(rows, ancestors, get_price_bands())
+
+
+def _replay(index, entries):
+    from api.models import ProductVariant
+
+    product_ids, variant_ids = set(), set()
+    for changed_products, changed_variants in entries:
+        product_ids.update(changed_products)
+        variant_ids.update(changed_variants)
+    owners = ProductVariant.objects.filter(pk__in=variant_ids).values('product_id')
+    rows = list(_rows().filter(Q(product_id__in=product_ids) | Q(product_id__in=owners)))
+    seen = set()
+    for row in _with_tags(rows, [row['product_id'] for row in rows]):
+        index.add(row)
+        seen.add(row['product_id'])
+    # Deleted or deactivated products no longer have a listing.
+    for product_id in product_ids - seen:
+        index.remove(product_id)
+    stats.incr('updates', len(product_ids) + len(variant_ids))
+
+
+def get_index():
+    """
+    The process-local facet index. Changes logged by any worker since it was
+    last brought up to date are replayed into it; it is rebuilt when the
+    version is bumped or the log can't be replayed.
+    """
+    global _index, _loaded_version, _applied
+
+    cache = get_cache()
+    version = get_version(VERSION)
+    head = cache.get(_head_key(version))
+    if _index is not None and version == _loaded_version and head == _applied:
+        return _index
+
+    with _lock:
+        head = cache.get(_head_key(version))
+        if _index is not None and version == _loaded_version and head is not None and _applied <= head:
+            if head == _applied:
+                return _index
+            if head - _applied <= MAX_REPLAY:
+                keys = [_entry_key(version, number) for number in range(_applied + 1, head + 1)]
+                entries = cache.get_many(keys)
+                if len(entries) == len(keys):
+                    _replay(_index, [entries[key] for key in keys])
+                    _applied = head
+                    return _index
+
+        # Start the log before reading the rows, so changes committed while
+        # building are replayed on the next call rather than missed.
+        cache.add(_head_key(version), random.randrange(1 << 40), None)
+        head = cache.get(_head_key(version)) or 0
+        _index = build_index()
+        _loaded_version = version
+        _applied = head
+        return _index
+
+
+def _ordered_values(facet, counts, index):
+    if facet == 'price':
+        return [band for band in index.band_labels if band in counts]
+    if facet == 'availability':
+        return [value for value in AVAILABILITY if value in counts]
+    return sorted(counts, key=lambda value: (-counts[value], value))
+
+
+def search(selected, size, after=None, limit=None):
+    """
+    One page of product ids matching `selected` (facet -> values picked in
+    it), whether there are more, the total and the counts of each facet's
+    values as [{'value', 'count'}] lists. Price bands and availability keep
+    their natural order; other facets list their `limit` biggest values,
+    plus any picked ones.
+    """
+    stats.incr('queries')
+    index = get_index()
+    with _lock:
+        matched, counts = index.select(selected)
+        product_ids, more = index.page(matched, size, after)
+
+    facets = {}
+    for facet in FACETS:
+        values = _ordered_values(facet, counts[facet], index)
+        if limit is not None and facet not in ORDERED_FACETS:
+            picked = [value for value in selected.get(facet, ()) if value in counts[facet]]
+            values = values[:limit] + [value for value in picked if value not in values[:limit]]
+        facets[facet] = [{'value': value, 'count': counts[facet][value]} for value in values]
+    return product_ids, more, matched.bit_count(), facets
@@ -0,0 +1,163 @@
+"""
+`Idempotency-Key` support: a request carrying a key runs once per user and
+key, and retries get the stored response back without running anything.
+
+The first request claims the key by inserting its IdempotencyKey row; a
+duplicate that arrives while it's running waits for it to finish (up to
+WAIT seconds, then gets a 409). Only successful responses are kept: after
+an error the claim is dropped, so a retry with the same key runs again. A
+claim whose request died without finishing is taken over once it's older
+than LOCK_TIMEOUT.
+"""
+import hashlib
+import json
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.response import Response
+
+from api.utils.stats import register
+
+
+stats = register('idempotency', 'requests', 'replayed', 'waits', 'conflicts', 'takeovers')
+
+HEADER = 'Idempotency-Key'
+MAX_LENGTH = 255
+LOCK_TIMEOUT = 60
+WAIT = 5
+WAIT_INTERVAL = 0.05
+PURGE_BATCH_SIZE = 5000
+
+
+def get_ttl():
+    return getattr(settings, 'IDEMPOTENCY_KEY_TTL', 24 * 60 * 60)
+
+
+def fingerprint(request):
+    body = json.dumps(request.data, sort_keys=True, default=str)
+    return hashlib.sha256(f'{request.method} {request.path}\n{body}'.encode()).hexdigest()
+
+
+def _replay(record):
+    response = Response(record.response_body, status=record.response_status)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def _claim(user, key, digest):
+    """
+    The IdempotencyKey row this request now owns, or the response to send
+    instead of running it.
+    """
+    from api.models import IdempotencyKey
+
+    deadline = time.monotonic() + WAIT
+    while True:
+        # Looked up first: in a retry storm most requests are replays, and
+        # that makes each one a single read.
+        record = IdempotencyKey.objects.filter(user=user, key=key).first()
+        if record is None:
+            try:
+                with transaction.atomic():
+                    return IdempotencyKey.objects.create(
+                        user=user, key=key, fingerprint=digest, locked_at=timezone.now()
+                    )
+            except IntegrityError:
+                # Claimed by a duplicate in between.
+                continue
+        if record.fingerprint != digest:
+            return Response(
+                {'error': f'{HEADER} was already used for a different request'},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            )
+        if record.response_status is not None:
+            stats.incr('replayed')
+            return _replay(record)
+
+        now = timezone.now()
+        if (now - record.locked_at).total_seconds() > LOCK_TIMEOUT:
+            taken = IdempotencyKey.objects.filter(
+                pk=record.pk, locked_at=record.locked_at, response_status__isnull=True
+            ).update(locked_at=now)
+            if taken:
+                stats.incr('takeovers')
+                record.locked_at = now
+                return record
+        if time.monotonic() >= deadline:
+            stats.incr('conflicts')
+            response = Response(
+                {'error': f'A request with this {HEADER} is still in progress'}, status=status.HTTP_409_CONFLICT
+            )
+            response['Retry-After'] = '1'
+            return response
+        stats.incr('waits')
+        time.sleep(WAIT_INTERVAL)
+
+
+def store(record, status_code, body):
+    """
+    Keep the response to replay for `record`'s key. Call it inside the
+    transaction that does the request's work, so the two commit together;
+    a no-op without a key.
+    """
+    if record is None:
+        return
+    record.response_status = status_code
+    record.response_body = body
+    record.save(update_fields=['response_status', 'response_body'])
+
+
+def run(request, handler):
+    """
+    The response to `request`, from `handler(record)` if it carries no key or
+    a key not seen before, and otherwise the stored one. `record` is the
+    claimed IdempotencyKey (None without a key) for handler to store() its
+    response on; a successful response it didn't store is stored after it.
+    """
+    from api.models import IdempotencyKey
+
+    key = request.headers.get(HEADER)
+    if key is None or not request.user.is_authenticated:
+        return handler(None)
+    if not key or len(key) > MAX_LENGTH:
+        return Response(
+            {'error': f'{HEADER} must be 1 to {MAX_LENGTH} characters'}, status=status.HTTP_400_BAD_REQUEST
+        )
+
+    stats.incr('requests')
+    record = _claim(request.user, key, fingerprint(request))
+    if not isinstance(record, IdempotencyKey):
+        return record
+
+    try:
+        response = handler(record)
+    except BaseException:
+        record.delete()
+        raise
+    if not status.is_success(response.status_code):
+        record.delete()
+    elif record.response_status is None:
+        store(record, response.status_code, response.data)
+    return response
+
+
+def purge(older_than=None):
+    """
+    Delete the keys older than `older_than` seconds (the TTL by default), a
+    batch at a time so no one statement holds its locks for long. Returns
+    the number deleted.
+    """
+    from api.models import IdempotencyKey
+
+    cutoff = timezone.now() - timedelta(seconds=get_ttl() if older_than is None else older_than)
+    expired = IdempotencyKey.objects.filter(created_at__lt=cutoff).values_list('pk', flat=True)
+    deleted = 0
+    while True:
+        batch = list(expired[:PURGE_BATCH_SIZE])
+        if not batch:
+            return deleted
+        deleted += IdempotencyKey.objects.filter(pk__in=batch).delete()[0]
@@ -0,0 +1,146 @@
+import hashlib
+import io
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from PIL import Image, ImageOps, features
+
+from api.utils import catalog_cache
+from api.utils.stats import register
+
+
+logger = logging.getLogger(__name__)
+stats = register('image_derivatives', 'generated', 'skipped', 'missing', 'failed')
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_widths():
+    return tuple(getattr(settings, 'IMAGE_DERIVATIVE_WIDTHS', (160, 320, 640, 1024)))
+
+
+def get_formats():
+    # AVIF needs a Pillow built with libavif; WebP is always produced.
+    formats = ['webp']
+    if features.check('avif'):
+        formats.append('avif')
+    return formats
+
+
+def derivative_name(name, digest, width, fmt):
+    root, _ = os.path.splitext(name)
+    return f'{root}.{digest}.w{width}.{fmt}'
+
+
+def generate(name, force=False):
+    """
+    Write resized copies of the stored image `name` next to it and return
+    {'source': name, <format>: {<width>: <storage name>}}. Names carry a hash
+    of the original's content, so re-running for the same upload reuses the
+    files already written, unless `force` overwrites them.
+    """
+    with default_storage.open(name, 'rb') as handle:
+        content = handle.read()
+    digest = hashlib.sha256(content).hexdigest()[:12]
+
+    with Image.open(io.BytesIO(content)) as original:
+        original = ImageOps.exif_transpose(original)
+        if original.mode not in ('RGB', 'RGBA'):
+            original = original.convert('RGBA' if 'A' in original.mode or 'transparency' in original.info else 'RGB')
+        widths = [width for width in get_widths() if width < original.width] or [original.width]
+
+        derivatives = {'source': name}
+        for fmt in get_formats():
+            derivatives[fmt] = {}
+            for width in widths:
+                target = derivative_name(name, digest, width, fmt)
+                exists = default_storage.exists(target)
+                if exists and not force:
+                    stats.incr('skipped')
+                else:
+                    if exists:
+                        default_storage.delete(target)
+                    resized = original.copy()
+                    resized.thumbnail((width, original.height), Image.LANCZOS)
+                    buffer = io.BytesIO()
+                    options = {'method': 4} if fmt == 'webp' else {}
+                    resized.save(buffer, format=fmt.upper(), quality=80, **options)
+                    target = default_storage.save(target, ContentFile(buffer.getvalue()))
+                    stats.incr('generated')
+                derivatives[fmt][str(width)] = target
+    return derivatives
+
+
+def needs_derivatives(image_field, derivatives):
+    return bool(image_field) and (derivatives or {}).get('source') != image_field.name
+
+
+def store(model, pk, derivatives):
+    """
+    Save generated derivatives, unless the image was replaced meanwhile.
+    """
+    updated = model.objects.filter(pk=pk, image=derivatives['source']).update(image_derivatives=derivatives)
+    if updated:
+        if model._meta.model_name == 'productimage':
+            product_id = model.objects.filter(pk=pk).values_list('product_id', flat=True).first()
+            catalog_cache.invalidate('product', product_id)
+        else:
+            catalog_cache.invalidate('category', pk)
+            catalog_cache.invalidate('category')
+    return updated
+
+
+def process(model, pk):
+    try:
+        name = model.objects.filter(pk=pk).values_list('image', flat=True).first()
+        if not name:
+            return
+        if not default_storage.exists(name):
+            # Rows pointing at files that were never uploaded (fixtures, copied databases).
+            stats.incr('missing')
+            return
+        store(model, pk, generate(name))
+    except Exception:
+        stats.incr('failed')
+        raise
+
+
+def _process_in_worker(model, pk):
+    try:
+        process(model, pk)
+    except Exception:
+        logger.exception('Could not generate derivatives for %s %s', model.__name__, pk)
+    finally:
+        # Pool threads outlive the job; don't leave their connections open.
+        connections.close_all()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'IMAGE_DERIVATIVE_WORKERS', 2), thread_name_prefix='image-derivatives'
+            )
+        return _executor
+
+
+def schedule(model, pk):
+    """
+    Generate derivatives once the current transaction commits, in the worker
+    pool (or inline when IMAGE_DERIVATIVES_ASYNC is off).
+    """
+    def run():
+        if getattr(settings, 'IMAGE_DERIVATIVES_ASYNC', True):
+            get_executor().submit(_process_in_worker, model, pk)
+        else:
+            process(model, pk)
+
+    transaction.on_commit(run)
@@ -0,0 +1,44 @@
+from collections import Counter
+
+from django.db.models import Case, F, IntegerField, Value, When
+
+from api.models import ProductVariant
+from api.utils import catalog_cache, listings
+
+
+class InsufficientStock(Exception):
+    def __init__(self, variant_ids):
+        self.variant_ids = sorted(variant_ids)
+        super().__init__('Insufficient stock')
+
+
+def reserve_stock(lines):
+    """
+    Take the quantities in `lines`, (variant id, quantity) pairs, out of
+    stock, all or nothing, in a single UPDATE. Must run inside the
+    transaction that creates the order so a failure rolls the order back
+    with it.
+    """
+    wanted = Counter()
+    for variant_id, quantity in lines:
+        wanted[variant_id] += quantity
+
+    quantity = Case(
+        *[When(pk=pk, then=Value(amount)) for pk, amount in wanted.items()],
+        output_field=IntegerField(),
+    )
+    # The stock condition is re-checked by the UPDATE itself, so a concurrent
+    # checkout that got there first makes this match fewer rows instead of
+    # driving stock negative.
+    updated = ProductVariant.objects.filter(pk__in=wanted, stock__gte=quantity).update(
+        stock=F('stock') - quantity
+    )
+    if updated != len(wanted):
+        # Nothing was changed; find the short lines for the error.
+        stock = dict(ProductVariant.objects.filter(pk__in=wanted).values_list('pk', 'stock'))
+        raise InsufficientStock([pk for pk, quantity in wanted.items() if stock.get(pk, 0) < quantity] or wanted)
+    # The UPDATE sends no signals; bring the listings' stock and the cached
+    # product payloads (and with them their ETags) up to date.
+    listings.sync_stock(wanted)
+    for product_id in set(ProductVariant.objects.filter(pk__in=wanted).values_list('product_id', flat=True)):
+        catalog_cache.invalidate('product', product_id)
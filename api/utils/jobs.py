@@ -0,0 +1,285 @@
+"""
+A small job queue kept in the database, for work that needn't hold up the
+request that causes it, such as the follow-up to a placed order.
+
+Tasks are registered by name with @task and queued with enqueue(). Call it
+inside the transaction whose work the job follows up on: the Job row then
+commits (or rolls back) with that work, so a job never runs ahead of it or
+for nothing. `manage.py run_jobs` runs the jobs. A worker claims a due job
+with a conditional UPDATE, so workers in any number of processes never
+both run one. A job runs in a transaction that also marks it done. One
+that raises is retried with exponential backoff until it's out of
+attempts, then left failed for inspection. A job still running past its
+task's timeout is taken to have died with its worker and queued again.
+If the original run finishes after all, it rolls back.
+"""
+import logging
+import random
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from api.utils.profiling import Histogram
+from api.utils.stats import register
+
+
+logger = logging.getLogger(__name__)
+
+stats = register('jobs', 'enqueued', 'claimed', 'succeeded', 'retried', 'failed', 'expired', 'lost')
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+# Due jobs looked at per claim, beyond the number wanted, in case others
+# take some first.
+CLAIM_SLACK = 10
+MAX_ERROR_LENGTH = 2000
+PURGE_BATCH_SIZE = 5000
+
+_tasks = {}
+
+
+class Task:
+
+    def __init__(self, name, func, max_attempts, timeout, concurrency):
+        self.name = name
+        self.func = func
+        self.max_attempts = max_attempts
+        self.timeout = timeout
+        self.concurrency = concurrency
+
+
+class LostClaim(Exception):
+    """
+    The job was taken back while running (it outran its timeout), so what it
+    did is rolled back.
+    """
+
+
+def task(name, max_attempts=5, timeout=60, concurrency=None):
+    """
+    Register the decorated function as the task `name`. It's called with
+    the job's args, which must be JSON. `timeout` is in seconds, and
+    `concurrency` caps the jobs of this task running at once across all
+    workers (approximately: two workers claiming at the same moment can
+    both take the last slot).
+    """
+    def decorator(func):
+        _tasks[name] = Task(name, func, max_attempts, timeout, concurrency)
+        return func
+    return decorator
+
+
+def get_tasks():
+    return dict(_tasks)
+
+
+def get_retry_delay(attempts):
+    # Seconds before retrying a job that failed `attempts` times: doubling
+    # from JOB_RETRY_BASE up to JOB_RETRY_MAX, with jitter so jobs that
+    # failed together don't all come back together.
+    base = getattr(settings, 'JOB_RETRY_BASE', 5)
+    delay = min(base * 2 ** (attempts - 1), getattr(settings, 'JOB_RETRY_MAX', 600))
+    return delay * random.uniform(1, 1.25)
+
+
+def get_retention():
+    return getattr(settings, 'JOB_RETENTION', 7 * 24 * 60 * 60)
+
+
+def enqueue(name, *args, delay=0):
+    """
+    Queue the task `name` to run with `args` in `delay` seconds (or as soon
+    as a worker is free). Returns the Job.
+    """
+    from api.models import Job
+
+    if name not in _tasks:
+        raise LookupError(f'No task named {name!r}')
+    job = Job.objects.create(
+        name=name, args=list(args), max_attempts=_tasks[name].max_attempts,
+        run_at=timezone.now() + timedelta(seconds=delay),
+    )
+    stats.incr('enqueued')
+    return job
+
+
+def pending(name, *args):
+    """
+    Whether a job of the task `name` with `args` is queued or running.
+    """
+    from api.models import Job
+
+    return Job.objects.filter(status__in=(QUEUED, RUNNING), name=name, args=list(args)).exists()
+
+
+def claim(worker, limit=1):
+    """
+    Up to `limit` due jobs, oldest due first, marked as running by
+    `worker`. Tasks at their concurrency limit are skipped.
+    """
+    from api.models import Job
+
+    running = dict(
+        Job.objects.filter(status=RUNNING).values('name').annotate(count=Count('id')).values_list('name', 'count')
+    )
+    full = [
+        name for name, count in running.items()
+        if name in _tasks and _tasks[name].concurrency is not None and count >= _tasks[name].concurrency
+    ]
+    due = (
+        Job.objects.filter(status=QUEUED, run_at__lte=timezone.now()).exclude(name__in=full)
+        .order_by('run_at').values_list('pk', 'name', 'run_at')
+    )
+
+    claimed = []
+    for pk, name, run_at in due[:limit + CLAIM_SLACK]:
+        if len(claimed) == limit:
+            break
+        current = _tasks.get(name)
+        if current is not None and current.concurrency is not None and running.get(name, 0) >= current.concurrency:
+            continue
+        now = timezone.now()
+        taken = Job.objects.filter(pk=pk, status=QUEUED).update(
+            status=RUNNING, locked_by=worker, attempts=F('attempts') + 1, started_at=now,
+            locked_until=now + timedelta(seconds=current.timeout if current else 60),
+            wait=max((now - run_at).total_seconds(), 0),
+        )
+        if taken:
+            claimed.append(pk)
+            running[name] = running.get(name, 0) + 1
+    stats.incr('claimed', len(claimed))
+    return list(Job.objects.filter(pk__in=claimed).order_by('run_at'))
+
+
+def execute(job):
+    """
+    Run a claimed job and record how it went. Returns True if it's done.
+    """
+    from api.models import Job
+
+    mine = Job.objects.filter(pk=job.pk, status=RUNNING, locked_by=job.locked_by, attempts=job.attempts)
+    started = time.monotonic()
+    try:
+        current = _tasks.get(job.name)
+        if current is None:
+            raise LookupError(f'No task named {job.name!r}')
+        with transaction.atomic():
+            current.func(*job.args)
+            if not mine.update(
+                status=DONE, finished_at=timezone.now(), duration=time.monotonic() - started,
+                locked_until=None, last_error='',
+            ):
+                raise LostClaim()
+    except LostClaim:
+        stats.incr('lost')
+        logger.warning('Job %s (%s) outran its timeout; rolled back', job.pk, job.name)
+        return False
+    except Exception as e:
+        duration = time.monotonic() - started
+        error = f'{type(e).__name__}: {e}'[:MAX_ERROR_LENGTH]
+        now = timezone.now()
+        if job.attempts >= job.max_attempts:
+            stats.incr('failed')
+            logger.exception('Job %s (%s) failed for good after %s attempts', job.pk, job.name, job.attempts)
+            mine.update(status=FAILED, finished_at=now, duration=duration, locked_until=None, last_error=error)
+        else:
+            stats.incr('retried')
+            logger.warning('Job %s (%s) failed, attempt %s: %s', job.pk, job.name, job.attempts, error)
+            mine.update(
+                status=QUEUED, run_at=now + timedelta(seconds=get_retry_delay(job.attempts)),
+                duration=duration, locked_until=None, last_error=error,
+            )
+        return False
+    stats.incr('succeeded')
+    return True
+
+
+def requeue_expired():
+    """
+    Take back jobs still running past their timeout: failed if that was
+    their last attempt, and otherwise due again now. Returns the number.
+    """
+    from api.models import Job
+
+    now = timezone.now()
+    expired = Job.objects.filter(status=RUNNING, locked_until__lt=now)
+    count = expired.filter(attempts__gte=F('max_attempts')).update(
+        status=FAILED, finished_at=now, locked_until=None, last_error='Timed out',
+    )
+    count += expired.update(status=QUEUED, run_at=now, locked_until=None, last_error='Timed out')
+    stats.incr('expired', count)
+    return count
+
+
+def run_pending(worker='inline', limit=None):
+    """
+    Run due jobs in this thread until there are none (or `limit` have run);
+    for tests and one-off draining. Returns the number run.
+    """
+    count = 0
+    while limit is None or count < limit:
+        batch = claim(worker, 1)
+        if not batch:
+            return count
+        execute(batch[0])
+        count += 1
+    return count
+
+
+def purge(older_than=None):
+    """
+    Delete finished jobs older than `older_than` seconds (JOB_RETENTION by
+    default), a batch at a time. Failed ones are kept. Returns the number
+    deleted.
+    """
+    from api.models import Job
+
+    cutoff = timezone.now() - timedelta(seconds=get_retention() if older_than is None else older_than)
+    finished = Job.objects.filter(status=DONE, finished_at__lt=cutoff).values_list('pk', flat=True)
+    deleted = 0
+    while True:
+        batch = list(finished[:PURGE_BATCH_SIZE])
+        if not batch:
+            return deleted
+        deleted += Job.objects.filter(pk__in=batch).delete()[0]
+
+
+def metrics(window=3600):
+    """
+    Per task: jobs by status, and for the jobs finished in the last `window`
+    seconds the wait from due to started and the run time, in milliseconds.
+    The latter cover the latest attempt of each job.
+    """
+    from api.models import Job
+
+    results = {}
+
+    def entry(name):
+        if name not in results:
+            results[name] = {
+                'queued': 0, 'running': 0, 'done': 0, 'failed': 0, 'finished': 0,
+                'wait_ms': Histogram(), 'run_ms': Histogram(),
+            }
+        return results[name]
+
+    for name, status, count in Job.objects.values('name', 'status').annotate(count=Count('id')).values_list(
+        'name', 'status', 'count'
+    ):
+        entry(name)[status] = count
+
+    since = timezone.now() - timedelta(seconds=window)
+    for name, wait, duration in Job.objects.filter(
+        status__in=(DONE, FAILED), finished_at__gte=since
+    ).values_list('name', 'wait', 'duration').iterator():
+        current = entry(name)
+        current['finished'] += 1
+        current['wait_ms'].add((wait or 0) * 1000)
+        current['run_ms'].add((duration or 0) * 1000)
+
+    for current in results.values():
+        current['wait_ms'] = current['wait_ms'].summary()
+        current['run_ms'] = current['run_ms'].summary()
+    return results
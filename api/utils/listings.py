@@ -0,0 +1,115 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Subquery, Sum
+
+from api.utils import facets
+from api.utils.order_calculator import discounted_price
+
+
+BATCH_SIZE = 2000
+
+
+def build(product_ids):
+    """
+    ProductListing rows (unsaved) for the active products among
+    `product_ids`, from three queries however many products there are.
+    """
+    from api.models import Product, ProductImage, ProductListing, ProductVariant
+
+    products = list(
+        Product.objects.filter(pk__in=product_ids, is_active=True)
+        .values('id', 'name', 'slug', 'brand', 'category_id', 'category__slug', 'created_at')
+    )
+    if not products:
+        return []
+    ids = [product['id'] for product in products]
+
+    variants = defaultdict(list)
+    for product_id, price, discount_percent, stock in ProductVariant.objects.filter(product_id__in=ids).values_list(
+        'product_id', 'price', 'discount_percent', 'stock'
+    ):
+        variants[product_id].append((discounted_price(price, discount_percent), discount_percent, stock))
+
+    images = {}
+    # Primary images sort last, so they win; otherwise the first image uploaded.
+    for product_id, image in ProductImage.objects.filter(product_id__in=ids).order_by('is_primary', '-id').values_list(
+        'product_id', 'image'
+    ):
+        images[product_id] = image
+
+    listings = []
+    for product in products:
+        rows = variants.get(product['id'], [])
+        prices = [price for price, _, _ in rows]
+        total_stock = sum(stock for _, _, stock in rows)
+        listings.append(ProductListing(
+            product_id=product['id'],
+            name=product['name'],
+            slug=product['slug'],
+            brand=product['brand'],
+            category_id=product['category_id'],
+            category_slug=product['category__slug'],
+            min_price=min(prices, default=None),
+            max_price=max(prices, default=None),
+            max_discount_percent=max((discount for _, discount, _ in rows), default=0),
+            total_stock=total_stock,
+            in_stock=total_stock > 0,
+            primary_image=images.get(product['id'], ''),
+            created_at=product['created_at'],
+        ))
+    return listings
+
+
+def refresh(product_ids):
+    """
+    Recompute the listings of `product_ids`; inactive or deleted products
+    lose theirs.
+    """
+    from api.models import ProductListing
+
+    product_ids = list(product_ids)
+    with transaction.atomic():
+        ProductListing.objects.filter(product_id__in=product_ids).delete()
+        ProductListing.objects.bulk_create(build(product_ids))
+    facets.changed(product_ids)
+
+
+def sync_stock(variant_ids):
+    """
+    Re-sum the stock of the listings owning `variant_ids` in one UPDATE, for
+    writes that bypass signals, like the conditional stock reservation.
+    """
+    from api.models import ProductListing, ProductVariant
+
+    variants = ProductVariant.objects.filter(product=OuterRef('pk'))
+    owners = ProductVariant.objects.filter(pk__in=variant_ids).values('product_id')
+    ProductListing.objects.filter(product_id__in=owners).update(
+        total_stock=Subquery(variants.values('product').annotate(total=Sum('stock')).values('total')),
+        in_stock=Exists(variants.filter(stock__gt=0)),
+    )
+    facets.changed(variant_ids=variant_ids)
+
+
+def update_category(category):
+    from api.models import ProductListing
+
+    ProductListing.objects.filter(category=category).exclude(category_slug=category.slug).update(
+        category_slug=category.slug
+    )
+
+
+def rebuild():
+    """
+    Recompute every listing. Returns the number of listings written.
+    """
+    from api.models import Product, ProductListing
+
+    written = 0
+    with transaction.atomic():
+        ProductListing.objects.all().delete()
+        product_ids = list(Product.objects.filter(is_active=True).values_list('id', flat=True))
+        for start in range(0, len(product_ids), BATCH_SIZE):
+            written += len(ProductListing.objects.bulk_create(build(product_ids[start:start + BATCH_SIZE])))
+        facets.invalidate()
+    return written
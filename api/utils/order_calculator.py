@@ -1,35 +1,57 @@
+import hashlib
 from decimal import Decimal, ROUND_HALF_UP
 
+from django.conf import settings
+from django.core.cache import cache
+
+from api.utils import coupons
+from api.utils.stats import register
+from api.utils.versions import bump_version_on_commit, get_versions
+
+
+stats = register('cart_pricing', 'hits', 'misses')
+
+TAX_RATE = Decimal('0.05')
+FREE_SHIPPING_FROM = Decimal('1000.00')
+SHIPPING_FEE = Decimal('50.00')
+
+# Bumped whenever any variant's price or discount may have changed; see
+# api/signals.py.
+PRICES_VERSION = 'prices'
+
+
 def round_rupees(value):
     return value.quantize(Decimal('1'), rounding=ROUND_HALF_UP)
 
-def calculate_order_summary(cart_items, coupon_code=None):
-    subtotal = sum(
-        Decimal(item.product.discounted_price()) * item.quantity
-        for item in cart_items
-    )
 
-    subtotal = round_rupees(subtotal)
+def discounted_price(price, discount_percent):
+    result = price * (Decimal('1.0') - Decimal(discount_percent) / Decimal('100'))
+    return result.quantize(Decimal('1.'), rounding=ROUND_HALF_UP)
+
+
+def summarize_lines(lines, coupon_code=None):
+    """
+    Totals for priced lines (dicts with at least 'line_total'). The coupon
+    comes from the in-process registry, and is only checked for a
+    non-empty cart.
+    """
+    subtotal = round_rupees(sum((line['line_total'] for line in lines), Decimal('0')))
 
     # Tax (5%) - use Decimal
-    tax_amount = round_rupees(subtotal * Decimal('0.05'))
+    tax_amount = round_rupees(subtotal * TAX_RATE)
 
     # Shipping fee
-    shipping_fee = Decimal('0.00') if subtotal >= Decimal('1000.00') else Decimal('50.00')
+    shipping_fee = Decimal('0.00') if subtotal >= FREE_SHIPPING_FROM else SHIPPING_FEE
 
     # Discount logic
     discount = Decimal('0.00')
-    coupon = None
-    if coupon_code:
-        try:
-            from api.models import Coupon
-            coupon = Coupon.objects.get(code=coupon_code, active=True)
-            if subtotal >= coupon.minimum_amount:
-                discount = coupon.discount_amount
-            else:
-                raise ValueError('Minimum amount not reached for coupon')
-        except Coupon.DoesNotExist:
+    if coupon_code and lines:
+        coupon = coupons.lookup(coupon_code)
+        if coupon is None:
             raise ValueError('Invalid coupon code')
+        if subtotal < coupon.minimum_amount:
+            raise ValueError('Minimum amount not reached for coupon')
+        discount = coupon.discount_amount
 
     total_amount = round_rupees(subtotal + tax_amount + shipping_fee - discount)
 
@@ -39,4 +61,82 @@ def calculate_order_summary(cart_items, coupon_code=None):
         'shipping_fee': shipping_fee,
         'discount': discount,
         'total_amount': total_amount,
+        'lines': lines,
     }
+
+
+def price_line(cart_id, variant_id, product_id, quantity, price, discount_percent):
+    unit_price = discounted_price(price, discount_percent)
+    return {
+        'cart_id': cart_id,
+        'variant_id': variant_id,
+        'product_id': product_id,
+        'quantity': quantity,
+        'unit_price': unit_price,
+        'line_total': unit_price * quantity,
+    }
+
+
+def calculate_order_summary(cart_items, coupon_code=None):
+    """
+    Price cart items that already have their variant loaded.
+    """
+    return summarize_lines([
+        price_line(item.pk, item.product_id, item.product.product_id, item.quantity,
+                   item.product.price, item.product.discount_percent)
+        for item in cart_items
+    ], coupon_code)
+
+
+def cart_version_name(user_id):
+    return f'cart:{user_id}'
+
+
+def invalidate_cart(user_id):
+    bump_version_on_commit(cart_version_name(user_id))
+
+
+def invalidate_prices():
+    bump_version_on_commit(PRICES_VERSION)
+
+
+def _cart_lines(user):
+    from api.models import Cart
+
+    rows = Cart.objects.filter(user=user).order_by('pk').values_list(
+        'id', 'product_id', 'product__product_id', 'quantity', 'product__price', 'product__discount_percent'
+    )
+    return [price_line(*row) for row in rows]
+
+
+def price_cart(user, coupon_code=None, verify=False):
+    """
+    Summary of the user's cart with a breakdown per line, from one query
+    over the cart joined to its variants.
+
+    The result is memoized until the cart, any variant price or the coupons
+    change, so checkout followed by placing the order prices the cart once.
+    The version stamps are read before the cart is, so a change committed
+    meanwhile can't be cached under the new stamps.
+
+    The stamps are only as shared as the cache they live in, so a change
+    made through another worker may not have retired the memo yet. With
+    `verify` (placing an order), the cart and its prices are read anyway
+    and the memo is only used if its lines still match them.
+    """
+    coupon_code = coupon_code or None
+    versions = get_versions([cart_version_name(user.pk), PRICES_VERSION, coupons.VERSION])
+    digest = hashlib.md5(coupons.normalize(coupon_code or '').encode()).hexdigest()[:12]
+    key = 'pricing:{}:{}:{}:{}:{}'.format(
+        user.pk, versions[cart_version_name(user.pk)], versions[PRICES_VERSION], versions[coupons.VERSION], digest
+    )
+    summary = cache.get(key)
+    lines = _cart_lines(user) if verify or summary is None else None
+    if summary is not None and (lines is None or lines == summary['lines']):
+        stats.incr('hits')
+        return summary
+
+    stats.incr('misses')
+    summary = summarize_lines(lines, coupon_code)
+    cache.set(key, summary, getattr(settings, 'CART_PRICING_CACHE_TIMEOUT', 15 * 60))
+    return summary
@@ -0,0 +1,76 @@
+import threading
+
+from asgiref.sync import sync_to_async
+
+from api.utils.stats import register
+from api.utils.versions import bump_version_on_commit, get_version
+
+
+stats = register('postal_codes', 'lookups', 'reloads')
+
+VERSION = 'postal_codes'
+
+_lock = threading.Lock()
+_codes = frozenset()
+_loaded_version = None
+
+
+def normalize(code):
+    return str(code).strip()
+
+
+def invalidate():
+    """
+    Tell every worker to reload its index on next use. Signals call this on
+    save/delete; call it directly after bulk writes, which send no signals.
+    """
+    bump_version_on_commit(VERSION)
+
+
+def get_codes():
+    """
+    The serviceable postal codes as an immutable set, reloaded when another
+    worker (or this one) has bumped the version since it was last built.
+    """
+    global _codes, _loaded_version
+
+    version = get_version(VERSION)
+    if version == _loaded_version:
+        return _codes
+
+    with _lock:
+        if version != _loaded_version:
+            from api.models import PostalCode
+
+            # Readers keep using the old set until the new one is swapped in.
+            _codes = frozenset(normalize(code) for code in PostalCode.objects.values_list('code', flat=True))
+            _loaded_version = version
+            stats.incr('reloads')
+        return _codes
+
+
+async def aget_codes():
+    """
+    get_codes() for async views. Only a reload touches the database; it
+    runs in a worker thread under the same lock as the sync callers'.
+    """
+    if get_version(VERSION) == _loaded_version:
+        return _codes
+    return await sync_to_async(get_codes)()
+
+
+def is_serviceable(code):
+    stats.incr('lookups')
+    return normalize(code) in get_codes()
+
+
+async def ais_serviceable(code):
+    stats.incr('lookups')
+    return normalize(code) in await aget_codes()
+
+
+def check_many(codes):
+    codes = [normalize(code) for code in codes]
+    stats.incr('lookups', len(codes))
+    serviceable = get_codes()
+    return {code: code in serviceable for code in codes}
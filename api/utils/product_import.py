@@ -0,0 +1,404 @@
+import csv
+import json
+import re
+from decimal import Decimal, InvalidOperation
+
+from django.db import DatabaseError, transaction
+from django.utils.text import slugify
+
+from api.utils import catalog_cache, listings, order_calculator, search, tags
+from api.utils.stats import register
+
+
+stats = register('product_import', 'rows', 'products', 'variants', 'failed')
+
+BATCH_SIZE = 1000
+FORMATS = ('csv', 'jsonl')
+# Row errors kept for the report; any beyond are only counted.
+MAX_ERRORS = 1000
+
+# Batch key of a product known only by name: (NEW, the slug made from the
+# name). Those are always created, never matched to a stored product.
+NEW = 'new'
+# Slugs made unique with a suffix ('-2', ...) keep at least this much of
+# the slug they're made from.
+SLUG_STEM = 44
+
+PRODUCT_FIELDS = ('slug', 'name', 'description', 'category_id', 'brand', 'is_active')
+VARIANT_FIELDS = ('unit', 'price', 'stock', 'discount_percent')
+TRUE = ('1', 'true', 'yes', 'y')
+FALSE = ('0', 'false', 'no', 'n')
+
+
+class RowError(ValueError):
+    pass
+
+
+class ImportReport:
+    def __init__(self):
+        self.rows = 0
+        self.products = 0
+        self.variants = 0
+        self.failed = 0
+        self.errors = []
+
+    def error(self, line, message):
+        self.failed += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append({'line': line, 'error': message})
+
+    def as_dict(self):
+        return {
+            'rows': self.rows,
+            'products': self.products,
+            'variants': self.variants,
+            'failed': self.failed,
+            'errors': self.errors,
+        }
+
+
+def format_for(filename):
+    """
+    The import format a file name's extension implies, or None.
+    """
+    extension = filename.rsplit('.', 1)[-1].lower()
+    if extension in ('jsonl', 'ndjson'):
+        return 'jsonl'
+    return extension if extension in FORMATS else None
+
+
+def read_rows(stream, fmt):
+    """
+    (line number, row dict) for each row of a text stream, CSV with a header
+    or one JSON object per line. A line that isn't a JSON object comes out
+    as a RowError instead of a dict.
+    """
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            # Columns missing from a short row are absent rather than None.
+            yield reader.line_num, {key: value for key, value in row.items() if key is not None and value is not None}
+        return
+
+    for number, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, RowError('Invalid JSON')
+            continue
+        yield number, row if isinstance(row, dict) else RowError('Expected a JSON object')
+
+
+def _text(row, field, max_length, required=False):
+    value = row.get(field)
+    value = '' if value is None else str(value).strip()
+    if required and not value:
+        raise RowError(f'{field} is required')
+    if len(value) > max_length:
+        raise RowError(f'{field} is longer than {max_length} characters')
+    return value
+
+
+def _number(value, field, convert):
+    try:
+        number = convert(str(value).strip())
+    except (InvalidOperation, ValueError):
+        raise RowError(f'{field} must be a number')
+    if isinstance(number, Decimal) and not number.is_finite():
+        raise RowError(f'{field} must be a number')
+    if number < 0:
+        raise RowError(f'{field} must not be negative')
+    return number
+
+
+def _variant(data):
+    variant = {'unit': _text(data, 'unit', 50, required=True)}
+    if data.get('price') not in (None, ''):
+        price = _number(data['price'], 'price', Decimal)
+        if price.as_tuple().exponent < -2 or price >= 10 ** 8:
+            raise RowError('price must have at most 8 digits before and 2 after the point')
+        variant['price'] = price
+    if data.get('stock') not in (None, ''):
+        variant['stock'] = _number(data['stock'], 'stock', int)
+    if data.get('discount_percent') not in (None, ''):
+        variant['discount_percent'] = _number(data['discount_percent'], 'discount_percent', int)
+        if variant['discount_percent'] > 100:
+            raise RowError('discount_percent must be at most 100')
+    return variant
+
+
+def parse_row(row, categories):
+    """
+    The product fields (only those the row has; `slug` only if it's given)
+    and variants of one row.
+    `categories` maps category slugs and lower-cased names to ids. Raises
+    RowError for anything invalid.
+
+    A row describes its variants either inline (`unit`, `price`, `stock`,
+    `discount_percent` columns, one variant per row) or, in JSONL, as a
+    `variants` list.
+    """
+    name = _text(row, 'name', 255, required=True)
+    slug = _text(row, 'slug', 50)
+    if slug and slug != slugify(slug):
+        raise RowError('slug may only contain letters, numbers, hyphens and underscores')
+    if not slug and not name_slug(name):
+        raise RowError('No slug can be made from the name; give one')
+
+    product = {'slug': slug, 'name': name} if slug else {'name': name}
+    if 'category' in row:
+        category = _text(row, 'category', 100, required=True)
+        category_id = categories.get(category) or categories.get(category.lower())
+        if category_id is None:
+            raise RowError(f'Unknown category {category!r}')
+        product['category_id'] = category_id
+    if 'description' in row:
+        product['description'] = _text(row, 'description', 100_000)
+    if 'brand' in row:
+        product['brand'] = _text(row, 'brand', 100)
+    if 'is_active' in row:
+        active = row['is_active']
+        if not isinstance(active, bool):
+            active = str(active).strip().lower()
+            if active not in TRUE + FALSE:
+                raise RowError('is_active must be true or false')
+            active = active in TRUE
+        product['is_active'] = active
+
+    product_tags = None
+    if 'tags' in row:
+        value = row['tags']
+        product_tags = tags.parse(','.join(map(str, value)) if isinstance(value, list) else str(value or ''))
+
+    if 'variants' in row:
+        if not isinstance(row['variants'], list) or not all(isinstance(data, dict) for data in row['variants']):
+            raise RowError('variants must be a list of objects')
+        variants = [_variant(data) for data in row['variants']]
+    elif row.get('unit'):
+        variants = [_variant(row)]
+    else:
+        variants = []
+    return product, product_tags, variants
+
+
+def name_slug(name):
+    return slugify(name)[:50].strip('-')
+
+
+def category_map():
+    from api.models import Category
+
+    names, slugs = {}, {}
+    for pk, slug, name in Category.objects.values_list('pk', 'slug', 'name'):
+        names[name.lower()] = pk
+        slugs[slug] = pk
+    # Slugs win over names that happen to look like one.
+    return {**names, **slugs}
+
+
+def _set_tags(product_tags):
+    from api.models import Product
+
+    ProductTag = Product.tags.through
+    ProductTag.objects.filter(product_id__in=product_tags).delete()
+    tag_ids = {tag.name: tag.pk for tag in tags.get_or_create(set().union(*product_tags.values()))}
+    ProductTag.objects.bulk_create([
+        ProductTag(product_id=product_id, tag_id=tag_ids[name])
+        for product_id, names in product_tags.items() for name in names
+    ])
+
+
+def free_slugs(bases, taken=()):
+    """
+    {base: slug} with a slug for each of `bases` that no product has and
+    that isn't in `taken`: the base itself, or else with the lowest free
+    suffix ('-2', '-3', ...). Two queries at most, however many there are.
+    """
+    from api.models import Product
+
+    taken = set(taken)
+    taken.update(Product.objects.filter(slug__in=bases).values_list('slug', flat=True))
+    clashing = [base for base in bases if base in taken]
+    slugs = {base: base for base in bases if base not in taken}
+    taken.update(slugs)
+    if clashing:
+        # Every suffixed slug, cut to fit, starts with the base's stem.
+        pattern = '^(%s)' % '|'.join(re.escape(base[:SLUG_STEM]) for base in set(clashing))
+        taken.update(Product.objects.filter(slug__regex=pattern).values_list('slug', flat=True))
+    for base in clashing:
+        number, slug = 1, base
+        while slug in taken:
+            number += 1
+            suffix = f'-{number}'
+            slug = base[:50 - len(suffix)].rstrip('-') + suffix
+        taken.add(slug)
+        slugs[base] = slug
+    return slugs
+
+
+def write_batch(batch):
+    """
+    Write a batch of parsed rows, {key: (product, tags, {unit: variant})},
+    in one transaction, and bring everything derived from the catalog (the
+    listings, facet index, search index and caches) up to date, as the
+    signals would for single saves. A key is the slug the file gave, and
+    that product is updated if there is one; or (NEW, the slug made from
+    the name), and a product is created with that slug made unique.
+
+    Returns ({key: error} for the products left out, because they would be
+    created without a category or get a new variant without a price, the
+    number of variants written, and {base: slug} for the products created
+    from names).
+    """
+    from api.models import Product, ProductVariant
+
+    with transaction.atomic():
+        slugs = {key: key for key in batch if not isinstance(key, tuple)}
+        # Every column goes into the upsert, so the fields a row leaves out
+        # are filled in from the stored product or variant.
+        current = {row['slug']: row for row in Product.objects.filter(slug__in=slugs).values(*PRODUCT_FIELDS)}
+        current_units = {
+            (row.pop('product__slug'), row['unit']): row
+            for row in ProductVariant.objects.filter(product__slug__in=current).values(
+                'product__slug', *VARIANT_FIELDS
+            )
+        }
+        rejected = {}
+        for key, (product, _, units) in batch.items():
+            if key not in current and 'category_id' not in product:
+                rejected[key] = 'category is required for a new product'
+            for unit, variant in units.items():
+                if (key, unit) not in current_units and 'price' not in variant:
+                    rejected.setdefault(key, f'price is required for new variant {unit!r}')
+        batch = {key: row for key, row in batch.items() if key not in rejected}
+        if not batch:
+            return rejected, 0, {}
+
+        named = free_slugs([key[1] for key in batch if isinstance(key, tuple)], taken=slugs)
+        slugs.update({key: named[key[1]] for key in batch if isinstance(key, tuple)})
+        given = [
+            Product(**{**current.get(key, {}), **product})
+            for key, (product, _, _) in batch.items() if not isinstance(key, tuple)
+        ]
+        if given:
+            Product.objects.bulk_create(
+                given, update_conflicts=True, unique_fields=['slug'], update_fields=PRODUCT_FIELDS[1:],
+            )
+        # A plain insert: should a slug be taken after all, the batch fails
+        # rather than overwrite another product.
+        Product.objects.bulk_create([
+            Product(**product, slug=slugs[key]) for key, (product, _, _) in batch.items() if isinstance(key, tuple)
+        ])
+        ids = dict(Product.objects.filter(slug__in=slugs.values()).values_list('slug', 'pk'))
+
+        variants = [
+            ProductVariant(product_id=ids[slugs[key]], **{**current_units.get((key, unit), {}), **variant})
+            for key, (_, _, units) in batch.items() for unit, variant in units.items()
+        ]
+        ProductVariant.objects.bulk_create(
+            variants, update_conflicts=True, unique_fields=['product', 'unit'], update_fields=VARIANT_FIELDS[1:],
+        )
+
+        tagged = {ids[slugs[key]]: names for key, (_, names, _) in batch.items() if names is not None}
+        if tagged:
+            _set_tags(tagged)
+
+        product_ids = list(ids.values())
+        listings.refresh(product_ids)
+        search.index_products(Product.objects.filter(pk__in=product_ids))
+        for product_id in product_ids:
+            catalog_cache.invalidate('product', product_id)
+        if variants:
+            order_calculator.invalidate_prices()
+    return rejected, len(variants), named
+
+
+def run(stream, fmt, batch_size=BATCH_SIZE):
+    """
+    Create or update products and their variants from a CSV or JSONL text
+    stream, `batch_size` rows at a time, so memory use doesn't grow with the
+    file. A row with a slug updates the product with that slug, if there is
+    one; a row with only a name creates a product, its slug made from the
+    name and unique ('-2', '-3', ...). Variants are matched by unit. Only
+    the fields a row has are changed on existing products and variants, and
+    variants missing from the file are left alone. Rows for the same
+    product (by slug, or else by name), in a batch or spread over the file,
+    are merged.
+
+    A row with an error is skipped and reported; if a batch fails as a
+    whole, its rows are. Yields the ImportReport after each batch, the
+    last time complete.
+    """
+    report = ImportReport()
+    categories = category_map()
+    batch, lines = {}, {}
+    # Slugs of the products created from names so far, by the slug made
+    # from the name, so later rows with that name update them.
+    created = {}
+    pending = 0
+
+    def flush():
+        try:
+            rejected, written, named = write_batch(batch) if batch else ({}, 0, {})
+        except DatabaseError as exc:
+            for line in sorted(set().union(*lines.values())):
+                report.error(line, str(exc))
+        else:
+            for key, message in rejected.items():
+                for line in sorted(lines[key]):
+                    report.error(line, message)
+            created.update(named)
+            report.products += len(batch) - len(rejected)
+            report.variants += written
+        batch.clear()
+        lines.clear()
+
+    for line, row in read_rows(stream, fmt):
+        report.rows += 1
+        pending += 1
+        try:
+            if isinstance(row, RowError):
+                raise row
+            product, product_tags, variants = parse_row(row, categories)
+        except RowError as exc:
+            report.error(line, str(exc))
+        else:
+            if 'slug' not in product and name_slug(product['name']) in created:
+                product['slug'] = created[name_slug(product['name'])]
+            key = product.get('slug') or (NEW, name_slug(product['name']))
+            if key in batch:
+                merged, merged_tags, units = batch[key]
+                merged.update(product)
+                batch[key] = (merged, merged_tags if product_tags is None else product_tags, units)
+            else:
+                units = {}
+                batch[key] = (product, product_tags, units)
+            for variant in variants:
+                units.setdefault(variant['unit'], {}).update(variant)
+            lines.setdefault(key, set()).add(line)
+
+        if pending == batch_size:
+            flush()
+            pending = 0
+            yield report
+    if pending or not report.rows:
+        flush()
+        yield report
+
+    stats.incr('rows', report.rows)
+    stats.incr('products', report.products)
+    stats.incr('variants', report.variants)
+    stats.incr('failed', report.failed)
+
+
+def import_products(stream, fmt, batch_size=BATCH_SIZE, progress=None):
+    """
+    run() to the end, calling `progress(report)` after each batch. Returns
+    the ImportReport.
+    """
+    for report in run(stream, fmt, batch_size):
+        if progress is not None:
+            progress(report)
+    return report
@@ -0,0 +1,251 @@
+import bisect
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+logger = logging.getLogger(__name__)
+
+# Changed by reset(). Not a version stamp: those run out in a process-local
+# cache, and this running out would read as a reset.
+RESET_KEY = 'profiling:reset'
+# Pids of the workers that have published; see _update_workers().
+WORKERS_KEY = 'profiling:workers'
+WORKERS_LOCK_TIMEOUT = 5
+METRICS = ('latency_ms', 'queries', 'sql_ms', 'response_bytes')
+
+# 1-2-5 bucket bounds from 0.1 to 50M; wide enough for milliseconds, query
+# counts and response sizes alike. Fixed bounds make snapshots from
+# different workers mergeable by adding bucket counts.
+BOUNDS = tuple(
+    mantissa * 10 ** exponent for exponent in range(-1, 8) for mantissa in (1, 2, 5)
+)
+
+MAX_SLOW_REQUESTS = 20
+MAX_CAPTURED_QUERIES = 50
+MAX_SQL_LENGTH = 1000
+
+
+class Histogram:
+    """
+    Bucketed distribution of one metric. Percentiles are estimated from the
+    bucket bounds, capped at the largest value seen.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BOUNDS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0.0
+        target = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(BOUNDS[index], self.max) if index < len(BOUNDS) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {'counts': list(self.counts), 'count': self.count, 'total': self.total, 'max': self.max}
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls()
+        histogram.merge(data)
+        return histogram
+
+    def merge(self, data):
+        self.counts = [a + b for a, b in zip(self.counts, data['counts'])]
+        self.count += data['count']
+        self.total += data['total']
+        self.max = max(self.max, data['max'])
+
+    def summary(self):
+        return {
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+class RequestProfile:
+    """
+    Per-view histograms of this worker, plus its slowest requests with the
+    SQL they ran when slow-request logging is on.
+    """
+
+    def __init__(self):
+        self.views = {}
+        self.slowest = []
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+
+    def record(self, view, latency_ms, queries, sql_ms, response_bytes):
+        with self._lock:
+            histograms = self.views.get(view)
+            if histograms is None:
+                histograms = self.views[view] = {metric: Histogram() for metric in METRICS}
+            histograms['latency_ms'].add(latency_ms)
+            histograms['queries'].add(queries)
+            histograms['sql_ms'].add(sql_ms)
+            if response_bytes is not None:
+                histograms['response_bytes'].add(response_bytes)
+
+    def record_slow(self, entry):
+        with self._lock:
+            item = (entry['latency_ms'], next(self._sequence), entry)
+            if len(self.slowest) < MAX_SLOW_REQUESTS:
+                heapq.heappush(self.slowest, item)
+            else:
+                heapq.heappushpop(self.slowest, item)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'views': {
+                    view: {metric: histogram.to_dict() for metric, histogram in histograms.items()}
+                    for view, histograms in self.views.items()
+                },
+                'slowest': [entry for _, _, entry in self.slowest],
+            }
+
+    def reset(self):
+        with self._lock:
+            self.views = {}
+            self.slowest = []
+
+
+profile = RequestProfile()
+
+_published_at = 0.0
+_seen_version = None
+
+
+def get_cache():
+    return caches[getattr(settings, 'REQUEST_PROFILING_CACHE_ALIAS', 'default')]
+
+
+def _worker_key(worker):
+    return f'profiling:worker:{worker}'
+
+
+def get_worker_ttl():
+    return getattr(settings, 'REQUEST_PROFILING_WORKER_TTL', 10 * 60)
+
+
+def _update_workers(cache, change):
+    # Read-modify-write of the worker set under a lock, so workers joining
+    # at once don't drop each other. Skipped when someone else holds the
+    # lock; a worker missing from the set adds itself on its next publish.
+    lock = f'{WORKERS_KEY}:lock'
+    if not cache.add(lock, os.getpid(), WORKERS_LOCK_TIMEOUT):
+        return
+    try:
+        cache.set(WORKERS_KEY, change(cache.get(WORKERS_KEY) or set()), None)
+    finally:
+        cache.delete(lock)
+
+
+def _reset_marker(cache):
+    marker = cache.get(RESET_KEY)
+    if marker is None:
+        cache.add(RESET_KEY, uuid.uuid4().hex, None)
+        marker = cache.get(RESET_KEY)
+    return marker
+
+
+def get_slow_threshold():
+    return getattr(settings, 'REQUEST_PROFILING_SLOW_MS', None)
+
+
+def publish(force=False):
+    """
+    Share this worker's profile through the cache, at most every
+    REQUEST_PROFILING_PUBLISH_INTERVAL seconds, so `collect()` in another
+    process (the staff endpoint, the management command) can see it. Also
+    where a reset requested elsewhere reaches this worker. A profile not
+    published again within REQUEST_PROFILING_WORKER_TTL seconds (its worker
+    died, or has been idle) runs out.
+    """
+    global _published_at, _seen_version
+
+    now = time.monotonic()
+    if not force and now - _published_at < getattr(settings, 'REQUEST_PROFILING_PUBLISH_INTERVAL', 10):
+        return
+    _published_at = now
+
+    cache = get_cache()
+    version = _reset_marker(cache)
+    if _seen_version is not None and version != _seen_version:
+        profile.reset()
+    _seen_version = version
+
+    worker = str(os.getpid())
+    cache.set(_worker_key(worker), {'version': version, **profile.to_dict()}, get_worker_ttl())
+    if worker not in (cache.get(WORKERS_KEY) or set()):
+        _update_workers(cache, lambda workers: workers | {worker})
+
+
+def collect():
+    """
+    Merge the profiles published by every worker with this process's own,
+    and summarize them per view, most total time first.
+    """
+    publish(force=True)
+    cache = get_cache()
+    version = _reset_marker(cache)
+    workers = cache.get(WORKERS_KEY) or set()
+    published = cache.get_many([_worker_key(worker) for worker in workers])
+    gone = {worker for worker in workers if _worker_key(worker) not in published}
+    if gone:
+        _update_workers(cache, lambda current: current - gone)
+
+    views = {}
+    slowest = []
+    for data in published.values():
+        if data.get('version') != version:
+            continue
+        for view, histograms in data['views'].items():
+            merged = views.setdefault(view, {metric: Histogram() for metric in METRICS})
+            for metric, histogram in histograms.items():
+                merged[metric].merge(histogram)
+        slowest.extend(data['slowest'])
+
+    summaries = {
+        view: {'requests': histograms['latency_ms'].count, **{
+            metric: histogram.summary() for metric, histogram in histograms.items()
+        }}
+        for view, histograms in sorted(views.items(), key=lambda item: -item[1]['latency_ms'].total)
+    }
+    slowest.sort(key=lambda entry: -entry['latency_ms'])
+    return {'views': summaries, 'slowest': slowest[:MAX_SLOW_REQUESTS]}
+
+
+def reset():
+    """
+    Clear the profiles of every worker; each one drops its data the next
+    time it publishes.
+    """
+    get_cache().set(RESET_KEY, uuid.uuid4().hex, None)
+    profile.reset()
+    publish(force=True)
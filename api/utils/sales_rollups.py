@@ -0,0 +1,249 @@
+"""
+Daily sales rollups (DailySales, DailyVariantSales) for dashboards, which
+sum a few rows per day instead of scanning order items.
+
+Orders are added to the rollups when they're placed and taken out again
+if cancelled or deleted (see api/signals.py), by adding to the day's
+rows rather than recounting them. Items are only
+read when their order is added or removed; rows written any other way,
+and history from before the rollups, are picked up by rebuilding a date
+range (`manage.py rebuild_sales_rollups`).
+"""
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+
+from django.db import connection, transaction
+from django.db.models import Sum
+from django.utils import timezone
+
+from api.utils import category_tree
+
+
+CENT = Decimal('0.01')
+ORDER_FIELDS = ('orders', 'subtotal', 'discount', 'tax', 'shipping', 'revenue')
+VARIANT_FIELDS = ('orders', 'units', 'revenue', 'discount', 'tax')
+
+# ?by= of report(): the rollup it reads and the columns it groups by.
+GROUPS = {
+    'day': ('DailySales', ['date']),
+    'coupon': ('DailySales', ['coupon_code']),
+    'variant': ('DailyVariantSales', ['variant_id', 'variant__unit', 'product_id', 'product__name']),
+    'product': ('DailyVariantSales', ['product_id', 'product__name']),
+    'category': ('DailyVariantSales', ['category_id', 'category__name']),
+}
+
+
+def counts(status):
+    return status != 'cancelled'
+
+
+def day_bounds(start, end):
+    """
+    The created_at range, as aware datetimes, of the days `start` to `end`.
+    """
+    return (
+        timezone.make_aware(datetime.combine(start, time.min)),
+        timezone.make_aware(datetime.combine(end + timedelta(days=1), time.min)),
+    )
+
+
+def _order_rows(orders):
+    return orders.values_list(
+        'pk', 'created_at', 'coupon_code', 'discount_amount', 'tax_amount', 'shipping_fee', 'total_amount'
+    )
+
+
+def _item_rows(items):
+    return items.values_list(
+        'order_id', 'product_id', 'product__product_id', 'product__product__category_id', 'quantity', 'price_at_order'
+    )
+
+
+def aggregate(orders, items):
+    """
+    Rollup rows for order and item tuples (as _order_rows() and _item_rows()
+    read them): {(date, coupon_code): {field: value}} and
+    {(date, variant_id, product_id, category_id): {field: value}}.
+    """
+    lines = defaultdict(list)
+    for order_id, variant_id, product_id, category_id, quantity, price in items:
+        lines[order_id].append(((variant_id, product_id, category_id), quantity, price * quantity))
+
+    sales = defaultdict(lambda: dict.fromkeys(ORDER_FIELDS, 0))
+    variants = defaultdict(lambda: dict.fromkeys(VARIANT_FIELDS, 0))
+    for order_id, created_at, coupon_code, discount, tax, shipping, total in orders:
+        date = timezone.localdate(created_at)
+        order_lines = lines.get(order_id, [])
+        subtotal = sum((value for _, _, value in order_lines), Decimal('0'))
+
+        row = sales[date, coupon_code or '']
+        row['orders'] += 1
+        row['subtotal'] += subtotal
+        row['discount'] += discount
+        row['tax'] += tax
+        row['shipping'] += shipping
+        row['revenue'] += total
+
+        # Discount and tax are shared out by value; the last line takes
+        # what rounding leaves over, so they add up to the order's.
+        discount_left, tax_left = discount, tax
+        for index, (key, quantity, value) in enumerate(order_lines):
+            if index == len(order_lines) - 1:
+                discount_share, tax_share = discount_left, tax_left
+            else:
+                share = value / subtotal if subtotal else 0
+                discount_share = (discount * share).quantize(CENT)
+                tax_share = (tax * share).quantize(CENT)
+            discount_left -= discount_share
+            tax_left -= tax_share
+
+            row = variants[(date,) + key]
+            row['units'] += quantity
+            row['revenue'] += value
+            row['discount'] += discount_share
+            row['tax'] += tax_share
+        for key in {key for key, _, _ in order_lines}:
+            variants[(date,) + key]['orders'] += 1
+    return sales, variants
+
+
+def _increment(model, key, fields, rows):
+    # One INSERT ... ON CONFLICT DO UPDATE (SQLite and PostgreSQL) adding
+    # `fields` to the rows that exist and creating the rest, so concurrent
+    # orders on the same day all count and the number of statements doesn't
+    # grow with the order's items. `rows` are dicts of every field to write.
+    if not rows:
+        return
+    quote = connection.ops.quote_name
+    table = quote(model._meta.db_table)
+    model_fields = [model._meta.get_field(name) for name in rows[0]]
+    column = {field.name: quote(field.column) for field in model_fields}
+    placeholders = '(' + ', '.join(['%s'] * len(model_fields)) + ')'
+    params = [
+        field.get_db_prep_save(row[field.name], connection) for row in rows for field in model_fields
+    ]
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'INSERT INTO {table} ({", ".join(column.values())}) VALUES {", ".join([placeholders] * len(rows))} '
+            f'ON CONFLICT ({", ".join(column[name] for name in key)}) DO UPDATE SET '
+            + ', '.join(f'{column[name]} = {table}.{column[name]} + excluded.{column[name]}' for name in fields),
+            params,
+        )
+
+
+def apply(order_ids, sign=1):
+    """
+    Add the orders `order_ids` to the rollups, or with `sign=-1` take them
+    out, whatever their status.
+    """
+    from api.models import DailySales, DailyVariantSales, Order, OrderItem
+
+    order_ids = list(order_ids)
+    sales, variants = aggregate(
+        _order_rows(Order.objects.filter(pk__in=order_ids)),
+        _item_rows(OrderItem.objects.filter(order_id__in=order_ids)),
+    )
+    with transaction.atomic():
+        _increment(DailySales, ['date', 'coupon_code'], ORDER_FIELDS, [
+            {'date': date, 'coupon_code': coupon_code, **{field: value * sign for field, value in values.items()}}
+            for (date, coupon_code), values in sales.items()
+        ])
+        _increment(DailyVariantSales, ['date', 'variant'], VARIANT_FIELDS, [
+            {'date': date, 'variant': variant_id, 'product': product_id, 'category': category_id,
+             **{field: value * sign for field, value in values.items()}}
+            for (date, variant_id, product_id, category_id), values in variants.items()
+        ])
+
+
+def order_placed(order_id):
+    # After the order's transaction commits, when its items are in.
+    from api.models import Order
+
+    if counts(Order.objects.filter(pk=order_id).values_list('status', flat=True).first()):
+        apply([order_id])
+
+
+def partitions(start, end, days):
+    """
+    (first, last) day pairs covering `start` to `end`, `days` at a time.
+    """
+    while start <= end:
+        last = min(start + timedelta(days=days - 1), end)
+        yield start, last
+        start = last + timedelta(days=1)
+
+
+def build_partition(start, end):
+    """
+    Rollup rows of the days `start` to `end`, from the orders themselves, as
+    plain tuples: ([(date, coupon_code, values)], [(date, variant_id,
+    product_id, category_id, values)]).
+    """
+    from api.models import Order, OrderItem
+
+    created = day_bounds(start, end)
+    orders = Order.objects.filter(created_at__gte=created[0], created_at__lt=created[1]).exclude(status='cancelled')
+    items = OrderItem.objects.filter(order__in=orders)
+    sales, variants = aggregate(
+        _order_rows(orders).iterator(chunk_size=2000), _item_rows(items).iterator(chunk_size=2000)
+    )
+    return (
+        [(date, coupon_code, values) for (date, coupon_code), values in sales.items()],
+        [key + (values,) for key, values in variants.items()],
+    )
+
+
+def write_partition(start, end, rows):
+    """
+    Replace the rollups of the days `start` to `end` with `rows`, as
+    build_partition() returns them.
+    """
+    from api.models import DailySales, DailyVariantSales
+
+    sales, variants = rows
+    with transaction.atomic():
+        DailySales.objects.filter(date__range=(start, end)).delete()
+        DailyVariantSales.objects.filter(date__range=(start, end)).delete()
+        DailySales.objects.bulk_create([
+            DailySales(date=date, coupon_code=coupon_code, **values) for date, coupon_code, values in sales
+        ], batch_size=1000)
+        DailyVariantSales.objects.bulk_create([
+            DailyVariantSales(date=date, variant_id=variant_id, product_id=product_id, category_id=category_id,
+                              **values)
+            for date, variant_id, product_id, category_id, values in variants
+        ], batch_size=1000)
+    return len(sales), len(variants)
+
+
+def report(by, start, end, category_id=None, limit=None):
+    """
+    Totals per `by` (a key of GROUPS) over the days `start` to `end`,
+    summed from the rollups: by day in date order, otherwise largest
+    revenue first. `category_id` narrows variant, product and category
+    totals to that category's subtree.
+
+    Above the variant, `orders` counts an order once for each variant of
+    the group it had.
+    """
+    from api import models
+
+    model_name, keys = GROUPS[by]
+    model = getattr(models, model_name)
+    fields = ORDER_FIELDS if model is models.DailySales else VARIANT_FIELDS
+
+    queryset = model.objects.filter(date__range=(start, end))
+    if category_id is not None and model is models.DailyVariantSales:
+        queryset = queryset.filter(category__in=category_tree.subtree_ids(category_id))
+    # Annotations can't share a name with a model field.
+    rows = queryset.values(*keys).annotate(**{f'total_{field}': Sum(field) for field in fields})
+    rows = rows.filter(total_orders__gt=0).order_by(*(keys[:1] if by == 'day' else ['-total_revenue', keys[0]]))
+    if limit is not None:
+        rows = rows[:limit]
+
+    results = []
+    for row in rows:
+        result = {key.replace('__', '_'): row[key] for key in keys}
+        result.update((field, row[f'total_{field}']) for field in fields)
+        results.append(result)
+    return results
@@ -0,0 +1,160 @@
+import hashlib
+import re
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+
+from api.utils import tags
+from api.utils.versions import bump_version_on_commit, get_version
+
+
+FTS_TABLE = 'api_product_fts'
+RANK_ANNOTATION = 'search_rank'
+
+# Columns of api_product_fts, in order; see migration 0005.
+FTS_COLUMNS = ('name', 'description', 'brand', 'tags', 'category')
+
+MAX_TERMS = 8
+BATCH_SIZE = 2000
+
+
+def is_available():
+    return connection.vendor == 'sqlite'
+
+
+def get_rank_limit():
+    return getattr(settings, 'SEARCH_RANK_LIMIT', 200)
+
+
+def build_match_query(term):
+    """
+    Turn user input into an FTS5 query: every word must match, and each is a
+    prefix so partial input works for type-ahead. Words are quoted, so FTS5
+    operators typed by the user are searched for literally.
+    """
+    words = re.findall(r'\w+', term.lower())[:MAX_TERMS]
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def matches_sql(query):
+    """
+    SQL and params selecting the id of every product matching the FTS5
+    `query`, unordered; cheap, as nothing is scored.
+    """
+    return (
+        f'SELECT d.product_id FROM {FTS_TABLE} '
+        f'JOIN api_productsearchdocument d ON d.id = {FTS_TABLE}.rowid '
+        f'WHERE {FTS_TABLE} MATCH %s',
+        [query],
+    )
+
+
+def search_product_ids(term, limit=None):
+    """
+    Hex ids of the `limit` (SEARCH_RANK_LIMIT) best matches for `term`,
+    best first. Other matches exist beyond these; see matches_sql().
+
+    Ranking has to score every match, which is the expensive part for short
+    prefixes, so ranked lists are cached until the index next changes.
+    """
+    query = build_match_query(term)
+    if not query:
+        return []
+    limit = limit or get_rank_limit()
+    digest = hashlib.md5(query.encode()).hexdigest()
+    key = f'search:{get_version("search")}:{limit}:{digest}'
+    product_ids = cache.get(key)
+    if product_ids is None:
+        sql, params = matches_sql(query)
+        with connection.cursor() as cursor:
+            cursor.execute(f'{sql} ORDER BY rank LIMIT %s', [*params, limit])
+            product_ids = [row[0] for row in cursor.fetchall()]
+        cache.set(key, product_ids, getattr(settings, 'SEARCH_CACHE_TIMEOUT', 10 * 60))
+    return product_ids
+
+
+def _document_ids(product_ids):
+    from api.models import ProductSearchDocument
+
+    existing = dict(
+        ProductSearchDocument.objects.filter(product_id__in=product_ids).values_list('product_id', 'id')
+    )
+    missing = [pk for pk in product_ids if pk not in existing]
+    if missing:
+        ProductSearchDocument.objects.bulk_create(
+            [ProductSearchDocument(product_id=pk) for pk in missing], ignore_conflicts=True
+        )
+        existing.update(
+            ProductSearchDocument.objects.filter(product_id__in=missing).values_list('product_id', 'id')
+        )
+    return existing
+
+
+def _write_rows(rows):
+    rows = list(rows)
+    if not rows:
+        return
+    bump_version_on_commit('search')
+    documents = _document_ids([row['id'] for row in rows])
+    product_tags = tags.names_by_product(list(documents))
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'DELETE FROM {FTS_TABLE} WHERE rowid = %s',
+            [(documents[row['id']],) for row in rows],
+        )
+        cursor.executemany(
+            f'INSERT INTO {FTS_TABLE} (rowid, {", ".join(FTS_COLUMNS)}) VALUES (%s, %s, %s, %s, %s, %s)',
+            [
+                (
+                    documents[row['id']], row['name'], row['description'], row['brand'],
+                    tags.as_text(product_tags.get(row['id'], [])), row['category__name'],
+                )
+                for row in rows
+            ],
+        )
+
+
+def _rows(queryset):
+    return queryset.values('id', 'name', 'description', 'brand', 'category__name')
+
+
+def index_products(queryset):
+    """
+    (Re)index every product in `queryset`.
+    """
+    if not is_available():
+        return
+    batch = []
+    for row in _rows(queryset).iterator(chunk_size=BATCH_SIZE):
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            _write_rows(batch)
+            batch = []
+    _write_rows(batch)
+
+
+def remove_document(document_id):
+    if not is_available():
+        return
+    bump_version_on_commit('search')
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE} WHERE rowid = %s', [document_id])
+
+
+def rebuild_index():
+    """
+    Drop every indexed row and index the whole catalog again. Returns the
+    number of products indexed.
+    """
+    from api.models import Product
+
+    if not is_available():
+        return 0
+    bump_version_on_commit('search')
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {FTS_TABLE}')
+    index_products(Product.objects.all())
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+    return Product.objects.count()
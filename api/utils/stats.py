@@ -0,0 +1,42 @@
+import threading
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+class StatsCounter:
+    """
+    A named group of process-local counters, e.g. cache hits and misses.
+    """
+
+    def __init__(self, name, fields):
+        self.name = name
+        self._values = dict.fromkeys(fields, 0)
+        self._lock = threading.Lock()
+
+    def incr(self, field, amount=1):
+        with self._lock:
+            self._values[field] = self._values.get(field, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def reset(self):
+        with self._lock:
+            for field in self._values:
+                self._values[field] = 0
+
+
+def register(name, *fields):
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = StatsCounter(name, fields)
+        return _registry[name]
+
+
+def snapshot_all():
+    with _registry_lock:
+        counters = list(_registry.values())
+    return {counter.name: counter.snapshot() for counter in counters}
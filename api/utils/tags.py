@@ -0,0 +1,56 @@
+from collections import defaultdict
+
+
+MAX_LENGTH = 100
+
+
+def normalize(name):
+    return name.strip().lower()[:MAX_LENGTH]
+
+
+def parse(text):
+    """
+    Tag names in a comma-separated string, normalized, without blanks or
+    repeats, in the order given.
+    """
+    names = (normalize(name) for name in text.split(','))
+    return list(dict.fromkeys(name for name in names if name))
+
+
+def get_or_create(names):
+    """
+    Tags for `names` (already normalized), creating the missing ones in bulk.
+    """
+    from api.models import Tag
+
+    names = set(names)
+    tags = list(Tag.objects.filter(name__in=names))
+    missing = names - {tag.name for tag in tags}
+    if missing:
+        Tag.objects.bulk_create([Tag(name=name) for name in missing], ignore_conflicts=True)
+        tags += Tag.objects.filter(name__in=missing)
+    return tags
+
+
+def set_tags(product, names):
+    product.tags.set(get_or_create(names))
+
+
+def names_by_product(product_ids):
+    """
+    Each product's tag names, from one query.
+    """
+    from api.models import Product
+
+    names = defaultdict(list)
+    rows = Product.tags.through.objects.filter(product_id__in=product_ids)
+    for product_id, name in rows.values_list('product_id', 'tag__name'):
+        names[product_id].append(name)
+    return names
+
+
+def as_text(names):
+    """
+    The comma-separated form the API has always used for a product's tags.
+    """
+    return ','.join(names)
@@ -0,0 +1,82 @@
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+
+
+# Version stamps are opaque tokens rather than counters: if a stamp is ever
+# evicted, the replacement is a fresh token, so entries written under the
+# old one can never be mistaken for current. Each one starts with the time
+# it was made, which is all that is read back out of it (stamp_time()).
+
+def get_cache():
+    return caches[getattr(settings, 'VERSION_CACHE_ALIAS', 'default')]
+
+
+def get_stamp_timeout():
+    """
+    How long a stamp lives: for good in a shared cache, but only
+    VERSION_LOCAL_TIMEOUT seconds in a process-local one, where a bump
+    reaches no other worker. There the stamp running out is what makes the
+    other workers drop what it covered, so this bounds how stale they get.
+    """
+    if isinstance(get_cache(), LocMemCache):
+        return getattr(settings, 'VERSION_LOCAL_TIMEOUT', 60)
+    return None
+
+
+def _key(name):
+    return f'version:{name}'
+
+
+def _new_stamp():
+    return f'{int(time.time()):08x}{uuid.uuid4().hex[:12]}'
+
+
+def stamp_time(stamp):
+    """
+    When `stamp` was made, as a Unix time; None for a stamp from before they
+    carried one.
+    """
+    if len(stamp) != 20:
+        return None
+    return int(stamp[:8], 16)
+
+
+def get_version(name):
+    cache = get_cache()
+    stamp = cache.get(_key(name))
+    if stamp is None:
+        cache.add(_key(name), _new_stamp(), get_stamp_timeout())
+        stamp = cache.get(_key(name))
+    return stamp
+
+
+def get_versions(names):
+    cache = get_cache()
+    keys = {_key(name): name for name in names}
+    found = cache.get_many(keys)
+    stamps = {keys[key]: stamp for key, stamp in found.items()}
+    for name in names:
+        if name not in stamps:
+            stamps[name] = get_version(name)
+    return stamps
+
+
+def bump_version(name):
+    stamp = _new_stamp()
+    get_cache().set(_key(name), stamp, get_stamp_timeout())
+    return stamp
+
+
+def bump_version_on_commit(name):
+    """
+    Bump `name` now and again once the current transaction commits, so a
+    reader that rebuilt an entry from the not-yet-committed state in between
+    doesn't leave it cached under the new stamp.
+    """
+    bump_version(name)
+    transaction.on_commit(lambda: bump_version(name))
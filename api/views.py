@@ -1,16 +1,40 @@
+import io
+import json
+import uuid
+from datetime import date, timedelta
+from decimal import Decimal, InvalidOperation
+
 from django.contrib.auth import get_user_model
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.http import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from rest_framework import viewsets, generics, permissions
+from rest_framework.decorators import action
+from rest_framework.exceptions import NotFound
+from rest_framework.parsers import MultiPartParser
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+from api.utils import (
+    carts, catalog_cache, category_tree, conditional, coupons, delivery_assignment, facets, idempotency, jobs,
+    order_export, postal_codes, product_import, profiling, sales_rollups, stats, tags,
+)
+from api.utils.inventory import InsufficientStock, reserve_stock
+from api.utils.order_calculator import price_cart
 
-from api.utils.order_calculator import calculate_order_summary
+from .filters import FullTextSearchFilter, OrderExportFilter, ProductFilter, ProductListingFilter
+from .mixins import CatalogCacheMixin, ConditionalGetMixin
 
+from .pagination import DeliveryCursorPagination, KeysetCursorPagination
 from .permissions import IsAdminOrReadOnly
-from .models import Category, OrderItem, PostalCode, Product, Cart, Address, Order, Delivery, Payment, ProductVariant
+from .models import (
+    Category, OrderItem, PostalCode, Product, ProductListing, Cart, Address, Order, Delivery, Payment, ProductVariant,
+)
 from .serializers import (
     CategorySerializer, PostalCodeSerializer, UserSerializer, RegisterSerializer, ProductSerializer, 
     CartSerializer, AddressSerializer, OrderSerializer, 
-    DeliverySerializer, PaymentSerializer
+    DeliverySerializer, PaymentSerializer, SetCartSerializer
 )
 from django.contrib.auth import authenticate
 from rest_framework.authtoken.models import Token
@@ -36,24 +60,158 @@ class UserViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = [IsAuthenticated]
 
 
-class CategoryViewSet(viewsets.ModelViewSet):
+class CategoryViewSet(CatalogCacheMixin, viewsets.ModelViewSet):
+    cache_entity = 'category'
+    cache_whole_list = True
     queryset = Category.objects.all()
     serializer_class = CategorySerializer
     permission_classes = [IsAdminOrReadOnly]
     filter_backends = [SearchFilter]
     search_fields = ['name']
 
+    @action(detail=False)
+    def tree(self, request):
+        """
+        Every category nested under its parent, built from one query.
+        """
+        def build():
+            categories = self.get_serializer(self.get_queryset().order_by('name'), many=True).data
+            return category_tree.build_tree(categories)
+
+        not_modified = self.not_modified(['category:*'])
+        if not_modified is not None:
+            return not_modified
+        return Response(catalog_cache.get_collection('category', build, f'{self.get_cache_scope()}tree'))
 
 
-class ProductViewSet(viewsets.ModelViewSet):
-    queryset = Product.objects.all()
+class ProductViewSet(CatalogCacheMixin, viewsets.ModelViewSet):
+    cache_entity = 'product'
+    queryset = ProductSerializer.setup_eager_loading(Product.objects.all())
     serializer_class = ProductSerializer
     permission_classes = [IsAdminOrReadOnly]
-    filter_backends = [DjangoFilterBackend, SearchFilter, OrderingFilter]
-    filterset_fields = ['name', 'category__name']
+    pagination_class = KeysetCursorPagination
+    filter_backends = [DjangoFilterBackend, FullTextSearchFilter, OrderingFilter]
+    filterset_class = ProductFilter
+    # Only used where the FTS5 index isn't available.
     search_fields = ['name', 'category__name']
     ordering_fields = ['name', 'created_at']
 
+    @action(
+        detail=False, methods=['post'], url_path='import',
+        permission_classes=[permissions.IsAdminUser], parser_classes=[MultiPartParser],
+    )
+    def import_products(self, request):
+        """
+        Bulk create or update products from an uploaded CSV or JSONL `file`
+        (see api/utils/product_import.py). The response is NDJSON: a
+        progress line after each batch, then the final report.
+        """
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({'error': 'file is required'}, status=400)
+        fmt = request.data.get('format') or product_import.format_for(upload.name)
+        if fmt not in product_import.FORMATS:
+            return Response({'error': f'format must be one of {", ".join(product_import.FORMATS)}'}, status=400)
+
+        def lines():
+            stream = io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline='')
+            for report in product_import.run(stream, fmt):
+                yield json.dumps({'rows': report.rows, 'products': report.products, 'failed': report.failed}) + '\n'
+            yield json.dumps(report.as_dict()) + '\n'
+
+        return StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+
+
+
+class ProductListingView(generics.ListAPIView):
+    """
+    Catalog grid rows straight from the denormalized listing table: one
+    indexed query per page and no serializer.
+    """
+    queryset = ProductListing.objects.all()
+    pagination_class = KeysetCursorPagination
+    filter_backends = [DjangoFilterBackend, OrderingFilter]
+    filterset_class = ProductListingFilter
+    ordering_fields = ['min_price', 'max_price', 'name', 'created_at']
+    listing_fields = (
+        'name', 'slug', 'brand', 'category_id', 'category_slug', 'min_price', 'max_price',
+        'max_discount_percent', 'total_stock', 'in_stock', 'primary_image', 'created_at',
+    )
+    price_fields = ('min_price', 'max_price')
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        # A product without variants has no price, and a page ordered by
+        # price can't have its cursor point at it; such products are left
+        # out of those orderings.
+        ordering = OrderingFilter().get_ordering(self.request, queryset, self)
+        field = ordering[0].lstrip('-') if ordering else None
+        if field in self.price_fields:
+            queryset = queryset.exclude(**{f'{field}__isnull': True})
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        rows = self.paginate_queryset(self.filter_queryset(self.get_queryset()).values('pk', *self.listing_fields))
+        return self.get_paginated_response(self.to_payload(rows))
+
+    def to_payload(self, rows):
+        # New dicts: the paginator still reads the page's rows for the
+        # cursor positions.
+        payload = []
+        for row in rows:
+            row = dict(row)
+            row['id'] = row.pop('pk')
+            image = row.pop('primary_image')
+            row['image'] = self.request.build_absolute_uri(default_storage.url(image)) if image else None
+            payload.append(row)
+        return payload
+
+
+class ProductFacetView(ProductListingView):
+    """
+    Listing rows narrowed down by facets, plus the counts of every facet's
+    values, from the in-process facet index (api/utils/facets.py) and one
+    query for the page's rows.
+
+    Facets are `brand`, `tag`, `category` (a slug; matches its subtree),
+    `price` (a band such as `100-250`) and `availability` (`in_stock` or
+    `out_of_stock`). Repeat a parameter to match any of its values. Rows
+    come newest first; pass the `next` link for the following page.
+    """
+    page_size = 20
+    max_page_size = 100
+    facet_limit = 50
+
+    def get_page_size(self):
+        try:
+            size = int(self.request.query_params.get('page_size', self.page_size))
+        except ValueError:
+            size = self.page_size
+        return min(max(size, 1), self.max_page_size)
+
+    def list(self, request, *args, **kwargs):
+        selected = {facet: request.query_params.getlist(facet) for facet in facets.FACETS}
+        selected['tag'] = [tags.normalize(tag) for tag in selected['tag']]
+
+        cursor = request.query_params.get('cursor')
+        try:
+            after = uuid.UUID(cursor) if cursor else None
+            product_ids, more, count, counts = facets.search(selected, self.get_page_size(), after, self.facet_limit)
+        except (KeyError, ValueError):
+            raise NotFound('Invalid cursor')
+
+        rows = {}
+        if product_ids:
+            page = self.get_queryset().filter(pk__in=product_ids).values('pk', *self.listing_fields)
+            rows = {row['pk']: row for row in page}
+        return Response({
+            'count': count,
+            'next': replace_query_param(request.build_absolute_uri(), 'cursor', product_ids[-1]) if more else None,
+            # A product deleted since the index caught up is skipped.
+            'results': self.to_payload([rows[pk] for pk in product_ids if pk in rows]),
+            'facets': counts,
+        })
+
 
 
 class CartViewSet(viewsets.ModelViewSet):
@@ -61,7 +219,8 @@ class CartViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return Cart.objects.filter(user=self.request.user)
+        carts.flush(self.request.user)
+        return CartSerializer.setup_eager_loading(Cart.objects.filter(user=self.request.user))
 
 
 
@@ -79,21 +238,56 @@ class AddressViewSet(viewsets.ModelViewSet):
 class OrderViewSet(viewsets.ModelViewSet):
     serializer_class = OrderSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetCursorPagination
+    ordering_fields = ['created_at', 'status', 'total_amount']
 
     def get_queryset(self):
-        return Order.objects.filter(user=self.request.user)
+        return OrderSerializer.setup_eager_loading(Order.objects.filter(user=self.request.user))
+
+
+
+class OrderExportView(generics.GenericAPIView):
+    """
+    Every order matching the filters (see OrderExportFilter), one row per
+    item with its payment and delivery, streamed as CSV or, with
+    `?output=jsonl`, one JSON object per line.
+    """
+    queryset = Order.objects.all()
+    permission_classes = [permissions.IsAdminUser]
+    filter_backends = [DjangoFilterBackend]
+    filterset_class = OrderExportFilter
+
+    def get(self, request):
+        fmt = request.query_params.get('output', 'csv')
+        if fmt not in order_export.FORMATS:
+            return Response({'error': f'output must be one of {", ".join(order_export.FORMATS)}'}, status=400)
+        orders = self.filter_queryset(self.get_queryset())
+        response = StreamingHttpResponse(order_export.stream(orders, fmt), content_type=order_export.CONTENT_TYPES[fmt])
+        response['Content-Disposition'] = f'attachment; filename="orders.{fmt}"'
+        return response
 
 
 
 class DeliveryViewSet(viewsets.ModelViewSet):
     serializer_class = DeliverySerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = DeliveryCursorPagination
+    ordering_fields = ['id', 'delivery_status', 'delivered_at']
 
     def get_queryset(self):
         if self.request.user.is_staff:
             return Delivery.objects.all()
         return Delivery.objects.filter(order__user=self.request.user)
 
+    @action(detail=False, methods=['post'], url_path='rider-offline', permission_classes=[permissions.IsAdminUser])
+    def rider_offline(self, request):
+        rider = get_object_or_404(User, id=request.data.get('rider_id'), user_role='Delivery_Person')
+        with transaction.atomic():
+            rider.is_available = False
+            rider.save(update_fields=['is_available'])
+            moved = delivery_assignment.reassign_rider(rider)
+        return Response({'message': 'Rider marked offline', 'reassigned': moved}, status=200)
+
 
 
 class PaymentViewSet(viewsets.ModelViewSet):
@@ -127,6 +321,78 @@ class LogoutView(APIView):
         request.auth.delete()
         return Response({"message": "Logged out successfully"}, status=status.HTTP_200_OK)
 
+class StatsView(APIView):
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(stats.snapshot_all())
+
+
+class RequestStatsView(APIView):
+    """
+    Per-view latency, query count, SQL time and response size histograms of
+    every worker, and the slowest requests recorded.
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        return Response(profiling.collect())
+
+    def delete(self, request):
+        profiling.reset()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class JobStatsView(APIView):
+    """
+    Background jobs per task: how many are queued, running, done and failed,
+    and the wait and run time percentiles of those finished in the last
+    `?window=` seconds (an hour by default).
+    """
+    permission_classes = [permissions.IsAdminUser]
+
+    def get(self, request):
+        try:
+            window = int(request.query_params.get('window', 3600))
+        except ValueError:
+            return Response({'error': 'Invalid window'}, status=400)
+        return Response(jobs.metrics(window))
+
+
+class SalesReportView(APIView):
+    """
+    Sales totals over a range of days, summed from the daily rollups (see
+    api/utils/sales_rollups.py). `?by=` is day, coupon, variant, product
+    or category; `?start=` and `?end=` are inclusive dates, the last 30
+    days by default. `?category=` narrows variant, product and category
+    totals to a subtree, and `?limit=` caps all but the daily ones.
+    """
+    permission_classes = [permissions.IsAdminUser]
+    default_days = 30
+    default_limit = 50
+    max_limit = 1000
+
+    def get(self, request):
+        params = request.query_params
+        by = params.get('by', 'day')
+        if by not in sales_rollups.GROUPS:
+            return Response({'error': f'by must be one of {", ".join(sales_rollups.GROUPS)}'}, status=400)
+        try:
+            end = date.fromisoformat(params['end']) if params.get('end') else timezone.localdate()
+            start = date.fromisoformat(params['start']) if params.get('start') else (
+                end - timedelta(days=self.default_days - 1)
+            )
+            category = uuid.UUID(params['category']) if params.get('category') else None
+            limit = min(max(int(params.get('limit', self.default_limit)), 1), self.max_limit)
+        except ValueError:
+            return Response({'error': 'Invalid start, end, category or limit'}, status=400)
+        if start > end:
+            return Response({'error': 'start is after end'}, status=400)
+
+        results = sales_rollups.report(by, start, end, category, None if by == 'day' else limit)
+        return Response({'by': by, 'start': start, 'end': end, 'results': results})
+
+
 class PostalCodeViewSet(viewsets.ModelViewSet):
     queryset = PostalCode.objects.all()
     serializer_class = PostalCodeSerializer
@@ -136,53 +402,127 @@ class PostalCodeViewSet(viewsets.ModelViewSet):
 class ValidatePostalCodeView(APIView):
     def post(self, request):
         user_postal_code = request.data.get('postal_code')
-        print(user_postal_code)
         if not user_postal_code:
             return Response({"error": "Postal code is required"}, status=status.HTTP_400_BAD_REQUEST)
 
-        if PostalCode.objects.filter(code=user_postal_code).exists():
+        if postal_codes.is_serviceable(user_postal_code):
             return Response({"message": "Service available in your area"}, status=status.HTTP_200_OK)
         
         return Response({"message": "Service not available in your area"}, status=status.HTTP_404_NOT_FOUND)
 
 
+class ValidatePostalCodeBatchView(APIView):
+    max_codes = 1000
+
+    def post(self, request):
+        codes = request.data.get('postal_codes')
+        if not isinstance(codes, list) or not codes:
+            return Response({"error": "postal_codes must be a non-empty list"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(codes) > self.max_codes:
+            return Response(
+                {"error": f"At most {self.max_codes} postal codes per request"}, status=status.HTTP_400_BAD_REQUEST
+            )
+
+        return Response({"results": postal_codes.check_many(codes)}, status=status.HTTP_200_OK)
+
+
+class ApplicableCouponsView(APIView):
+    """
+    Coupons a subtotal qualifies for, best first. Without ?subtotal= the
+    signed-in user's cart is priced.
+    """
+
+    def get(self, request):
+        subtotal = request.query_params.get('subtotal')
+        if subtotal is not None:
+            try:
+                subtotal = Decimal(subtotal)
+            except InvalidOperation:
+                subtotal = None
+            if subtotal is None or not subtotal.is_finite():
+                return Response({'error': 'subtotal must be a number'}, status=status.HTTP_400_BAD_REQUEST)
+        elif request.user.is_authenticated:
+            carts.flush(request.user)
+            subtotal = price_cart(request.user)['subtotal']
+        else:
+            return Response({'error': 'subtotal is required'}, status=status.HTTP_400_BAD_REQUEST)
+
+        applicable = coupons.applicable(subtotal)
+        return Response({
+            'subtotal': subtotal,
+            'best': applicable[0]._asdict() if applicable else None,
+            'coupons': [coupon._asdict() for coupon in applicable],
+        })
+
+
 class AddToCartAPIView(APIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def post(self, request):
-        product_id = request.data.get('product_id')
-        quantity = int(request.data.get('quantity', 1))
-
-        product = get_object_or_404(ProductVariant, id=product_id)
-        cart_item, created = Cart.objects.get_or_create(
-            user=request.user,
-            product=product,
-            defaults={'quantity': quantity}
-        )
+        try:
+            product_id = int(request.data.get('product_id'))
+            quantity = int(request.data.get('quantity', 1))
+        except (TypeError, ValueError):
+            return Response({'error': 'product_id and quantity must be integers'}, status=400)
+        if quantity < 1:
+            return Response({'error': 'quantity must be at least 1'}, status=400)
 
-        if not created:
-            cart_item.quantity += quantity
-            cart_item.save()
+        try:
+            carts.add_item(request.user, product_id, quantity)
+        except carts.UnknownVariants:
+            raise NotFound('No ProductVariant matches the given query.')
 
         return Response({'message': 'Item added to cart successfully'}, status=200)
 
 
+class SetCartAPIView(APIView):
+    """
+    Set the quantities of many cart lines at once, in one transaction:
+    `{"items": [{"product_id": 1, "quantity": 2}, ...], "replace": false}`.
+    A quantity of 0 removes the line; with `replace`, so does leaving it
+    out. Responds with the repriced cart.
+    """
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        serializer = SetCartSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        quantities = {line['product_id']: line['quantity'] for line in serializer.validated_data['items']}
+
+        try:
+            carts.set_items(request.user, quantities, serializer.validated_data['replace'])
+        except carts.UnknownVariants as e:
+            return Response({'error': str(e), 'product_ids': e.variant_ids}, status=400)
+
+        return Response(price_cart(request.user))
+
+
 class CartListAPIView(generics.ListAPIView):
     serializer_class = CartSerializer
     permission_classes = [permissions.IsAuthenticated]
 
     def get_queryset(self):
-        return Cart.objects.filter(user=self.request.user)
+        carts.flush(self.request.user)
+        return CartSerializer.setup_eager_loading(Cart.objects.filter(user=self.request.user))
 
 
 
 
-class UserOrdersAPIView(generics.ListAPIView):
+class UserOrdersAPIView(ConditionalGetMixin, generics.ListAPIView):
     serializer_class = OrderSerializer
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = KeysetCursorPagination
+    conditional_entity = 'orders'
+    conditional_private = True
 
     def get_queryset(self):
-        return Order.objects.filter(user=self.request.user)
+        return OrderSerializer.setup_eager_loading(Order.objects.filter(user=self.request.user))
+
+    def list(self, request, *args, **kwargs):
+        not_modified = self.not_modified(conditional.order_history_names(request.user.pk))
+        if not_modified is not None:
+            return not_modified
+        return super().list(request, *args, **kwargs)
     
 class DeliveryStatusUpdateAPIView(APIView):
     permission_classes = [permissions.IsAuthenticated]
@@ -210,19 +550,17 @@ class DeliveryStatusUpdateAPIView(APIView):
 
 class CheckoutAPIView(APIView):
     def post(self, request):
-        cart_items = Cart.objects.filter(user=request.user)
-        if not cart_items.exists():
-            return Response({'error': 'Cart is empty'}, status=400)
-
-        
         coupon_code = request.data.get('coupon_code')
 
-        address = get_object_or_404(Address, user=request.user)
-
+        carts.flush(request.user)
         try:
-            summary = calculate_order_summary(cart_items, coupon_code)
+            summary = price_cart(request.user, coupon_code)
         except ValueError as e:
             return Response({'error': str(e)}, status=400)
+        if not summary['lines']:
+            return Response({'error': 'Cart is empty'}, status=400)
+
+        address = get_object_or_404(Address, user=request.user)
 
         return Response({
             **summary,
@@ -232,51 +570,71 @@ class CheckoutAPIView(APIView):
     
 
 class PlaceOrderAPIView(APIView):
+    """
+    Send an `Idempotency-Key` header to make retries safe: a repeat of a
+    placed order gets its response back instead of placing another (see
+    api/utils/idempotency.py).
+    """
+
     def post(self, request):
-        cart_items = Cart.objects.filter(user=request.user)
-        if not cart_items.exists():
-            return Response({'error': 'Cart is empty'}, status=400)
+        return idempotency.run(request, lambda claim: self.place_order(request, claim))
 
+    def place_order(self, request, claim):
         # address_id = request.data.get('address_id')
         coupon_code = request.data.get('coupon_code')
         note = request.data.get('note', '')
 
-        address = get_object_or_404(Address, user=request.user)
-
+        carts.flush(request.user)
         try:
-            summary = calculate_order_summary(cart_items, coupon_code)
+            with transaction.atomic():
+                # Usually already priced (and memoized) by the checkout step;
+                # checked against the cart and prices as they are now.
+                summary = price_cart(request.user, coupon_code, verify=True)
+                lines = summary['lines']
+                if not lines:
+                    return Response({'error': 'Cart is empty'}, status=400)
+
+                get_object_or_404(Address, user=request.user)
+
+                order = Order.objects.create(
+                    user=request.user,
+                    note=note,
+                    coupon_code=coupon_code,
+                    discount_amount=summary['discount'],
+                    tax_amount=summary['tax_amount'],
+                    shipping_fee=summary['shipping_fee'],
+                    total_amount=summary['total_amount']
+                )
+
+                OrderItem.objects.bulk_create([
+                    OrderItem(
+                        order=order,
+                        product_id=line['variant_id'],
+                        quantity=line['quantity'],
+                        price_at_order=line['unit_price']
+                    )
+                    for line in lines
+                ])
+                reserve_stock((line['variant_id'], line['quantity']) for line in lines)
+
+                Payment.objects.create(
+                    order=order,
+                    payment_method='cod',
+                    payment_status='pending',
+                    amount_paid=summary['total_amount']
+                )
+
+                # A rider is picked off the request, by a job (api/tasks.py).
+                Delivery.objects.create(order=order)
+                jobs.enqueue('assign_delivery', str(order.pk))
+
+                Cart.objects.filter(pk__in=[line['cart_id'] for line in lines]).delete()
+
+                data = {'message': 'Order placed successfully', 'order_id': str(order.pk)}
+                idempotency.store(claim, 201, data)
         except ValueError as e:
             return Response({'error': str(e)}, status=400)
+        except InsufficientStock as e:
+            return Response({'error': str(e), 'variants': e.variant_ids}, status=status.HTTP_409_CONFLICT)
 
-        order = Order.objects.create(
-            user=request.user,
-            note=note,
-            coupon_code=coupon_code,
-            discount_amount=summary['discount'],
-            tax_amount=summary['tax_amount'],
-            shipping_fee=summary['shipping_fee'],
-            total_amount=summary['total_amount']
-        )
-
-        for item in cart_items:
-            OrderItem.objects.create(
-                order=order,
-                product=item.product,
-                quantity=item.quantity,
-                price_at_order=item.product.discounted_price()
-            )
-
-        Payment.objects.create(
-            order=order,
-            payment_method='cod',
-            payment_status='pending',
-            amount_paid=summary['total_amount']
-        )
-
-        delivery_persons = User.objects.filter(user_role='Delivery_Person')
-        if delivery_persons.exists():
-            Delivery.objects.create(order=order, delivery_person=delivery_persons.first())
-
-        cart_items.delete()
-
-        return Response({'message': 'Order placed successfully'}, status=201)
+        return Response(data, status=201)
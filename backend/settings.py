@@ -45,6 +45,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.RequestProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -82,9 +83,94 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Every transaction.atomic() block, read-only ones included,
+            # takes the database write lock when it opens rather than at its
+            # first write. Concurrent checkouts then queue up behind the busy
+            # timeout instead of failing with "database is locked" when a
+            # reader tries to upgrade, and atomic blocks never interleave:
+            # stock reservation, the sales rollup job and rider assignment
+            # (api/tasks.py) count on that, as select_for_update() does
+            # nothing on SQLite. The cost is that atomic blocks run one at a
+            # time across all workers, however little they write, and a
+            # slow one holds up the rest for up to `timeout` seconds; reads
+            # outside atomic() aren't affected.
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+        'TEST': {
+            # A file rather than shared-cache memory, so tests that write from
+            # several threads get the busy timeout too.
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
+    }
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+#
+# Local memory by default. Point DJANGO_CACHE_BACKEND at e.g.
+# django.core.cache.backends.filebased.FileBasedCache (with
+# DJANGO_CACHE_LOCATION set to a directory) to share entries and version
+# stamps between worker processes. With more than one worker, do: in local
+# memory a write made through one worker bumps only that worker's stamps,
+# so the others serve cached payloads, ETags and registries from before it
+# until their stamps run out after VERSION_LOCAL_TIMEOUT seconds. Each
+# worker also rebuilds its in-process indexes (facets, postal codes,
+# coupons) that often, stamp changed or not.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.environ.get('DJANGO_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('DJANGO_CACHE_LOCATION', 'storefront'),
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+        },
     }
 }
 
+VERSION_LOCAL_TIMEOUT = 60
+
+# Serialized product and category payloads; invalidated by api/signals.py.
+CATALOG_CACHE_TIMEOUT = 60 * 60
+
+# Memoized cart price quotes (api/utils/order_calculator.py), reused by
+# checkout and order placement until the cart, a price or a coupon changes.
+CART_PRICING_CACHE_TIMEOUT = 15 * 60
+
+# Upper bounds of the price bands products are faceted by (on their
+# cheapest variant); api/utils/facets.py adds an open-ended top band.
+FACET_PRICE_BANDS = (100, 250, 500, 1000)
+
+# Keep add-to-cart clicks in the cache and write them to the Cart table
+# when the cart is next read (listing, pricing, checkout); see
+# api/utils/carts.py. Needs a cache shared by every worker, and buffered
+# adds are lost if the cache evicts them.
+CART_WRITE_BUFFER = False
+
+# Delivery assignment (api/utils/delivery_assignment.py): open deliveries a
+# rider may hold, and how often each worker re-reads rider loads.
+DELIVERY_RIDER_CAPACITY = 5
+DELIVERY_INDEX_TTL = 60
+
+# Background jobs (api/utils/jobs.py, run by `manage.py run_jobs`): the
+# first retry's delay in seconds, doubling up to JOB_RETRY_MAX, and how
+# long finished jobs are kept for the stats.
+JOB_RETRY_BASE = 5
+JOB_RETRY_MAX = 600
+JOB_RETENTION = 7 * 24 * 60 * 60
+
+# Per-view latency/query histograms (api/middleware.py). Set
+# REQUEST_PROFILING_SLOW_MS to log, and keep the SQL of, requests slower
+# than that many milliseconds. Workers publish their histograms to the
+# cache every REQUEST_PROFILING_PUBLISH_INTERVAL seconds; those not
+# published again within REQUEST_PROFILING_WORKER_TTL seconds are dropped.
+REQUEST_PROFILING_ENABLED = True
+REQUEST_PROFILING_SLOW_MS = None
+REQUEST_PROFILING_PUBLISH_INTERVAL = 10
+REQUEST_PROFILING_WORKER_TTL = 10 * 60
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -127,6 +213,12 @@ STATIC_URL = '/static/'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Resized WebP (and AVIF, where Pillow supports it) copies of uploaded
+# product and category images, generated off the request thread.
+IMAGE_DERIVATIVE_WIDTHS = (160, 320, 640, 1024)
+IMAGE_DERIVATIVE_WORKERS = 2
+IMAGE_DERIVATIVES_ASYNC = True
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/3.2/ref/settings/#default-auto-field
@@ -141,5 +233,9 @@ REST_FRAMEWORK = {
         'rest_framework.filters.OrderingFilter',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
-    ],}
\ No newline at end of file
+        'api.authentication.CachedTokenAuthentication',
+    ],}
+
+# Token -> user lookups kept per worker by CachedTokenAuthentication.
+TOKEN_AUTH_CACHE_TTL = 300
+TOKEN_AUTH_CACHE_MAX_ENTRIES = 10000
\ No newline at end of file
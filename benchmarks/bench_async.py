@@ -0,0 +1,71 @@
+"""
+Sync (DRF) vs. async read endpoints, served over WSGI (Django's threaded
+server) and ASGI (uvicorn, or daphne), at rising client concurrency.
+
+    python benchmarks/bench_async.py [--products 100000] [--users 50000]
+        [--concurrency 8 64 256] [--requests 2000] [--transport wsgi asgi]
+
+Uses the suite's dataset and scenarios; point BENCH_DB at the suite's
+database to skip seeding. Prints requests per second and p50/p99 latency
+of each endpoint pair, sync first.
+"""
+import argparse
+import os
+import tempfile
+
+from common import seed_products, seed_users, setup_django
+from suite import SCENARIOS, Context, asgi_server_available, run_server, start_server
+
+PAIRS = [
+    ('catalog_list', 'async_catalog_list'),
+    ('product_detail', 'async_product_detail'),
+    ('category_tree', 'async_category_tree'),
+    ('order_history', 'async_order_history'),
+    ('validate_postal', 'async_validate_postal'),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=100_000)
+    parser.add_argument('--users', type=int, default=50_000)
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[8, 64, 256])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=50)
+    parser.add_argument('--transport', nargs='+', default=['wsgi', 'asgi'], choices=['wsgi', 'asgi'])
+    args = parser.parse_args()
+
+    if not os.environ.get('BENCH_DB'):
+        os.environ['BENCH_DB'] = os.path.join(tempfile.mkdtemp(), 'suite.sqlite3')
+    db_path = os.environ['BENCH_DB']
+    setup_django(db_path)
+    seed_products(args.products)
+    seed_users(args.users)
+    ctx = Context(args.requests + args.warmup)
+    scenarios = {scenario.name: scenario for scenario in SCENARIOS}
+
+    for transport in args.transport:
+        if transport == 'asgi' and not asgi_server_available():
+            print('Skipping asgi: neither uvicorn nor daphne is installed.')
+            continue
+        server, port = start_server(transport, db_path)
+        try:
+            for concurrency in args.concurrency:
+                print(f'\n{transport}, {concurrency} concurrent clients')
+                for pair in PAIRS:
+                    for name in pair:
+                        # A first, untimed pass fills the catalog cache, which
+                        # both views of a pair share.
+                        run_server(ctx, scenarios[name], args.requests, args.warmup, port, concurrency)
+                        result = run_server(ctx, scenarios[name], args.requests, args.warmup, port, concurrency)
+                        print(
+                            f'  {name:<24} {result["ops_per_s"]:8.1f} req/s   p50 {result["p50_ms"]:8.2f} ms   '
+                            f'p99 {result["p99_ms"]:8.2f} ms   errors {result["errors"]}'
+                        )
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
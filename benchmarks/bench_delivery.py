@@ -0,0 +1,72 @@
+"""
+Delivery assignment: grid index lookup vs. a linear scan over every rider,
+and the full DB-backed choose_rider() path.
+
+    python benchmarks/bench_delivery.py [--riders 5000] [--iterations 2000]
+"""
+import argparse
+import random
+
+from common import measure, report, setup_django, summarize
+
+# Roughly the Bengaluru metro area.
+LAT, LON, SPAN = 12.85, 77.45, 0.35
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--riders', type=int, default=5000)
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    setup_django()
+
+    from django.contrib.auth import get_user_model
+
+    from api.models import Address
+    from api.utils import delivery_assignment
+    from api.utils.delivery_assignment import RiderIndex, distance_km
+
+    rng = random.Random(3)
+
+    def point():
+        return LAT + rng.random() * SPAN, LON + rng.random() * SPAN
+
+    riders = [(index, *point()) for index in range(args.riders)]
+    loads = {index: rng.randint(0, 5) for index in range(args.riders)}
+    index = RiderIndex(riders, loads, capacity=5)
+
+    def grid():
+        index.nearest(*point())
+
+    def linear():
+        latitude, longitude = point()
+        min(
+            (distance_km(latitude, longitude, lat, lon), rider_id)
+            for rider_id, lat, lon in riders if loads[rider_id] < 5
+        )
+
+    report(f'grid nearest ({args.riders} riders)', summarize(measure(grid, args.iterations)))
+    report(f'linear scan ({args.riders} riders)', summarize(measure(linear, args.iterations // 10)))
+
+    User = get_user_model()
+    if not User.objects.filter(user_role='Delivery_Person').exists():
+        users = User.objects.bulk_create([
+            User(username=f'rider{index}', full_name=f'Rider {index}', user_role='Delivery_Person')
+            for index in range(args.riders)
+        ])
+        Address.objects.bulk_create([
+            Address(user=user, address_line='Depot', city='Bengaluru', postal_code='560001',
+                    latitude=lat, longitude=lon, is_default=True)
+            for user, (_, lat, lon) in zip(users, riders)
+        ])
+        delivery_assignment.invalidate()
+
+    report('build index from DB', summarize(measure(delivery_assignment.build_index, 10, warmup=1)))
+    report('choose_rider (index + load recount)', summarize(
+        measure(lambda: delivery_assignment.choose_rider(*point()), args.iterations // 4)
+    ))
+
+
+if __name__ == '__main__':
+    main()
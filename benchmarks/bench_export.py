@@ -0,0 +1,66 @@
+"""
+Order export: rows per second and peak memory of the streaming export over
+a growing share of the order history.
+
+    python benchmarks/bench_export.py [--products 20000] [--users 20000]
+
+Exports the last month, quarter and year of orders, as CSV and JSONL, by
+draining the view's streaming response, so the time includes the query,
+encoding and the response iteration. Peak memory is traced in a separate
+pass; it should stay flat as the number of rows grows.
+"""
+import argparse
+import time
+import tracemalloc
+from datetime import timedelta
+
+from common import seed_products, seed_users, setup_django
+
+PERIODS = [('month', 30), ('quarter', 91), ('year', 366)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=20_000)
+    parser.add_argument('--users', type=int, default=20_000)
+    args = parser.parse_args()
+
+    setup_django()
+    seed_products(args.products)
+    seed_users(args.users)
+
+    from django.utils import timezone
+    from rest_framework.test import APIClient
+
+    from api.models import CustomUser
+
+    admin, _ = CustomUser.objects.get_or_create(username='bench-admin', defaults={'is_staff': True})
+    client = APIClient()
+    client.force_authenticate(admin)
+
+    def export(fmt, days):
+        since = (timezone.now() - timedelta(days=days)).isoformat()
+        response = client.get('/api/orders/export/', {'output': fmt, 'created_after': since})
+        size = lines = 0
+        for chunk in response.streaming_content:
+            size += len(chunk)
+            lines += chunk.count(b'\n')
+        return size, lines
+
+    for fmt in ('csv', 'jsonl'):
+        for label, days in PERIODS:
+            started = time.perf_counter()
+            size, lines = export(fmt, days)
+            elapsed = time.perf_counter() - started
+            tracemalloc.start()
+            export(fmt, days)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(
+                f'{fmt:<5} {label:<8} {lines:9} rows {size / 2 ** 20:8.1f} MiB  {lines / elapsed:9.0f} rows/s   '
+                f'peak {peak / 2 ** 20:6.1f} MiB'
+            )
+
+
+if __name__ == '__main__':
+    main()
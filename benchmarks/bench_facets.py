@@ -0,0 +1,74 @@
+"""
+Faceted product filtering: the in-process bitset index vs. one GROUP BY
+COUNT query per facet over the listing table.
+
+    python benchmarks/bench_facets.py [--products 100000] [--iterations 200]
+"""
+import argparse
+
+from common import measure, report, seed_products, setup_django, summarize
+
+SELECTIONS = [
+    {},
+    {'category': ['fruits']},
+    {'brand': ['Ooty', 'Nandini'], 'availability': ['in_stock']},
+    {'tag': ['tomato'], 'price': ['100-250'], 'category': ['organic-vegetables']},
+]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=100_000)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    setup_django()
+    seed_products(args.products)
+
+    from django.db.models import Count
+    from django.test import Client
+
+    from api.models import ProductListing
+    from api.utils import facets
+    from api.utils.versions import bump_version
+
+    client = Client()
+
+    print(f'{ProductListing.objects.count()} listings')
+    report('index build', summarize(measure(lambda: (bump_version(facets.VERSION), facets.get_index()), 5, 1)))
+
+    def replay():
+        facets.changed(ProductListing.objects.values_list('pk', flat=True)[:20])
+        facets.get_index()
+
+    report('replay 20 changed products', summarize(measure(replay, args.iterations)))
+
+    for selected in SELECTIONS:
+        label = '&'.join(f'{facet}={",".join(values)}' for facet, values in selected.items()) or 'all'
+
+        def index():
+            facets.search(selected, 20, limit=50)
+
+        def group_by():
+            # Roughly what the index replaces: a COUNT per facet (tags and
+            # category subtrees left out, which would cost more still).
+            queryset = ProductListing.objects.all()
+            if 'brand' in selected:
+                queryset = queryset.filter(brand__in=selected['brand'])
+            if 'availability' in selected:
+                queryset = queryset.filter(in_stock=selected['availability'] == ['in_stock'])
+            list(queryset.order_by('-created_at')[:20])
+            queryset.count()
+            for field in ('brand', 'in_stock', 'category_slug'):
+                list(queryset.order_by().values(field).annotate(count=Count('pk')))
+
+        def endpoint():
+            assert client.get('/api/products/facets/', selected).status_code == 200
+
+        report(f'index     {label}', summarize(measure(index, args.iterations)))
+        report(f'GROUP BY  {label}', summarize(measure(group_by, max(10, args.iterations // 10))))
+        report(f'GET /api/products/facets/?{label}', summarize(measure(endpoint, args.iterations)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""
+Retry storms on order placement: what each retry costs, and what it gets
+back, once the first attempt has placed the order. With an
+Idempotency-Key it's a replay of the 201; without one the pipeline runs
+again and, the cart being empty by now, tells the client it failed.
+(Retries racing the first attempt are covered by the tests.)
+
+    python benchmarks/bench_idempotency.py [--products 5000] [--orders 200] [--retries 5]
+"""
+import argparse
+import time
+from collections import Counter
+
+from common import seed_products, setup_django
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--orders', type=int, default=200)
+    parser.add_argument('--retries', type=int, default=5)
+    args = parser.parse_args()
+
+    setup_django()
+    seed_products(args.products)
+
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from rest_framework.test import APIClient
+
+    from api.models import Address, Cart, CustomUser, ProductVariant
+
+    variants = list(ProductVariant.objects.values_list('pk', flat=True)[:4])
+    # Stock running out would fail first attempts, which aren't kept.
+    ProductVariant.objects.filter(pk__in=variants).update(stock=10 ** 6)
+
+    def shopper(name):
+        user, _ = CustomUser.objects.get_or_create(username=name, defaults={'full_name': name})
+        Address.objects.get_or_create(user=user, defaults={
+            'address_line': '1 Main Road', 'city': 'Bengaluru', 'postal_code': '560001',
+        })
+        Cart.objects.bulk_create([Cart(user=user, product_id=pk, quantity=1) for pk in variants],
+                                 ignore_conflicts=True)
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    stamp = int(time.time())
+    for label, with_key in (('with Idempotency-Key', True), ('without a key', False)):
+        clients = [shopper(f'idem-{with_key:d}-{stamp}-{index}') for index in range(args.orders)]
+        headers = lambda index: {'HTTP_IDEMPOTENCY_KEY': f'order-{index}'} if with_key else {}
+
+        started = time.perf_counter()
+        for index, client in enumerate(clients):
+            assert client.post('/api/order/place/', **headers(index)).status_code == 201
+        placed = time.perf_counter() - started
+
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            codes = Counter(
+                client.post('/api/order/place/', **headers(index)).status_code
+                for _ in range(args.retries) for index, client in enumerate(clients)
+            )
+            retried = time.perf_counter() - started
+        count = args.orders * args.retries
+        print(
+            f'{label:<22} first attempt {placed / args.orders * 1000:6.2f} ms   '
+            f'retry {retried / count * 1000:6.2f} ms, {len(queries) / count:5.1f} queries, status {dict(codes)}'
+        )
+
+
+if __name__ == '__main__':
+    main()
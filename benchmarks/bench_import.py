@@ -0,0 +1,100 @@
+"""
+Bulk product import: batched upserts vs. saving each row through the ORM.
+
+    python benchmarks/bench_import.py [--rows 50000] [--batch-size 1000] [--sample 500]
+
+Writes a CSV of `--rows` products (two variants each, so two rows per
+product), imports it into a fresh database, then imports it again, which
+updates every row. The per-row baseline creates a `--sample` of the same
+rows one model save at a time, the way signals-driven code would. Prints
+rows per second of each, and the peak memory of an import, which
+depends on the batch size rather than the file's.
+"""
+import argparse
+import csv
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from common import BRANDS, WORDS, seed_categories, setup_django
+
+
+def write_csv(path, rows, categories, seed=1):
+    rng = random.Random(seed)
+    with open(path, 'w', newline='') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(['name', 'slug', 'description', 'category', 'brand', 'tags', 'unit', 'price', 'stock'])
+        for index in range(rows // 2):
+            words = rng.sample(WORDS, 3)
+            product = [
+                ' '.join(words[:2]).title(), f'import-{index}', f'Fresh {words[0]} with {words[2]}.',
+                rng.choice(categories), rng.choice(BRANDS), ','.join(rng.sample(WORDS, 2)),
+            ]
+            for unit in ('500g', '1kg'):
+                writer.writerow(product + [unit, rng.randint(20, 500), rng.randint(0, 50)])
+
+
+def timed(label, rows, run):
+    started = time.perf_counter()
+    result = run()
+    elapsed = time.perf_counter() - started
+    print(f'{label:<36} {rows / elapsed:10.0f} rows/s   {elapsed:7.2f} s')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=50_000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    parser.add_argument('--sample', type=int, default=500)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    setup_django(os.path.join(directory, 'import.sqlite3'))
+
+    from decimal import Decimal
+
+    from api.models import Product, ProductVariant
+    from api.utils import product_import, tags
+
+    categories = [category.slug for category in seed_categories()]
+    path = os.path.join(directory, 'products.csv')
+    write_csv(path, args.rows, categories)
+
+    def run_import():
+        with open(path, newline='') as handle:
+            return product_import.import_products(handle, 'csv', args.batch_size)
+
+    for label in ('import (new products)', 're-import (updates)'):
+        report = timed(label, args.rows, run_import)
+        assert report.failed == 0, report.errors[:5]
+    print(f'{Product.objects.count()} products, {ProductVariant.objects.count()} variants')
+
+    # Traced separately: tracemalloc slows everything down.
+    tracemalloc.start()
+    run_import()
+    print(f'peak traced memory of an import: {tracemalloc.get_traced_memory()[1] / 2 ** 20:.1f} MiB')
+    tracemalloc.stop()
+
+    def per_row():
+        category_ids = product_import.category_map()
+        with open(path, newline='') as handle:
+            for index, row in enumerate(csv.DictReader(handle)):
+                if index == args.sample:
+                    break
+                product, _ = Product.objects.get_or_create(slug=f'orm-{row["slug"]}', defaults={
+                    'name': row['name'], 'description': row['description'],
+                    'category_id': category_ids[row['category']], 'brand': row['brand'],
+                })
+                tags.set_tags(product, tags.parse(row['tags']))
+                ProductVariant.objects.update_or_create(product=product, unit=row['unit'], defaults={
+                    'price': Decimal(row['price']), 'stock': int(row['stock']),
+                })
+
+    timed(f'per-row ORM saves ({args.sample} rows)', args.sample, per_row)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Order placement with the follow-up work (rider assignment, sales rollups)
+queued as background jobs: checkout latency, then how long a worker takes
+to drain what the checkouts queued, and the queue's own wait and run time
+figures.
+
+    python benchmarks/bench_jobs.py [--products 5000] [--users 10000] [--riders 2000] [--orders 300] [--concurrency 4]
+"""
+import argparse
+import os
+import time
+
+from common import report, seed_products, seed_users, setup_django, summarize
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--riders', type=int, default=2000)
+    parser.add_argument('--orders', type=int, default=300)
+    parser.add_argument('--concurrency', type=int, default=4)
+    args = parser.parse_args()
+
+    setup_django()
+    seed_products(args.products)
+    seed_users(args.users, riders=args.riders)
+
+    from django.core.management import call_command
+    from rest_framework.test import APIClient
+
+    from api.models import Address, Cart, CustomUser, Delivery, Job, ProductVariant
+    from api.utils import jobs
+
+    variants = list(ProductVariant.objects.values_list('pk', flat=True)[:4])
+    ProductVariant.objects.filter(pk__in=variants).update(stock=10 ** 6)
+    # Riders never fill up, so every order gets one.
+    Delivery.objects.filter(delivery_status__in=('pending', 'assigned')).update(delivery_status='delivered')
+    Job.objects.all().delete()
+
+    stamp = int(time.time())
+    users, clients = [], []
+    for index in range(args.orders + 5):
+        user = CustomUser.objects.create(username=f'j{stamp % 10 ** 6}{index}', full_name='Job bench')
+        Address.objects.create(user=user, address_line='1 Main Road', city='Bengaluru', postal_code='560001',
+                               latitude=12.97, longitude=77.59, is_default=True)
+        Cart.objects.bulk_create([Cart(user=user, product_id=pk, quantity=1) for pk in variants])
+        client = APIClient()
+        client.force_authenticate(user)
+        users.append(user)
+        clients.append(client)
+
+    for client in clients[:5]:
+        assert client.post('/api/order/place/').status_code == 201
+    samples = []
+    for client in clients[5:]:
+        started = time.perf_counter()
+        assert client.post('/api/order/place/').status_code == 201
+        samples.append(time.perf_counter() - started)
+    report('place order (follow-up queued)', summarize(samples))
+
+    queued = Job.objects.filter(status='queued').count()
+    started = time.perf_counter()
+    call_command('run_jobs', '--burst', '--concurrency', str(args.concurrency), '--poll', '0.05',
+                 stdout=open(os.devnull, 'w'))
+    drained = time.perf_counter() - started
+    print(f'worker drained {queued} jobs in {drained:.2f} s ({queued / drained:.0f} jobs/s, '
+          f'{args.concurrency} threads)')
+    unassigned = Delivery.objects.filter(order__user__in=users, delivery_person__isnull=True).count()
+    print(f'deliveries left without a rider: {unassigned}')
+    for name, figures in sorted(jobs.metrics().items()):
+        print(f'  {name:<16} done {figures["done"]:5d}  failed {figures["failed"]:3d}   '
+              f'wait p50 {figures["wait_ms"]["p50"]:8.1f} ms  p99 {figures["wait_ms"]["p99"]:8.1f} ms   '
+              f'run p50 {figures["run_ms"]["p50"]:6.2f} ms  p99 {figures["run_ms"]["p99"]:6.2f} ms')
+
+
+if __name__ == '__main__':
+    main()
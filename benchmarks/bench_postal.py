@@ -0,0 +1,66 @@
+"""
+Postal code validation: in-memory index vs. the per-request EXISTS query.
+
+    python benchmarks/bench_postal.py [--codes 20000] [--iterations 2000]
+"""
+import argparse
+import random
+
+from common import measure, report, setup_django, summarize
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--codes', type=int, default=20_000)
+    parser.add_argument('--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    setup_django()
+
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+
+    from api.models import PostalCode
+    from api.utils import postal_codes
+
+    if PostalCode.objects.count() < args.codes:
+        PostalCode.objects.bulk_create(
+            [PostalCode(code=str(500000 + index)) for index in range(args.codes)], ignore_conflicts=True
+        )
+        postal_codes.invalidate()
+
+    rng = random.Random(1)
+    probes = [str(500000 + rng.randrange(args.codes * 2)) for _ in range(256)]
+    client = Client()
+    state = {'i': 0}
+
+    def next_code():
+        state['i'] += 1
+        return probes[state['i'] % len(probes)]
+
+    def exists_query():
+        PostalCode.objects.filter(code=next_code()).exists()
+
+    def index_lookup():
+        postal_codes.is_serviceable(next_code())
+
+    def endpoint():
+        client.post('/api/validate-postal/', {'postal_code': next_code()}, content_type='application/json')
+
+    def batch_endpoint():
+        client.post('/api/validate-postal/batch/', {'postal_codes': probes[:100]}, content_type='application/json')
+
+    report('EXISTS query (old hot path)', summarize(measure(exists_query, args.iterations)))
+    report('index lookup', summarize(measure(index_lookup, args.iterations)))
+    report('POST /api/validate-postal/', summarize(measure(endpoint, args.iterations)))
+    report('POST /api/validate-postal/batch/ (100)', summarize(measure(batch_endpoint, args.iterations // 10)))
+
+    with CaptureQueriesContext(connection) as queries:
+        for _ in range(100):
+            endpoint()
+    print(f'queries for 100 validations after warm-up: {len(queries)}')
+
+
+if __name__ == '__main__':
+    main()
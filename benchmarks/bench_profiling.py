@@ -0,0 +1,102 @@
+"""
+Overhead of RequestProfilingMiddleware.
+
+First the middleware alone around a view that runs a fixed number of
+queries, which isolates its per-request and per-query cost; then real
+endpoints through the test client with the middleware off, on, and on with
+slow-request SQL capture. The modes are interleaved in rounds so drift in
+machine load hits all of them alike.
+
+    python benchmarks/bench_profiling.py [--products 2000] [--rounds 20] [--batch 25]
+"""
+import argparse
+import logging
+
+from common import measure, report, seed_products, setup_django, summarize
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--batch', type=int, default=25)
+    args = parser.parse_args()
+
+    setup_django()
+    seed_products(args.products)
+
+    from django.conf import settings
+    from django.db import connection
+    from django.http import HttpResponse
+    from django.test import Client, RequestFactory, override_settings
+
+    from api.middleware import RequestProfilingMiddleware
+    from api.models import PostalCode, Product
+    from api.utils import profiling
+
+    # Every request counts as slow in the capture mode; don't print them all.
+    logging.getLogger('api.utils.profiling').disabled = True
+    PostalCode.objects.get_or_create(code='560001')
+
+    print('Middleware alone, view running 10 queries:')
+    request = RequestFactory().get('/api/products/')
+
+    def view(request):
+        with connection.cursor() as cursor:
+            for _ in range(10):
+                cursor.execute('SELECT 1')
+        return HttpResponse(b'x' * 2048)
+
+    middleware = RequestProfilingMiddleware(view)
+    direct = summarize(measure(lambda: view(request), 5000, warmup=100))
+    report('  view only', direct)
+    wrapped = summarize(measure(lambda: middleware(request), 5000, warmup=100))
+    report('  with middleware', wrapped)
+    with override_settings(REQUEST_PROFILING_SLOW_MS=0):
+        captured = summarize(measure(lambda: middleware(request), 5000, warmup=100))
+    report('  with middleware + SQL capture', captured)
+    print(f'  overhead {(wrapped["mean_ms"] - direct["mean_ms"]) * 1000:.1f} us/request, '
+          f'{(captured["mean_ms"] - direct["mean_ms"]) * 1000:.1f} us with capture')
+    profiling.reset()
+
+    detail = f'/api/products/{Product.objects.values_list("pk", flat=True).first()}/'
+    without = [name for name in settings.MIDDLEWARE if name != 'api.middleware.RequestProfilingMiddleware']
+    modes = {
+        'off': override_settings(MIDDLEWARE=without),
+        'on': override_settings(),
+        'on + SQL capture': override_settings(REQUEST_PROFILING_SLOW_MS=0),
+    }
+    clients = {}
+    for mode, override in modes.items():
+        with override:
+            clients[mode] = Client()
+            # Middleware is loaded on the first request.
+            clients[mode].get('/api/categories/')
+
+    endpoints = {
+        'product list': lambda client: client.get('/api/products/'),
+        'product detail': lambda client: client.get(detail),
+        'postal validation': lambda client: client.post(
+            '/api/validate-postal/', {'postal_code': '560001'}, content_type='application/json'
+        ),
+    }
+
+    print()
+    for name, call in endpoints.items():
+        samples = {mode: [] for mode in modes}
+        for _ in range(args.rounds):
+            for mode, override in modes.items():
+                with override:
+                    samples[mode] += measure(lambda: call(clients[mode]), args.batch, warmup=2)
+        base = summarize(samples['off'])
+        for mode in modes:
+            summary = summarize(samples[mode])
+            extra = (summary['p50_ms'] - base['p50_ms']) * 1000
+            report(f'{name} [{mode}]', summary)
+            if mode != 'off':
+                print(f'{"":<40} p50 {extra:+.0f} us vs off')
+        profiling.reset()
+
+
+if __name__ == '__main__':
+    main()
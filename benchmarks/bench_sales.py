@@ -0,0 +1,70 @@
+"""
+Sales dashboards: summing the daily rollups vs. scanning order items, and
+the rollup backfill on one worker vs. several.
+
+    python benchmarks/bench_sales.py [--products 20000] [--users 20000] [--workers 4] [--iterations 20]
+
+Point BENCH_DB at a seeded database to skip seeding. The backfill runs
+first, over the whole order history, so the rollups are complete before
+the dashboards are timed.
+"""
+import argparse
+import os
+import time
+from datetime import timedelta
+
+from common import measure, report, seed_products, seed_users, setup_django, summarize
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=20_000)
+    parser.add_argument('--users', type=int, default=20_000)
+    parser.add_argument('--workers', type=int, default=min(os.cpu_count() or 1, 4))
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    setup_django()
+    seed_products(args.products)
+    seed_users(args.users)
+
+    from django.core.management import call_command
+    from django.db.models import F, Sum
+    from django.utils import timezone
+
+    from api.models import DailyVariantSales, OrderItem
+    from api.utils import sales_rollups
+
+    for workers in sorted({1, args.workers}):
+        started = time.perf_counter()
+        call_command('rebuild_sales_rollups', '--workers', str(workers), '--days', '14', stdout=open(os.devnull, 'w'))
+        print(f'backfill on {workers} worker(s): {time.perf_counter() - started:.2f} s')
+    print(f'{DailyVariantSales.objects.count()} variant rollup rows, {OrderItem.objects.count()} order items')
+
+    end = timezone.localdate()
+    for label, days in [('week', 7), ('quarter', 91), ('year', 366)]:
+        start = end - timedelta(days=days - 1)
+        created = sales_rollups.day_bounds(start, end)
+
+        def scan_categories():
+            list(
+                OrderItem.objects.filter(order__created_at__gte=created[0], order__created_at__lt=created[1])
+                .exclude(order__status='cancelled')
+                .values('product__product__category_id')
+                .annotate(revenue=Sum(F('price_at_order') * F('quantity')), units=Sum('quantity'))
+                .order_by('-revenue')
+            )
+
+        def rollup_categories():
+            sales_rollups.report('category', start, end)
+
+        def rollup_top_variants():
+            sales_rollups.report('variant', start, end, limit=20)
+
+        report(f'{label}: revenue per category, order items', summarize(measure(scan_categories, args.iterations)))
+        report(f'{label}: revenue per category, rollups', summarize(measure(rollup_categories, args.iterations)))
+        report(f'{label}: top 20 variants, rollups', summarize(measure(rollup_top_variants, args.iterations)))
+
+
+if __name__ == '__main__':
+    main()
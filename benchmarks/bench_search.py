@@ -0,0 +1,56 @@
+"""
+Product search: FTS5 index vs. the LIKE '%term%' scan SearchFilter used to run.
+
+    python benchmarks/bench_search.py [--products 100000] [--iterations 200]
+"""
+import argparse
+
+from common import measure, report, seed_products, setup_django, summarize
+
+TERMS = ['tom', 'tomato', 'onion garlic', 'organic', 'fresh mango', 'cum', 'dairy']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=100_000)
+    parser.add_argument('--iterations', type=int, default=200)
+    args = parser.parse_args()
+
+    setup_django()
+    seed_products(args.products)
+
+    from django.db.models import Q
+    from django.test import Client
+
+    from api.models import Product
+    from api.utils import search
+    from api.utils.versions import bump_version
+
+    client = Client()
+
+    print(f'{Product.objects.count()} products')
+    for term in TERMS:
+        def fts():
+            search.search_product_ids(term)
+
+        def fts_cold():
+            bump_version('search')
+            search.search_product_ids(term)
+
+        def like():
+            list(
+                Product.objects.filter(Q(name__icontains=term) | Q(category__name__icontains=term))
+                .values_list('id', flat=True)[:search.get_rank_limit()]
+            )
+
+        def endpoint():
+            assert client.get('/api/products/', {'search': term}).status_code == 200
+
+        report(f'fts5 ids      "{term}"', summarize(measure(fts, args.iterations)))
+        report(f'fts5 ids cold "{term}"', summarize(measure(fts_cold, max(10, args.iterations // 4))))
+        report(f'icontains ids "{term}"', summarize(measure(like, max(10, args.iterations // 10))))
+        report(f'GET /api/products/?search="{term}"', summarize(measure(endpoint, max(10, args.iterations // 4))))
+
+
+if __name__ == '__main__':
+    main()
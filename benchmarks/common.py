@@ -0,0 +1,237 @@
+"""
+Shared setup for the benchmark scripts in this directory.
+
+Benchmarks run against their own SQLite file (BENCH_DB, or a temporary file
+by default) so seeding never touches db.sqlite3. Reusing a seeded BENCH_DB
+between runs skips the seeding step.
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+WORDS = (
+    'tomato onion carrot potato apple banana mango grape orange lemon ginger garlic spinach '
+    'cabbage beans peas chilli coriander mint basil rice wheat millet dal paneer curd milk '
+    'butter ghee honey jaggery almond cashew raisin pepper turmeric cumin mustard'
+).split()
+BRANDS = ['Ooty', 'Nandini', 'Organic Tattva', 'FreshCo', 'Farm Pure', 'Village Roots', '']
+
+
+def setup_django(db_path=None):
+    sys.path.insert(0, str(ROOT))
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+
+    from django.conf import settings
+
+    settings.DATABASES['default']['NAME'] = (
+        db_path or os.environ.get('BENCH_DB') or os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+    )
+    settings.DEBUG = False
+    settings.ALLOWED_HOSTS = ['*']
+
+    import django
+
+    django.setup()
+
+    from django.core.management import call_command
+
+    call_command('migrate', verbosity=0)
+
+
+ROOT_CATEGORIES = ['Vegetables', 'Fruits', 'Dairy', 'Grains', 'Spices', 'Dry Fruits']
+SUBCATEGORIES = ['Organic', 'Exotic', 'Local', 'Premium', 'Value']
+LEAF_CATEGORIES = ['Loose', 'Packed', 'Bulk', 'Gift']
+
+
+def seed_categories():
+    """
+    A three-level category tree (6 roots, 5 children each, 4 leaves under
+    every child); returns the leaves, which is where products go.
+    """
+    from api.models import Category
+
+    def get(name, parent=None):
+        return Category.objects.get_or_create(name=name, defaults={'parent': parent})[0]
+
+    leaves = []
+    for root_name in ROOT_CATEGORIES:
+        root = get(root_name)
+        for child_name in SUBCATEGORIES:
+            child = get(f'{child_name} {root_name}', root)
+            leaves += [get(f'{child_name} {root_name} ({leaf})', child) for leaf in LEAF_CATEGORIES]
+    return leaves
+
+
+def seed_products(count, seed=1):
+    """
+    Bulk-insert `count` products with two variants and an image each, spread
+    over the leaves of the category tree. Signals don't fire for bulk
+    inserts, so the search index and the listings are rebuilt afterwards.
+    """
+    from api.models import Product, ProductImage, ProductVariant, Tag
+    from api.utils import listings, search
+
+    existing = Product.objects.count()
+    if existing >= count:
+        return existing
+
+    rng = random.Random(seed)
+    categories = seed_categories()
+    Tag.objects.bulk_create([Tag(name=word) for word in WORDS], ignore_conflicts=True)
+    tags = list(Tag.objects.filter(name__in=WORDS))
+
+    batch = 5000
+    for start in range(existing, count, batch):
+        products = []
+        for index in range(start, min(start + batch, count)):
+            words = rng.sample(WORDS, 3)
+            products.append(Product(
+                name=' '.join(words[:2]).title(),
+                slug=f'product-{index}',
+                description=f'Fresh {words[0]} with {words[2]}, sourced locally.',
+                category=rng.choice(categories),
+                brand=rng.choice(BRANDS),
+            ))
+        Product.objects.bulk_create(products)
+        Product.tags.through.objects.bulk_create([
+            Product.tags.through(product=product, tag=tag) for product in products for tag in rng.sample(tags, 2)
+        ])
+        ProductVariant.objects.bulk_create([
+            ProductVariant(product=product, unit=unit, price=rng.randint(20, 500), stock=rng.randint(0, 50),
+                           discount_percent=rng.choice([0, 0, 5, 10]))
+            for product in products for unit in ('500g', '1kg')
+        ])
+        ProductImage.objects.bulk_create([
+            ProductImage(product=product, image=f'product_images/{product.slug}.webp', is_primary=True)
+            for product in products
+        ])
+
+    search.rebuild_index()
+    listings.rebuild()
+    return count
+
+
+def seed_postal_codes(count):
+    from api.models import PostalCode
+
+    if PostalCode.objects.count() < count:
+        PostalCode.objects.bulk_create(
+            [PostalCode(code=str(500000 + index)) for index in range(count)], ignore_conflicts=True
+        )
+    return [str(500000 + index) for index in range(count)]
+
+
+def seed_users(count, riders=200, seed=1):
+    """
+    Bulk-insert `count` customers, each with a token, one address, 0-3 cart
+    lines and 0-4 past orders (with items, payment and delivery), plus
+    `riders` delivery persons spread around the same city. Needs products.
+    """
+    from django.contrib.auth.hashers import make_password
+    from rest_framework.authtoken.models import Token
+
+    from api.models import Address, Cart, CustomUser, Delivery, Order, OrderItem, Payment, ProductVariant
+
+    existing = CustomUser.objects.filter(username__startswith='u').count()
+    if existing >= count:
+        return existing
+
+    rng = random.Random(seed)
+    password = make_password('bench-password')
+    variants = list(ProductVariant.objects.values_list('id', 'price'))
+
+    def address(user):
+        return Address(
+            user=user, address_line=f'{rng.randint(1, 999)} Main Road', city='Bengaluru',
+            postal_code=str(500000 + rng.randrange(20000)), is_default=True,
+            latitude=12.97 + rng.uniform(-0.2, 0.2), longitude=77.59 + rng.uniform(-0.2, 0.2),
+        )
+
+    if not CustomUser.objects.filter(user_role='Delivery_Person').exists():
+        rider_rows = CustomUser.objects.bulk_create([
+            CustomUser(username=f'r{index}', full_name=f'Rider {index}', password=password,
+                       user_role='Delivery_Person')
+            for index in range(riders)
+        ])
+        Address.objects.bulk_create([address(user) for user in rider_rows])
+
+    # Spread order history over the last year instead of stamping it all "now".
+    created_at = Order._meta.get_field('created_at')
+    created_at.auto_now_add = False
+    now = time.time()
+    try:
+        batch = 2000
+        for start in range(existing, count, batch):
+            users = CustomUser.objects.bulk_create([
+                CustomUser(username=f'u{index}', full_name=f'User {index}', password=password)
+                for index in range(start, min(start + batch, count))
+            ])
+            Token.objects.bulk_create([Token(user=user, key=Token.generate_key()) for user in users])
+            Address.objects.bulk_create([address(user) for user in users])
+            Cart.objects.bulk_create([
+                Cart(user=user, product_id=variant_id, quantity=rng.randint(1, 3))
+                for user in users for variant_id, _ in rng.sample(variants, rng.randint(0, 3))
+            ])
+
+            orders, items = [], []
+            for user in users:
+                for _ in range(rng.randint(0, 4)):
+                    lines = rng.sample(variants, rng.randint(1, 4))
+                    order_items = [(variant_id, rng.randint(1, 3), price) for variant_id, price in lines]
+                    total = sum(price * quantity for _, quantity, price in order_items)
+                    order = Order(
+                        user=user, status=rng.choice(['completed', 'completed', 'shipped', 'cancelled']),
+                        total_amount=total,
+                        created_at=datetime.fromtimestamp(now - rng.uniform(0, 365 * 86400), timezone.utc),
+                    )
+                    orders.append(order)
+                    items += [
+                        OrderItem(order=order, product_id=variant_id, quantity=quantity, price_at_order=price)
+                        for variant_id, quantity, price in order_items
+                    ]
+            Order.objects.bulk_create(orders)
+            OrderItem.objects.bulk_create(items)
+            Payment.objects.bulk_create([
+                Payment(order=order, payment_method='cod', payment_status='paid', amount_paid=order.total_amount)
+                for order in orders
+            ])
+            Delivery.objects.bulk_create([Delivery(order=order, delivery_status='delivered') for order in orders])
+    finally:
+        created_at.auto_now_add = True
+    return count
+
+
+def measure(fn, iterations, warmup=5):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+
+def summarize(samples):
+    ordered = sorted(samples)
+    return {
+        'runs': len(ordered),
+        'mean_ms': statistics.fmean(ordered) * 1000,
+        'p50_ms': ordered[len(ordered) // 2] * 1000,
+        'p99_ms': ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))] * 1000,
+        'ops_per_s': len(ordered) / sum(ordered) if sum(ordered) else 0.0,
+    }
+
+
+def report(name, summary):
+    print(
+        f"{name:<40} p50 {summary['p50_ms']:8.2f} ms   p99 {summary['p99_ms']:8.2f} ms   "
+        f"{summary['ops_per_s']:9.1f} ops/s"
+    )
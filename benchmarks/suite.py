@@ -0,0 +1,468 @@
+"""
+Storefront benchmark suite.
+
+Seeds a synthetic dataset (100k products over a nested category tree, 50k
+customers with carts and order history, delivery riders, postal codes),
+then drives the main endpoints through the Django test client and through
+a local HTTP server, and records throughput, p50/p99 latency and SQL
+queries per request. Results are written as JSON and compared with a
+stored baseline; the script exits with status 1 on a regression.
+
+    python benchmarks/suite.py [--products 100000] [--users 50000]
+        [--transport client wsgi asgi] [--requests 300] [--concurrency 8]
+        [--output results.json] [--baseline benchmarks/baseline.json]
+        [--save-baseline] [--tolerance 0.25]
+
+Seeding 100k products and 50k users takes a few minutes; point BENCH_DB at
+a file to keep the seeded database between runs. The "asgi" transport
+needs uvicorn (or daphne) and is skipped without either. Query counts of
+the server transports come from the server's own /api/stats/requests/.
+
+Latency baselines are only comparable on the same machine; query counts
+are comparable anywhere.
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from common import ROOT, seed_postal_codes, seed_products, seed_users, setup_django, summarize
+
+HERE = Path(__file__).resolve().parent
+SEARCH_TERMS = ['tom', 'tomato', 'onion garlic', 'organic', 'fresh mango', 'cum', 'dairy']
+STAFF_USERNAME = 'benchstaff'
+MIN_LATENCY_REGRESSION_MS = 0.5
+
+
+class Context:
+    """
+    Ids and tokens the scenarios draw from, loaded once after seeding.
+    Customers are split so that checkout, add-to-cart and order placement
+    never touch each other's carts.
+    """
+
+    def __init__(self, requests):
+        from django.contrib.auth import get_user_model
+        from django.db.models import Count
+        from rest_framework.authtoken.models import Token
+
+        from api.models import Product, ProductVariant
+
+        User = get_user_model()
+        staff, _ = User.objects.get_or_create(
+            username=STAFF_USERNAME, defaults={'full_name': 'Bench Staff', 'is_staff': True}
+        )
+        self.staff_token = Token.objects.get_or_create(user=staff)[0].key
+
+        customers = list(
+            Token.objects.filter(user__username__startswith='u')
+            .annotate(lines=Count('user__carts'))
+            .order_by('user__username')
+            .values_list('key', 'user_id', 'lines')
+        )
+        with_cart = [(key, user_id) for key, user_id, lines in customers if lines]
+        self.checkout_users = with_cart[:max(requests, 1)]
+        taken = {user_id for _, user_id in self.checkout_users}
+        rest = [(key, user_id) for key, user_id, _ in customers if user_id not in taken]
+        self.cart_users = rest[:max(requests, 1)]
+        # Every placed order empties a cart; each iteration gets its own customer.
+        self.order_users = rest[len(self.cart_users):]
+
+        self.products = [str(pk) for pk in Product.objects.order_by('-created_at').values_list('pk', flat=True)[:5000]]
+        self.variants = list(ProductVariant.objects.order_by('id').values_list('id', flat=True)[:5000])
+        # Plenty of stock for the carts filled before placing orders.
+        self.stocked = self.variants[:500]
+        ProductVariant.objects.filter(pk__in=self.stocked).update(stock=10 ** 6)
+        self.postal_codes = seed_postal_codes(20_000)
+        self.rng = random.Random(1)
+        self._order_index = 0
+        self._lock = threading.Lock()
+
+    def next_order_user(self):
+        with self._lock:
+            user = self.order_users[self._order_index % len(self.order_users)]
+            self._order_index += 1
+        return user
+
+
+class Scenario:
+    """
+    One endpoint under load. `request(ctx, i)` returns (method, path, body,
+    token); `prepare(ctx, i)`, when given, runs untimed before the request,
+    e.g. to fill the cart an order is placed from, and returns the token to
+    use. `before` are paths requested untimed (and with the same token)
+    first, the way a client would, e.g. checkout before placing the order.
+    """
+
+    def __init__(self, name, view, request, prepare=None, before=(), expected=200):
+        self.name = name
+        self.view = view
+        self.request = request
+        self.prepare = prepare
+        self.before = before
+        self.expected = expected
+
+
+def _fill_cart(ctx, i):
+    from api.models import Cart
+
+    key, user_id = ctx.next_order_user()
+    Cart.objects.filter(user_id=user_id).delete()
+    Cart.objects.bulk_create([
+        Cart(user_id=user_id, product_id=variant_id, quantity=1)
+        for variant_id in ctx.rng.sample(ctx.stocked, 3)
+    ])
+    return key
+
+
+SCENARIOS = [
+    Scenario('catalog_list', 'GET product-list', lambda ctx, i: ('GET', '/api/products/', None, None)),
+    Scenario('category_list', 'GET category-list', lambda ctx, i: ('GET', '/api/categories/', None, None)),
+    Scenario('catalog_search', 'GET product-list', lambda ctx, i: (
+        'GET', f'/api/products/?search={SEARCH_TERMS[i % len(SEARCH_TERMS)].replace(" ", "+")}', None, None,
+    )),
+    Scenario('add_to_cart', 'POST add-to-cart', lambda ctx, i: (
+        'POST', '/api/cart/add/', {'product_id': ctx.variants[i % len(ctx.variants)], 'quantity': 1},
+        ctx.cart_users[i % len(ctx.cart_users)][0],
+    )),
+    Scenario('checkout', 'POST checkout', lambda ctx, i: (
+        'POST', '/api/cart/checkout/', {}, ctx.checkout_users[i % len(ctx.checkout_users)][0],
+    )),
+    Scenario('place_order', 'POST place-order', lambda ctx, i, key=None: (
+        'POST', '/api/order/place/', {'note': 'bench'}, key,
+    ), prepare=_fill_cart, before=['/api/cart/checkout/'], expected=201),
+    Scenario('order_history', 'GET user-orders', lambda ctx, i: (
+        'GET', '/api/orders/', None, ctx.checkout_users[i % len(ctx.checkout_users)][0],
+    )),
+    Scenario('validate_postal', 'POST validate-postal', lambda ctx, i: (
+        'POST', '/api/validate-postal/', {'postal_code': ctx.postal_codes[i % len(ctx.postal_codes)]}, None,
+    )),
+    Scenario('product_detail', 'GET product-detail', lambda ctx, i: (
+        'GET', f'/api/products/{ctx.products[i % len(ctx.products)]}/', None, None,
+    )),
+    Scenario('category_tree', 'GET category-tree', lambda ctx, i: ('GET', '/api/categories/tree/', None, None)),
+    # The same reads through the async views (api/async_views.py).
+    Scenario('async_catalog_list', 'GET async-product-list', lambda ctx, i: (
+        'GET', '/api/async/products/', None, None,
+    )),
+    Scenario('async_product_detail', 'GET async-product-detail', lambda ctx, i: (
+        'GET', f'/api/async/products/{ctx.products[i % len(ctx.products)]}/', None, None,
+    )),
+    Scenario('async_category_tree', 'GET async-category-tree', lambda ctx, i: (
+        'GET', '/api/async/categories/tree/', None, None,
+    )),
+    Scenario('async_order_history', 'GET async-user-orders', lambda ctx, i: (
+        'GET', '/api/async/orders/', None, ctx.checkout_users[i % len(ctx.checkout_users)][0],
+    )),
+    Scenario('async_validate_postal', 'POST async-validate-postal', lambda ctx, i: (
+        'POST', '/api/async/validate-postal/', {'postal_code': ctx.postal_codes[i % len(ctx.postal_codes)]}, None,
+    )),
+]
+
+
+def _build_request(scenario, ctx, i):
+    if scenario.prepare is None:
+        request = scenario.request(ctx, i)
+    else:
+        request = scenario.request(ctx, i, key=scenario.prepare(ctx, i))
+    method, path, body, token = request
+    return request, [('POST', before, body, token) for before in scenario.before]
+
+
+def _result(samples, statuses, scenario, elapsed, queries):
+    summary = summarize(samples)
+    summary['ops_per_s'] = len(samples) / elapsed if elapsed else 0.0
+    summary['errors'] = sum(1 for code in statuses if code != scenario.expected)
+    summary['queries'] = queries
+    return summary
+
+
+def run_client(ctx, scenario, count, warmup):
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+
+    client = Client()
+
+    def send(method, path, body, token):
+        headers = {'HTTP_AUTHORIZATION': f'Token {token}'} if token else {}
+        if method == 'GET':
+            return client.get(path, **headers)
+        return client.post(path, body, content_type='application/json', **headers)
+
+    def call(i):
+        request, before = _build_request(scenario, ctx, i)
+        for untimed in before:
+            send(*untimed)
+        started = time.perf_counter()
+        with CaptureQueriesContext(connection) as captured:
+            response = send(*request)
+        return time.perf_counter() - started, response.status_code, len(captured)
+
+    for i in range(warmup):
+        call(i)
+    samples, statuses, queries = [], [], []
+    elapsed = 0.0
+    for i in range(warmup, warmup + count):
+        seconds, code, query_count = call(i)
+        samples.append(seconds)
+        statuses.append(code)
+        queries.append(query_count)
+        elapsed += seconds
+    return _result(samples, statuses, scenario, elapsed, sum(queries) / len(queries))
+
+
+def _http(port, method, path, body=None, token=None):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    headers = {'Content-Type': 'application/json'}
+    if token:
+        headers['Authorization'] = f'Token {token}'
+    try:
+        connection.request(method, path, json.dumps(body) if body is not None else None, headers)
+        response = connection.getresponse()
+        return response.status, response.read()
+    finally:
+        connection.close()
+
+
+def run_server(ctx, scenario, count, warmup, port, concurrency):
+    def call(i):
+        request, before = _build_request(scenario, ctx, i)
+        for untimed in before:
+            _http(port, *untimed)
+        started = time.perf_counter()
+        code, _ = _http(port, *request)
+        return time.perf_counter() - started, code
+
+    for i in range(warmup):
+        call(i)
+    _http(port, 'DELETE', '/api/stats/requests/', token=ctx.staff_token)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        outcomes = list(pool.map(call, range(warmup, warmup + count)))
+    elapsed = time.perf_counter() - started
+
+    _, payload = _http(port, 'GET', '/api/stats/requests/', token=ctx.staff_token)
+    view = json.loads(payload)['views'].get(scenario.view)
+    queries = view['queries']['mean'] if view else None
+    return _result([seconds for seconds, _ in outcomes], [code for _, code in outcomes], scenario, elapsed, queries)
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(transport, db_path):
+    port = _free_port()
+    env = dict(os.environ, BENCH_DB=db_path)
+    process = subprocess.Popen(
+        [sys.executable, str(HERE / 'suite.py'), '--serve', transport, '--port', str(port)], env=env, cwd=HERE,
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{transport} server exited with {process.returncode}')
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return process, port
+        except OSError:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError(f'{transport} server did not start')
+
+
+def serve(transport, port):
+    setup_django()
+    if transport == 'wsgi':
+        from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+        from django.core.wsgi import get_wsgi_application
+
+        class QuietHandler(WSGIRequestHandler):
+            def log_message(self, *args):
+                pass
+
+        class Server(ThreadedWSGIServer):
+            # The default backlog of 5 resets connections under load.
+            request_queue_size = 1024
+
+        server = Server(('127.0.0.1', port), QuietHandler)
+        server.set_app(get_wsgi_application())
+        server.serve_forever()
+    else:
+        from django.core.asgi import get_asgi_application
+
+        application = get_asgi_application()
+        try:
+            import uvicorn
+        except ImportError:
+            from daphne.endpoints import build_endpoint_description_strings
+            from daphne.server import Server
+
+            Server(application, build_endpoint_description_strings(host='127.0.0.1', port=port), verbosity=0).run()
+        else:
+            uvicorn.run(application, host='127.0.0.1', port=port, log_level='warning', lifespan='off')
+
+
+def asgi_server_available():
+    for module in ('uvicorn', 'daphne'):
+        try:
+            __import__(module)
+            return True
+        except ImportError:
+            pass
+    return False
+
+
+def compare(results, baseline, tolerance):
+    """
+    Regressions against `baseline`: more queries per request than before,
+    or a p50 latency more than `tolerance` (and MIN_LATENCY_REGRESSION_MS)
+    slower.
+    """
+    regressions = []
+    for key, current in results.items():
+        previous = baseline.get(key)
+        if not previous:
+            continue
+        change = current['p50_ms'] / previous['p50_ms'] - 1 if previous['p50_ms'] else 0.0
+        line = f'{key:<32} p50 {previous["p50_ms"]:8.2f} -> {current["p50_ms"]:8.2f} ms ({change:+.0%})'
+        if current['queries'] is not None and previous['queries'] is not None:
+            line += f'   queries {previous["queries"]:.1f} -> {current["queries"]:.1f}'
+            if current['queries'] > previous['queries'] + 0.5:
+                regressions.append(f'{key}: queries per request went from {previous["queries"]:.1f} '
+                                   f'to {current["queries"]:.1f}')
+        # Sub-millisecond endpoints swing by more than any sane tolerance.
+        if change > tolerance and current['p50_ms'] - previous['p50_ms'] > MIN_LATENCY_REGRESSION_MS:
+            regressions.append(f'{key}: p50 went from {previous["p50_ms"]:.2f} to {current["p50_ms"]:.2f} ms')
+        print(line)
+    return regressions
+
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=100_000)
+    parser.add_argument('--users', type=int, default=50_000)
+    parser.add_argument('--transport', nargs='+', default=['client', 'wsgi', 'asgi'],
+                        choices=['client', 'wsgi', 'asgi'])
+    parser.add_argument('--scenario', nargs='+', choices=[scenario.name for scenario in SCENARIOS])
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--output', default=str(HERE / 'results.json'))
+    parser.add_argument('--baseline', default=str(HERE / 'baseline.json'))
+    parser.add_argument('--save-baseline', action='store_true', help='Store these results as the new baseline.')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed p50 slowdown, as a fraction.')
+    parser.add_argument('--serve', choices=['wsgi', 'asgi'], help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.serve, args.port)
+        return
+
+    if not os.environ.get('BENCH_DB'):
+        import tempfile
+        os.environ['BENCH_DB'] = os.path.join(tempfile.mkdtemp(), 'suite.sqlite3')
+    db_path = os.environ['BENCH_DB']
+    setup_django(db_path)
+
+    import django
+    from django.contrib.auth import get_user_model
+
+    from api.models import Product
+
+    started = time.monotonic()
+    seed_products(args.products)
+    seed_users(args.users)
+    print(f'Seeded in {time.monotonic() - started:.0f} s: {Product.objects.count()} products, '
+          f'{get_user_model().objects.count()} users')
+
+    ctx = Context(args.requests + args.warmup)
+    scenarios = [scenario for scenario in SCENARIOS if not args.scenario or scenario.name in args.scenario]
+
+    results = {}
+    for transport in args.transport:
+        if transport == 'asgi' and not asgi_server_available():
+            print('Skipping asgi: neither uvicorn nor daphne is installed.')
+            continue
+        server = None
+        if transport != 'client':
+            server, port = start_server(transport, db_path)
+        try:
+            for scenario in scenarios:
+                if transport == 'client':
+                    result = run_client(ctx, scenario, args.requests, args.warmup)
+                else:
+                    result = run_server(ctx, scenario, args.requests, args.warmup, port, args.concurrency)
+                key = f'{transport}/{scenario.name}'
+                results[key] = result
+                queries = f'{result["queries"]:6.1f}' if result['queries'] is not None else '     -'
+                print(
+                    f'{key:<32} p50 {result["p50_ms"]:8.2f} ms   p99 {result["p99_ms"]:8.2f} ms   '
+                    f'{result["ops_per_s"]:8.1f} req/s   queries {queries}   errors {result["errors"]}'
+                )
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    document = {
+        'meta': {
+            'revision': _git_revision(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'machine': platform.platform(),
+            'products': args.products,
+            'users': args.users,
+            'requests': args.requests,
+            'concurrency': args.concurrency,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as handle:
+        json.dump(document, handle, indent=2, sort_keys=True)
+    print(f'\nResults written to {args.output}')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as handle:
+            json.dump(document, handle, indent=2, sort_keys=True)
+        print(f'Baseline saved to {args.baseline}')
+        return
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as handle:
+            baseline = json.load(handle)
+        print(f'\nAgainst baseline {args.baseline} ({baseline["meta"].get("revision")}):')
+        regressions = compare(results, baseline['results'], args.tolerance)
+        if regressions:
+            print('\nRegressions:')
+            for regression in regressions:
+                print(f'  {regression}')
+            sys.exit(1)
+        print('No regressions.')
+
+
+if __name__ == '__main__':
+    main()